@@ -3,26 +3,154 @@ API OTP con doble validación: Usuario + Dispositivo
 Versión completa con todos los endpoints
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from supabase import create_client, Client
 import os
-import traceback
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import time
 import pyotp
-import qrcode
+from collections import Counter
 from datetime import datetime, timedelta
+from lookup_cache import users_cache, devices_cache, version_cache
+from log_writer import create_log_writer
+from device_touch import create_device_touch
+from change_feed import change_feed
+from metrics import registry as metrics, InstrumentedStorage
+from shared_state import create_shared_state
+from app_logging import get_logger
+from totp_verifier import verifier
+from replay_guard import create_replay_guard
+from rate_limiter import create_rate_limiter, rate_limit_keys
+from qr_cache import qr_cache, provisioning_uri
+from bulk_provision import detect_format, parse_rows, provision, write_zip
+from rotation_job import create_rotation_job, start_scheduler
+from storage_manager import create_storage, USER_PUBLIC_COLUMNS
+from log_rollups import DIMENSIONS, GRANULARITIES, bucket_of
+from pagination import (
+    PAGE_KEYS, MAX_PAGE_SIZE, InvalidCursor, decode_cursor, page_size, split_page
+)
+
+log = get_logger('api')
 
 app = Flask(__name__, static_folder='static')
 CORS(app)
 
-# Configuración Supabase
-SUPABASE_URL = os.environ.get('SUPABASE_URL')
-SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+# Almacenamiento (OTP_STORAGE = supabase | sqlite | memory), con cada llamada medida
+storage = InstrumentedStorage(create_storage(), metrics)
+
+
+def _insert_logs(rows):
+    """Inserción multi-fila usada por el escritor de logs"""
+    storage.insert_logs(rows)
+    change_feed.publish('log', rows)
+
+
+def _touch_devices(rows):
+    storage.touch_devices(rows)
+    _devices_changed()
+    change_feed.publish('device', rows)
+
+
+def _device_version():
+    """Versión de la tabla devices (caché de OTP_VERSION_TTL segundos)"""
+    return version_cache.get_or_load('devices', storage.device_version)
+
+
+def _devices_changed():
+    version_cache.invalidate('devices')
+
+
+log_writer = create_log_writer(_insert_logs)
+
+# last_used / ip_address de dispositivos: se agrupan y se escriben cada
+# OTP_DEVICE_TOUCH_INTERVAL segundos
+device_touch = create_device_touch(_touch_devices)
+
+# Códigos ya usados por (user_id, paso) (OTP_REPLAY_BACKEND = memory | sqlite | off)
+replay_guard = create_replay_guard(window=verifier.window)
+
+# Límite por usuario, dispositivo e IP con bloqueo tras fallos (OTP_RATE_LIMIT=0 lo desactiva)
+rate_limiter = create_rate_limiter()
+
+# Varios workers (OTP_SHARED_STATE=1): invalidaciones, feed de cambios y
+# métricas se comparten entre procesos del host
+shared_state = create_shared_state()
+if shared_state is not None:
+    for cache in (users_cache, devices_cache, version_cache):
+        shared_state.attach_cache(cache)
+    shared_state.attach_feed(change_feed)
+    shared_state.attach_metrics(metrics)
+
+    @app.before_request
+    def _shared_state_start():
+        shared_state.ensure_started()
+
+
+# ============================================
+# MÉTRICAS
+# ============================================
+def _endpoint_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.before_request
+def _metrics_start():
+    g.metrics_start = time.perf_counter()
+    g.metrics_endpoint = _endpoint_label()
+    metrics.gauge_add('otp_http_requests_in_flight', (('endpoint', g.metrics_endpoint),))
+
+
+@app.after_request
+def _metrics_record(response):
+    start = g.get('metrics_start')
+    if start is not None:
+        endpoint = g.metrics_endpoint
+        metrics.observe('otp_http_request_duration_seconds', (('endpoint', endpoint),),
+                        time.perf_counter() - start)
+        metrics.inc('otp_http_requests_total', (
+            ('endpoint', endpoint), ('method', request.method), ('status', str(response.status_code))
+        ))
+    return response
+
+
+@app.teardown_request
+def _metrics_finish(exc):
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        metrics.gauge_add('otp_http_requests_in_flight', (('endpoint', endpoint),), -1)
+
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("SUPABASE_URL y SUPABASE_KEY deben estar configuradas")
+def _queue_gauges():
+    writer = log_writer.stats()
+    touches = device_touch.stats()
+    gauges = [
+        ('otp_log_queue_depth', (), writer['queued']),
+        ('otp_log_rows_dropped_total', (), writer['dropped']),
+        ('otp_device_touch_pending', (), touches['pending']),
+    ]
+    for cache in (users_cache, devices_cache):
+        stats = cache.stats()
+        gauges.append(('otp_cache_hits_total', (('cache', cache.name),), stats['hits']))
+        gauges.append(('otp_cache_misses_total', (('cache', cache.name),), stats['misses']))
+    return gauges
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+metrics.describe('otp_log_queue_depth', 'gauge', 'Logs en cola pendientes de insertar')
+metrics.describe('otp_log_rows_dropped_total', 'counter', 'Logs descartados por cola llena')
+metrics.describe('otp_device_touch_pending', 'gauge', 'Dispositivos con last_used pendiente de escribir')
+metrics.describe('otp_cache_hits_total', 'counter', 'Aciertos de la caché de lecturas')
+metrics.describe('otp_cache_misses_total', 'counter', 'Fallos de la caché de lecturas')
+metrics.register_callback(_queue_gauges)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 # ============================================
@@ -37,9 +165,11 @@ def home():
         'status': 'online',
         'endpoints': {
             'auth': '/api/validate_totp',
+            'auth_batch': '/api/validate_totp/batch',
             'users': '/api/users',
             'devices': '/api/devices',
-            'logs': '/api/logs'
+            'logs': '/api/logs',
+            'log_stats': '/api/logs/stats'
         }
     })
 
@@ -62,10 +192,7 @@ def validate_totp():
         otp = req.get("otp")
         device_name = req.get("device_name")
         
-        print(f"\n{'='*60}")
-        print(f"📨 AUTENTICACIÓN")
-        print(f"{'='*60}")
-        print(f"Usuario: {user_id}, Dispositivo: {device_name}, OTP: {otp}")
+        log.debug("Solicitud de autenticación", extra={'user_id': user_id, 'device_name': device_name})
         
         # Validar campos
         if not user_id or not otp or not device_name:
@@ -75,52 +202,43 @@ def validate_totp():
             if not device_name: missing.append("device_name")
             return jsonify({'valid': False, 'message': f'Faltan: {", ".join(missing)}'}), 400
 
-        # Validar usuario
-        user_response = supabase.table("users").select("*").eq("user_id", user_id).limit(1).execute()
-        users = user_response.data or []
-        
-        if not users:
-            _log_attempt(user_id, device_name, "Usuario no encontrado", "user_not_found")
-            return jsonify({'valid': False, 'message': 'Usuario no encontrado'}), 404
-        
-        user = users[0]
-        
-        if not user.get("status_user", False):
-            _log_attempt(user_id, device_name, "Usuario inactivo", "user_inactive")
-            return jsonify({'valid': False, 'message': 'Usuario inactivo'}), 403
-        
-        totp_secret = user.get("totp_secret")
-        if not totp_secret:
-            return jsonify({'valid': False, 'message': 'Usuario sin TOTP'}), 400
+        # Límite de intentos: se rechaza antes de tocar la base de datos
+        client_ip = get_client_ip()
+        limit_keys = rate_limit_keys(user_id, device_name, client_ip)
+        if rate_limiter:
+            retry_after = rate_limiter.check(limit_keys)
+            if retry_after:
+                response = jsonify({'valid': False, 'message': 'Demasiados intentos', 'retry_after': retry_after})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
 
-        # Validar dispositivo
-        device_response = supabase.table("devices").select("*").eq("name", device_name).limit(1).execute()
-        devices = device_response.data or []
-        
-        if not devices:
-            _log_attempt(user_id, device_name, "Dispositivo no registrado", "device_not_found")
-            return jsonify({'valid': False, 'message': 'Dispositivo no autorizado'}), 403
-        
-        device = devices[0]
-        
-        if not device.get("enabled", False):
-            _log_attempt(user_id, device_name, "Dispositivo deshabilitado", "device_disabled")
-            return jsonify({'valid': False, 'message': 'Dispositivo deshabilitado'}), 403
+        # Usuario + dispositivo en una sola consulta (o desde caché)
+        user, device = _fetch_user_device(user_id, device_name)
 
-        # Validar OTP
-        totp = pyotp.TOTP(totp_secret)
-        
-        if totp.verify(str(otp), valid_window=1):
-            # Actualizar dispositivo
-            supabase.table("devices").update({
-                "last_used": datetime.now().isoformat(),
-                "ip_address": get_client_ip()
-            }).eq("name", device_name).execute()
-            
+        # Validar usuario y dispositivo
+        rejection = _reject_user_device(user, device)
+        if rejection:
+            status, message, logged = rejection
+            if logged:
+                _log_attempt(user_id, device_name, *logged)
+            return jsonify({'valid': False, 'message': message}), status
+
+        # Validar OTP (clave y códigos de la ventana en caché)
+        step = verifier.verify(user["totp_secret"], otp)
+        if step is not None:
+            # Un código solo se acepta una vez dentro de su ventana
+            if not replay_guard.claim(user_id, step):
+                _log_attempt(user_id, device_name, "OTP reutilizado", "otp_replay")
+                _register_failure(user_id, device_name, limit_keys)
+                return jsonify({'valid': False, 'message': 'OTP ya utilizado'}), 401
+
+            # Actualizar dispositivo: solo tras una verificación exitosa
+            device_touch.touch(device_name, datetime.now().isoformat(), client_ip)
+
+            if rate_limiter:
+                rate_limiter.success(limit_keys)
             _log_attempt(user_id, device_name, "Acceso exitoso", "login_success")
             
-            print(f"✅ ACCESO CONCEDIDO\n")
-            
             return jsonify({
                 'valid': True,
                 'message': 'Autenticación exitosa',
@@ -132,15 +250,231 @@ def validate_totp():
             }), 200
 
         _log_attempt(user_id, device_name, "OTP incorrecto", "otp_invalid")
-        print(f"❌ OTP INVÁLIDO\n")
+        _register_failure(user_id, device_name, limit_keys)
         return jsonify({'valid': False, 'message': 'OTP inválido'}), 401
 
     except Exception as e:
-        print(f"💥 ERROR: {str(e)}")
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'valid': False, 'error': str(e)}), 500
 
 
+def _reject_user_device(user, device):
+    """
+    Reglas comunes de usuario y dispositivo. None si se puede verificar el
+    código; si no, (estado HTTP, mensaje, (acción, log_type) o None).
+    """
+    if not user:
+        return 404, 'Usuario no encontrado', ("Usuario no encontrado", "user_not_found")
+    if not user.get("status_user", False):
+        return 403, 'Usuario inactivo', ("Usuario inactivo", "user_inactive")
+    if not user.get("totp_secret"):
+        return 400, 'Usuario sin TOTP', None
+    if not device:
+        return 403, 'Dispositivo no autorizado', ("Dispositivo no registrado", "device_not_found")
+    if not device.get("enabled", False):
+        return 403, 'Dispositivo deshabilitado', ("Dispositivo deshabilitado", "device_disabled")
+    return None
+
+
+# Elementos por petición en /api/validate_totp/batch
+BATCH_MAX = int(os.environ.get('OTP_BATCH_MAX', 500))
+
+
+@app.route('/api/validate_totp/batch', methods=['POST'])
+def validate_totp_batch():
+    """
+    Valida varios códigos en una petición (pasarelas de acceso):
+    {"items": [{"user_id", "device_name", "otp", "ip_address"?}, ...]}
+
+    Cada elemento sigue las mismas reglas y deja los mismos logs que
+    /api/validate_totp. ip_address es la del usuario final según la pasarela
+    y solo se usa en logs y last_used: el límite por IP cuenta la IP de la
+    petición. Los límites se deciden primero; usuarios y dispositivos de los
+    elementos admitidos se leen con una consulta in (...) por tabla, y códigos
+    usados, intentos, logs y last_used se escriben por lotes. Retorna un
+    resultado por elemento, en el mismo orden.
+    """
+    try:
+        req = request.json or {}
+        items = req.get('items') if isinstance(req, dict) else req
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items debe ser una lista de {user_id, device_name, otp}'}), 400
+        if len(items) > BATCH_MAX:
+            return jsonify({'error': f'Máximo {BATCH_MAX} elementos por lote'}), 413
+
+        client_ip = get_client_ip()
+        results = [None] * len(items)
+        attempts = []
+
+        def reject(index, status, message, **extra):
+            results[index] = dict(extra, valid=False, status=status, message=message)
+
+        # Campos obligatorios
+        pending = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            user_id, device_name, otp = item.get('user_id'), item.get('device_name'), item.get('otp')
+            missing = [name for name, value in
+                       (('user_id', user_id), ('otp', otp), ('device_name', device_name)) if not value]
+            if missing:
+                reject(index, 400, f'Faltan: {", ".join(missing)}')
+                continue
+            ip_address = item.get('ip_address') or client_ip
+            pending.append((index, user_id, device_name, str(otp), ip_address,
+                            rate_limit_keys(user_id, device_name, client_ip)))
+
+        # Límite de intentos antes de cualquier consulta: una sola operación
+        # para todo el lote; los rechazados no leen ni gastan su código
+        if rate_limiter and pending:
+            admitted = []
+            for entry, retry_after in zip(pending, rate_limiter.check_many([e[5] for e in pending])):
+                if retry_after:
+                    reject(entry[0], 429, 'Demasiados intentos', retry_after=retry_after)
+                else:
+                    admitted.append(entry)
+            pending = admitted
+
+        # Usuarios y dispositivos: caché y luego una consulta in (...) por tabla
+        users = _fetch_many(users_cache, {e[1] for e in pending}, storage.get_users, 'user_id')
+        devices = _fetch_many(devices_cache, {e[2] for e in pending}, storage.get_devices, 'name')
+
+        # Reglas y códigos en una pasada: (estado, mensaje, log, resultado del intento)
+        decisions = []
+        verified = []
+        for position, (_, user_id, device_name, otp, _, _) in enumerate(pending):
+            user, device = users.get(user_id), devices.get(device_name)
+            rejection = _reject_user_device(user, device)
+            if rejection:
+                decisions.append(rejection + (None,))
+                continue
+            step = verifier.verify(user['totp_secret'], otp)
+            if step is None:
+                decisions.append((401, 'OTP inválido', ("OTP incorrecto", "otp_invalid"), False))
+            else:
+                decisions.append(None)
+                verified.append((position, step))
+
+        # Códigos usados, también dentro del lote: un código repetido cuenta
+        # como fallo, en orden
+        claims = []
+        if verified:
+            claims = replay_guard.claim_many([(pending[position][1], step) for position, step in verified])
+        for (position, _), claimed in zip(verified, claims):
+            decisions[position] = (
+                (200, 'Autenticación exitosa', ("Acceso exitoso", "login_success"), True) if claimed
+                else (401, 'OTP ya utilizado', ("OTP reutilizado", "otp_replay"), False)
+            )
+
+        if rate_limiter and pending:
+            lockouts = rate_limiter.record_many([e[5] for e in pending], [d[3] for d in decisions])
+        else:
+            lockouts = [False] * len(pending)
+
+        accepted = []
+        for entry, decision, locked in zip(pending, decisions, lockouts):
+            index, user_id, device_name, _, ip_address, _ = entry
+            status, message, logged, outcome = decision
+            if logged:
+                attempts.append((user_id, device_name, *logged, ip_address))
+            if locked:
+                attempts.append((user_id, device_name, "Bloqueo temporal por intentos fallidos",
+                                 "rate_locked", ip_address))
+            if not outcome:
+                reject(index, status, message)
+                continue
+            user = users[user_id]
+            results[index] = {
+                'valid': True,
+                'status': status,
+                'message': message,
+                'user': {
+                    'user_id': user_id,
+                    'full_name': user.get('full_name'),
+                    'email': user.get('email')
+                }
+            }
+            accepted.append(entry)
+
+        now = datetime.now().isoformat()
+        device_touch.touch_many([
+            {'name': device_name, 'last_used': now, 'ip_address': ip_address}
+            for _, _, device_name, _, ip_address, _ in accepted
+        ])
+        _log_attempts(attempts)
+
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            results[index] = dict(results[index], index=index, user_id=item.get('user_id'),
+                                  device_name=item.get('device_name'))
+        return jsonify({
+            'results': results,
+            'count': len(results),
+            'valid': len(accepted),
+            'invalid': len(results) - len(accepted)
+        }), 200
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.path})
+        return jsonify({'error': str(e)}), 500
+
+
+def _fetch_many(cache, keys, loader, key_column):
+    """Lee varias filas a través de la caché; las que falten, en una sola llamada a loader"""
+    found = {}
+    missing = []
+    for key in keys:
+        row = cache.get(key)
+        if row is None:
+            missing.append(key)
+        else:
+            found[key] = row
+    if missing:
+        for row in loader(missing):
+            key = row[key_column]
+            if key not in found:
+                found[key] = row
+                cache.set(key, row)
+    return found
+
+
+def _register_failure(user_id, device_name, limit_keys):
+    """Cuenta un fallo de OTP; al iniciar un bloqueo se deja constancia una sola vez"""
+    if rate_limiter and rate_limiter.failure(limit_keys):
+        _log_attempt(user_id, device_name, "Bloqueo temporal por intentos fallidos", "rate_locked")
+
+
+def _fetch_user(user_id):
+    """Lee un usuario a través de la caché (TTL + LRU)"""
+    return users_cache.get_or_load(user_id, lambda: storage.get_user(user_id))
+
+
+def _fetch_device(device_name):
+    """Lee un dispositivo a través de la caché (TTL + LRU)"""
+    return devices_cache.get_or_load(device_name, lambda: storage.get_device(device_name))
+
+
+def _fetch_user_device(user_id, device_name):
+    """
+    Obtiene usuario y dispositivo con el mínimo de viajes al almacenamiento:
+    1. Ambos en caché: ninguna llamada
+    2. Si no, validate_user_device del backend: una sola operación
+       (en Supabase, la RPC de sql/validate_user_device.sql)
+
+    Retorna: (user, device)
+    """
+    user = users_cache.get(user_id)
+    device = devices_cache.get(device_name)
+    if user is not None and device is not None:
+        return user, device
+
+    user, device = storage.validate_user_device(user_id, device_name)
+    if user:
+        users_cache.set(user_id, user)
+    if device:
+        devices_cache.set(device_name, device)
+    return user, device
+
+
 def get_client_ip():
     """Obtiene la IP real del cliente incluso detrás de Render/Cloudflare"""
     if request.headers.get('X-Forwarded-For'):
@@ -148,18 +482,32 @@ def get_client_ip():
         return request.headers.get('X-Forwarded-For').split(',')[0].strip()
     return request.remote_addr
 def _log_attempt(user_id, device_name, action, log_type):
-    """Registra intento de autenticación"""
-    try:
-        supabase.table("logs").insert({
+    """Registra intento de autenticación (encolado, se inserta por lotes)"""
+    _log_attempts([(user_id, device_name, action, log_type, get_client_ip())])
+
+
+def _log_attempts(attempts):
+    """Varios (user_id, device_name, action, log_type, ip_address) de una vez"""
+    timestamp = datetime.now().isoformat()
+    rows = []
+    for user_id, device_name, action, log_type, ip_address in attempts:
+        metrics.inc('otp_auth_outcomes_total', (('log_type', log_type),))
+        success = log_type == 'login_success'
+        log.log(logging.INFO if success else logging.WARNING, action, extra={
+            'event': log_type, 'user_id': user_id, 'device_name': device_name, 'sample': success
+        })
+        rows.append({
             'user_id': user_id,
             'device_name': device_name,
             'action': action,
             'log_type': log_type,
-            'timestamp': datetime.now().isoformat(),
-            'ip_address': get_client_ip()
-        }).execute()
+            'timestamp': timestamp,
+            'ip_address': ip_address
+        })
+    try:
+        log_writer.write_many(rows)
     except Exception as e:
-        print(f"⚠️  Error log: {e}")
+        log.error("No se pudo encolar el log", extra={'error': str(e)})
 
 
 # ============================================
@@ -167,19 +515,37 @@ def _log_attempt(user_id, device_name, action, log_type):
 # ============================================
 @app.route('/api/users', methods=['GET'])
 def get_users():
-    """Listar todos los usuarios"""
+    """
+    Listar usuarios: completo sin parámetros, por páginas (?limit=&cursor=)
+    o en streaming (?format=ndjson)
+    """
     try:
-        response = supabase.table("users")\
-            .select("user_id, full_name, email, cedula, status_user, created_at")\
-            .execute()
+        after = decode_cursor('users', request.args.get('cursor'))
+        
+        if request.args.get('format') == 'ndjson':
+            return _ndjson_response('users', after, USER_PUBLIC_COLUMNS)
+
+        if not _paginated():
+            return jsonify({
+                "users": storage.list_users(columns=USER_PUBLIC_COLUMNS),
+                "message": "Usuarios cargados",
+                "next_cursor": None
+            }), 200
+        
+        limit = page_size(request.args.get('limit', type=int))
+        rows = storage.list_page('users', after, limit + 1, USER_PUBLIC_COLUMNS)
+        users, next_cursor = split_page('users', rows, limit)
         
         return jsonify({
-            "users": response.data or [],
-            "message": "Usuarios cargados"
+            "users": users,
+            "message": "Usuarios cargados",
+            "next_cursor": next_cursor
         }), 200
     
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({"error": str(e)}), 500
 
 
@@ -210,32 +576,60 @@ def create_user():
             "status_user": True
         }
 
-        response = supabase.table('users').insert(user_data).execute()
+        user = storage.insert_user(user_data)
 
-        if not response.data:
+        if not user:
             return jsonify({'error': 'No se pudo crear usuario'}), 500
 
-        # Generar QR
-        otpauth_url = pyotp.totp.TOTP(totp_secret).provisioning_uri(
-            name=email,
-            issuer_name="OTP Auth System"
-        )
-
-        qr_dir = "static/qrs"
-        os.makedirs(qr_dir, exist_ok=True)
-
-        qr_path = f"{qr_dir}/{user_id}.png"
-        img = qrcode.make(otpauth_url)
-        img.save(qr_path)
+        # Generar QR (queda en caché para /api/users/<user_id>/qr)
+        otpauth_url = provisioning_uri(totp_secret, email)
+        qr_cache.get(otpauth_url)
 
         return jsonify({
-            'user': response.data[0],
+            'user': user,
             'qr_url': f"/api/users/{user_id}/qr",
             'otpauth_url': otpauth_url
         }), 201
 
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/users/bulk', methods=['POST'])
+def bulk_create_users():
+    """
+    Alta masiva desde CSV (con encabezado) o NDJSON.
+    ?format=csv|ndjson (por defecto según Content-Type)
+    ?output=zip devuelve los QR y los resultados en un zip; si no, un
+    resultado NDJSON por fila a medida que se insertan los lotes.
+    """
+    try:
+        fmt = request.args.get('format') or detect_format(request.content_type)
+        if fmt not in ('csv', 'ndjson'):
+            return jsonify({'error': 'format debe ser csv o ndjson'}), 400
+
+        rows = parse_rows(request.get_data(as_text=True), fmt)
+
+        def store_qr(user_id, uri, png):
+            qr_cache.store(uri, png)
+
+        if request.args.get('output') == 'zip':
+            archive = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+            write_zip(archive, rows, storage, on_qr=store_qr)
+            archive.seek(0)
+            return Response(archive, mimetype='application/zip', headers={
+                'Content-Disposition': 'attachment; filename=usuarios_qr.zip'
+            })
+
+        def generate():
+            for result in provision(rows, storage, on_qr=store_qr):
+                yield json.dumps(result) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -249,24 +643,22 @@ def update_user(user_id):
         if status_user is None:
             return jsonify({'error': 'Campo status_user requerido'}), 400
         
-        response = supabase.table('users')\
-            .update({'status_user': status_user})\
-            .eq('user_id', user_id)\
-            .execute()
+        user = storage.update_user(user_id, {'status_user': status_user})
+        users_cache.invalidate(user_id)
         
-        if not response.data:
+        if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
         action = 'activado' if status_user else 'bloqueado'
-        print(f"✅ Usuario {user_id} {action}")
+        log.info(f"Usuario {action}", extra={'user_id': user_id})
         
         return jsonify({
             'message': f'Usuario {action}',
-            'user': response.data[0]
+            'user': user
         }), 200
     
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -274,35 +666,29 @@ def update_user(user_id):
 def get_user_qr(user_id):
     """Obtener QR del usuario"""
     try:
-        response = supabase.table("users").select("*").eq("user_id", user_id).limit(1).execute()
-        users = response.data or []
+        user = _fetch_user(user_id)
         
-        if not users:
+        if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
-        user = users[0]
         totp_secret = user.get("totp_secret")
         email = user.get("email")
         
         if not totp_secret:
             return jsonify({'error': 'Sin TOTP'}), 400
         
-        otpauth_url = pyotp.totp.TOTP(totp_secret).provisioning_uri(
-            name=email,
-            issuer_name="OTP Auth System"
-        )
-        
-        qr_dir = "static/qrs"
-        os.makedirs(qr_dir, exist_ok=True)
-        
-        qr_path = f"{qr_dir}/{user_id}.png"
-        img = qrcode.make(otpauth_url)
-        img.save(qr_path)
-        
-        return send_from_directory(qr_dir, f"{user_id}.png", mimetype='image/png')
+        otpauth_url = provisioning_uri(totp_secret, email)
+        etag = qr_cache.etag(otpauth_url)
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+
+        # El cliente ya tiene este QR: no se genera ni se lee la imagen
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        return Response(qr_cache.get(otpauth_url), mimetype='image/png', headers=headers)
         
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -311,20 +697,61 @@ def get_user_qr(user_id):
 # ============================================
 @app.route('/api/devices', methods=['GET'])
 def get_devices():
-    """Listar todos los dispositivos"""
+    """
+    Listar dispositivos: completo sin parámetros, por páginas (?limit=&cursor=)
+    o en streaming (?format=ndjson).
+    ?updated_since=<fecha> devuelve solo los cambiados desde entonces y los borrados.
+    Responde 304 si el ETag enviado en If-None-Match sigue vigente.
+    """
     try:
-        response = supabase.table('devices')\
-            .select('*')\
-            .order('created_at', desc=True)\
-            .execute()
-        
-        return jsonify({
-            'devices': response.data or [],
-            'count': len(response.data or [])
-        }), 200
+        # La versión se lee antes que los datos: un cambio intermedio solo
+        # produce un ETag más viejo que los datos, nunca un 304 incorrecto
+        version = _device_version()
+        etag = None
+        if version is not None:
+            query = request.query_string.decode()
+            etag = f"d{version}-{hashlib.sha1(query.encode()).hexdigest()[:12]}"
+            if request.if_none_match.contains(etag):
+                return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+        since = request.args.get('updated_since')
+        if since:
+            devices, deleted = storage.list_devices_since(since)
+            marks = [d.get('updated_at') for d in devices] + [t['deleted_at'] for t in deleted]
+            response = jsonify({
+                'devices': devices,
+                'deleted': deleted,
+                'count': len(devices),
+                'next_since': max((m for m in marks if m), default=since)
+            })
+        else:
+            after = decode_cursor('devices', request.args.get('cursor'))
+
+            if request.args.get('format') == 'ndjson':
+                return _ndjson_response('devices', after)
+
+            if _paginated():
+                limit = page_size(request.args.get('limit', type=int))
+                rows = storage.list_page('devices', after, limit + 1)
+                devices, next_cursor = split_page('devices', rows, limit)
+            else:
+                devices, next_cursor = storage.list_devices(), None
+
+            response = jsonify({
+                'devices': devices,
+                'count': len(devices),
+                'next_cursor': next_cursor
+            })
+
+        if etag:
+            response.headers['ETag'] = f'"{etag}"'
+            response.headers['Cache-Control'] = 'no-cache'
+        return response, 200
     
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -332,24 +759,22 @@ def get_devices():
 def check_device_status(device_name):
     """Verificar estado de un dispositivo"""
     try:
-        response = supabase.table("devices")\
-            .select("name, enabled, last_used")\
-            .eq("name", device_name)\
-            .limit(1)\
-            .execute()
+        device = storage.get_device(device_name)
         
-        if not response.data:
+        if not device:
             return jsonify({
                 'authorized': False,
                 'message': 'Dispositivo no registrado',
                 'device_name': device_name
             }), 404
         
-        device = response.data[0]
-        
         return jsonify({
             'authorized': device.get('enabled', False),
-            'device': device
+            'device': {
+                'name': device.get('name'),
+                'enabled': device.get('enabled'),
+                'last_used': device.get('last_used')
+            }
         }), 200
     
     except Exception as e:
@@ -367,32 +792,35 @@ def register_device():
             return jsonify({'error': 'Falta device_name'}), 400
         
         # Verificar si existe
-        existing = supabase.table("devices").select("*").eq("name", device_name).execute()
+        existing = storage.get_device(device_name)
         
-        if existing.data:
+        if existing:
             return jsonify({
                 'message': 'Dispositivo ya existe',
-                'device': existing.data[0]
+                'device': existing
             }), 200
         
         # Crear
-        new_device = supabase.table("devices").insert({
+        new_device = storage.insert_device({
             "name": device_name,
             "otp": "000000",
             "enabled": True,
             "created_at": datetime.now().isoformat(),
             "ip_address": request.remote_addr
-        }).execute()
+        })
+        devices_cache.invalidate(device_name)
+        _devices_changed()
+        change_feed.publish('device', [new_device])
         
-        print(f"✅ Dispositivo registrado: {device_name}")
+        log.info("Dispositivo registrado", extra={'device_name': device_name})
         
         return jsonify({
             'message': 'Dispositivo registrado',
-            'device': new_device.data[0] if new_device.data else None
+            'device': new_device
         }), 201
     
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -406,24 +834,43 @@ def update_device(device_name):
         if enabled is None:
             return jsonify({'error': 'Campo enabled requerido'}), 400
         
-        response = supabase.table('devices')\
-            .update({'enabled': enabled})\
-            .eq('name', device_name)\
-            .execute()
+        device = storage.update_device(device_name, {'enabled': enabled})
+        devices_cache.invalidate(device_name)
         
-        if not response.data:
+        if not device:
             return jsonify({'error': 'Dispositivo no encontrado'}), 404
+        _devices_changed()
+        change_feed.publish('device', [device])
         
         action = 'habilitado' if enabled else 'deshabilitado'
-        print(f"✅ Dispositivo {device_name} {action}")
+        log.info(f"Dispositivo {action}", extra={'device_name': device_name})
         
         return jsonify({
             'message': f'Dispositivo {action}',
-            'device': response.data[0]
+            'device': device
         }), 200
     
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/devices/<device_name>', methods=['DELETE'])
+def delete_device(device_name):
+    """Eliminar dispositivo (queda una lápida para ?updated_since=)"""
+    try:
+        if not storage.delete_device(device_name):
+            return jsonify({'error': 'Dispositivo no encontrado'}), 404
+        devices_cache.invalidate(device_name)
+        _devices_changed()
+        change_feed.publish('device', [{'name': device_name, 'deleted': True}])
+
+        log.info("Dispositivo eliminado", extra={'device_name': device_name})
+
+        return jsonify({'message': 'Dispositivo eliminado'}), 200
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
 
 
@@ -432,24 +879,136 @@ def update_device(device_name):
 # ============================================
 @app.route('/api/logs', methods=['GET'])
 def get_logs():
-    """Obtener logs de actividad"""
+    """Obtener logs de actividad por páginas (?limit=&cursor=) o en streaming (?format=ndjson)"""
     try:
-        limit = request.args.get('limit', 100, type=int)
+        after = decode_cursor('logs', request.args.get('cursor'))
+        
+        if request.args.get('format') == 'ndjson':
+            return _ndjson_response('logs', after, max_rows=request.args.get('limit', type=int))
         
-        response = supabase.table('logs')\
-            .select('*')\
-            .order('timestamp', desc=True)\
-            .limit(limit)\
-            .execute()
+        limit = page_size(request.args.get('limit', type=int), default=100)
+        rows = storage.list_page('logs', after, limit + 1)
+        logs, next_cursor = split_page('logs', rows, limit)
         
         return jsonify({
-            'logs': response.data or [],
-            'count': len(response.data or [])
+            'logs': logs,
+            'count': len(logs),
+            'next_cursor': next_cursor
         }), 200
     
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.path})
+        return jsonify({'error': str(e)}), 500
+
+
+# Rango por defecto y duración de cada intervalo de /api/logs/stats
+LOG_STATS_SPAN = {'minute': timedelta(hours=1), 'hour': timedelta(days=2), 'day': timedelta(days=90)}
+LOG_STATS_STEP = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+LOG_STATS_MAX_BUCKETS = 5000
+
+
+def _parse_time(value):
+    """Fecha ISO a la hora local sin zona, como los timestamps de los logs"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+@app.route('/api/logs/stats', methods=['GET'])
+def get_log_stats():
+    """
+    Conteos de logs por intervalo (?bucket=minute|hour|day) agrupados por
+    ?by=log_type,device_name,user_id entre ?since= y ?until= (ISO; until
+    excluido), con filtros opcionales ?log_type=&device_name=&user_id=.
+    Se lee de las tablas de resumen (log_rollups.py), no de los logs crudos.
+    """
+    try:
+        granularity = request.args.get('bucket', 'hour')
+        if granularity not in GRANULARITIES:
+            return jsonify({'error': f'bucket debe ser uno de: {", ".join(GRANULARITIES)}'}), 400
+
+        by = [dim.strip() for dim in request.args.get('by', 'log_type').split(',') if dim.strip()]
+        unknown = [dim for dim in by if dim not in DIMENSIONS]
+        if unknown:
+            return jsonify({'error': f'by admite: {", ".join(DIMENSIONS)}'}), 400
+
+        try:
+            until = _parse_time(request.args.get('until')) or datetime.now()
+            since = _parse_time(request.args.get('since')) or until - LOG_STATS_SPAN[granularity]
+        except ValueError:
+            return jsonify({'error': 'since y until deben ser fechas ISO 8601'}), 400
+
+        # Alinear a los intervalos: since hacia atrás, until hacia adelante
+        step = LOG_STATS_STEP[granularity]
+        start = datetime.fromisoformat(bucket_of(since, granularity))
+        end = datetime.fromisoformat(bucket_of(until, granularity))
+        if end < until:
+            end += step
+        if end <= start:
+            return jsonify({'error': 'until debe ser posterior a since'}), 400
+        if (end - start) / step > LOG_STATS_MAX_BUCKETS:
+            return jsonify({'error': f'Rango demasiado amplio para bucket={granularity} '
+                                     f'(máximo {LOG_STATS_MAX_BUCKETS} intervalos)'}), 400
+
+        filters = {dim: request.args[dim] for dim in DIMENSIONS if request.args.get(dim)}
+        rows = storage.log_rollup(granularity, start.isoformat(), end.isoformat(), by, filters)
+
+        series = []
+        totals = Counter()
+        for row in rows:
+            group = tuple(row.get(dim) for dim in by)
+            totals[group] += row['count']
+            series.append(dict(zip(by, group), bucket=row['bucket'], count=row['count']))
+
+        return jsonify({
+            'bucket': granularity,
+            'since': start.isoformat(),
+            'until': end.isoformat(),
+            'by': by,
+            'filters': filters,
+            'series': series,
+            'totals': [dict(zip(by, group), count=count) for group, count in totals.most_common()],
+            'total': sum(totals.values())
+        }), 200
+
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error no controlado", extra={'path': request.path})
         return jsonify({'error': str(e)}), 500
+
+
+def _paginated():
+    """Con limit o cursor se pagina; sin ellos se mantiene el listado completo"""
+    return 'limit' in request.args or 'cursor' in request.args
+
+
+def _ndjson_response(table, after=None, columns=None, max_rows=None):
+    """
+    Exporta un listado completo como NDJSON: se recorre página a página y
+    cada fila se escribe en cuanto llega, sin armar la respuesta en memoria
+    """
+    sort_col, tie_col = PAGE_KEYS[table]
+
+    def generate():
+        position = after
+        sent = 0
+        while max_rows is None or sent < max_rows:
+            batch = MAX_PAGE_SIZE if max_rows is None else min(MAX_PAGE_SIZE, max_rows - sent)
+            rows = storage.list_page(table, position, batch, columns)
+            for row in rows:
+                yield json.dumps(row, default=str) + '\n'
+            sent += len(rows)
+            if len(rows) < batch:
+                break
+            position = (rows[-1].get(sort_col), rows[-1].get(tie_col))
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/api/log_activity', methods=['POST'])
 def log_activity():
     try:
@@ -459,58 +1018,164 @@ def log_activity():
         action = data.get("action", "Actividad detectada")
         ip = data.get("ip_address") or request.remote_addr
 
-        # Insertamos directamente en la tabla de logs de Supabase
-        supabase.table("logs").insert({
+        # Encolamos el log; el escritor lo inserta por lotes en Supabase
+        log_writer.write({
             'user_id': user_id,
             'device_name': device_name,
             'action': action,
             'log_type': 'session_resume',
             'timestamp': datetime.now().isoformat(),
             'ip_address': ip
-        }).execute()
+        })
 
-        # También actualizamos la "última vez usado" del dispositivo
-        supabase.table("devices").update({
-            "last_used": datetime.now().isoformat(),
-            "ip_address": ip
-        }).eq("name", device_name).execute()
+        # También actualizamos la "última vez usado" del dispositivo (agrupado)
+        if device_name:
+            device_touch.touch(device_name, datetime.now().isoformat(), ip)
 
         return jsonify({'status': 'logged'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# ============================================
+# CAMBIOS EN VIVO
+# ============================================
+CHANGES_MAX_WAIT = 30
+SSE_HEARTBEAT = 15
+# Cada espera (long-poll o SSE) ocupa un hilo del worker: se acotan para que
+# /api/validate_totp siempre tenga hilos libres. Un stream SSE se cierra tras
+# SSE_MAX_LIFETIME segundos; el navegador reconecta con Last-Event-ID.
+CHANGES_MAX_WAITERS = int(os.environ.get('OTP_CHANGES_MAX_WAITERS', 4))
+SSE_MAX_LIFETIME = float(os.environ.get('OTP_SSE_MAX_LIFETIME', 300))
+SSE_RETRY = 5
+_change_waiters = threading.BoundedSemaphore(CHANGES_MAX_WAITERS)
+
+
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    """
+    Cambios de dispositivos y logs desde ?cursor= (o Last-Event-ID).
+    Por defecto long-poll: espera hasta ?timeout= segundos y devuelve lo nuevo
+    (sin espera si ya hay CHANGES_MAX_WAITERS esperando). Con Accept:
+    text/event-stream (o ?stream=sse) responde por SSE, o 503 si no hay lugar.
+    ?types=device,log filtra por tipo. Sin cursor empieza desde ahora.
+    """
+    cursor = request.args.get('cursor') or request.headers.get('Last-Event-ID')
+    types = request.args.get('types')
+    kinds = set(types.split(',')) if types else None
+
+    if request.args.get('stream') == 'sse' or \
+            request.accept_mimetypes.best == 'text/event-stream':
+        if not _change_waiters.acquire(blocking=False):
+            response = jsonify({'error': 'Demasiadas conexiones en vivo; usar long-poll'})
+            response.headers['Retry-After'] = str(SSE_RETRY)
+            return response, 503
+        response = _sse_response(cursor, kinds)
+        # Se libera al cerrar la respuesta, aunque el generador no llegue a correr
+        response.call_on_close(_change_waiters.release)
+        return response
+
+    timeout = min(request.args.get('timeout', default=25, type=float), CHANGES_MAX_WAIT)
+    events, next_cursor, reset = change_feed.read(cursor, kinds)
+    if not events and not reset and cursor and _change_waiters.acquire(blocking=False):
+        try:
+            change_feed.wait(next_cursor, timeout)
+        finally:
+            _change_waiters.release()
+        events, next_cursor, reset = change_feed.read(next_cursor, kinds)
+
+    return jsonify({'events': events, 'cursor': next_cursor, 'reset': reset}), 200
+
+
+def _sse_response(cursor, kinds):
+    def generate():
+        deadline = time.monotonic() + SSE_MAX_LIFETIME
+        position = cursor
+        events, position, reset = change_feed.read(position, kinds)
+        # Primer mensaje: cursor inicial (y aviso de recarga si no sirve el del cliente)
+        yield f"retry: {SSE_RETRY * 1000}\n"
+        if reset or not cursor:
+            yield f"id: {position}\nevent: {'reset' if reset else 'ready'}\ndata: {{}}\n\n"
+        else:
+            yield "event: ready\ndata: {}\n\n"
+        while True:
+            for event in events:
+                yield (f"id: {change_feed.cursor(event['seq'])}\nevent: {event['type']}\n"
+                       f"data: {json.dumps(event['data'], default=str)}\n\n")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # Fin de vida: el último id enviado es el Last-Event-ID de la reconexión
+                return
+            change_feed.wait(position, min(SSE_HEARTBEAT, remaining))
+            events, position, reset = change_feed.read(position, kinds)
+            if reset:
+                yield f"id: {position}\nevent: reset\ndata: {{}}\n\n"
+            elif not events:
+                yield ": ping\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+# ============================================
+# CACHÉ
+# ============================================
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Contadores de aciertos/fallos de la caché de lecturas"""
+    return jsonify({
+        'users': users_cache.stats(),
+        'devices': devices_cache.stats(),
+        'replay': replay_guard.stats(),
+        'rate_limit': rate_limiter.stats() if rate_limiter else None,
+        'qr': qr_cache.stats(),
+        'changes': change_feed.stats(),
+        'shared': shared_state.stats() if shared_state else None
+    }), 200
+
+
+@app.route('/api/devices/touch/stats', methods=['GET'])
+def device_touch_stats():
+    """Usos de dispositivos pendientes de escribir y escrituras agrupadas"""
+    return jsonify(device_touch.stats()), 200
+
+
+@app.route('/api/logs/writer/stats', methods=['GET'])
+def log_writer_stats():
+    """Estado de la cola de logs: pendientes, escritos y descartados"""
+    return jsonify(log_writer.stats()), 200
+
+
 # ============================================
 # MANTENIMIENTO
 # ============================================
-def refresh_totp_secrets():
-    """Refrescar secretos TOTP antiguos"""
-    try:
-        limite = datetime.now() - timedelta(days=30)
-        response = supabase.table("users").select("*").neq("status_user", False).execute()
-        users = response.data or []
-
-        for user in users:
-            date_totp = user.get("date_totp")
-            if date_totp:
-                date_totp_dt = datetime.fromisoformat(date_totp)
-            else:
-                date_totp_dt = datetime.min
+def _forget_rotated(users):
+    """Descarta de las cachés los secretos que se acaban de rotar"""
+    for user in users:
+        users_cache.invalidate(user["user_id"])
+        if user.get("totp_secret"):
+            verifier.forget(user["totp_secret"])
+            qr_cache.forget(provisioning_uri(user["totp_secret"], user.get("email")))
 
-            if date_totp_dt <= limite:
-                new_secret = pyotp.random_base32()
-                now_str = datetime.now().isoformat()
 
-                supabase.table("users").update({
-                    "totp_secret": new_secret,
-                    "date_totp": now_str
-                }).eq("user_id", user["user_id"]).execute()
+rotation_job = create_rotation_job(storage, on_rotated=_forget_rotated)
 
-                print(f"🔄 TOTP actualizado: {user['user_id']}")
+# Rotación periódica con APScheduler (OTP_ROTATION_SCHEDULE=1)
+if os.environ.get('OTP_ROTATION_SCHEDULE', '0') == '1':
+    start_scheduler(rotation_job)
 
-        print("✅ Actualización completada")
-    except Exception as e:
-        print(f"❌ Error: {e}")
+
+def refresh_totp_secrets():
+    """Refrescar secretos TOTP antiguos (por bloques, reanudable)"""
+    return rotation_job.run()
+
+
+@app.route('/api/maintenance/rotation', methods=['GET'])
+def rotation_status():
+    """Progreso y tiempos de la última rotación de secretos"""
+    return jsonify(rotation_job.progress), 200
 
 
 # ============================================
@@ -0,0 +1,141 @@
+"""
+Logs estructurados en JSON, con nivel configurable y escritura en segundo plano
+
+Los manejadores de peticiones solo encolan el registro (QueueHandler); un
+hilo (QueueListener) le da formato JSON y lo escribe en stdout. Los eventos
+marcados con sample=True (accesos exitosos) se muestrean con
+OTP_LOG_SUCCESS_SAMPLE, y los campos con OTP o secretos se ocultan siempre.
+
+    OTP_LOG_LEVEL           DEBUG | INFO | WARNING | ERROR (por defecto INFO)
+    OTP_LOG_SUCCESS_SAMPLE  fracción de eventos muestreables que se escriben (1.0)
+    OTP_LOG_QUEUE_SIZE_APP  capacidad de la cola; si se llena se descarta (10000)
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import traceback
+from datetime import datetime, timezone
+
+REDACTED = '***'
+REDACT_KEYS = frozenset({'otp', 'totp_secret', 'secret', 'password', 'otpauth_url', 'key'})
+# secret=... dentro de URIs otpauth que acaben en un mensaje
+_SECRET_IN_TEXT = re.compile(r'(secret=)[A-Za-z2-7=]+', re.IGNORECASE)
+
+# Atributos propios de LogRecord: todo lo demás son campos extra
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'sample'}
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if k.lower() in REDACT_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return _SECRET_IN_TEXT.sub(r'\1' + REDACTED, value)
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = ''.join(traceback.format_exception(*record.exc_info))
+        return json.dumps(redact(entry), default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """Deja pasar una fracción de los registros con sample=True; el resto siempre"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sample', False) and self.rate < 1.0:
+            return random.random() < self.rate
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """No formatea en el hilo de la petición y descarta si la cola está llena"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # El formato JSON (y el traceback) se resuelven en el hilo del listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging():
+    """Configura el logger raíz 'otp' una sola vez por proceso"""
+    global _listener, _handler
+    root = logging.getLogger('otp')
+    if _listener is not None:
+        return root
+
+    log_queue = queue.Queue(maxsize=int(os.environ.get('OTP_LOG_QUEUE_SIZE_APP', 10000)))
+    handler = _handler = _DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(float(os.environ.get('OTP_LOG_SUCCESS_SAMPLE', 1.0))))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root.setLevel(os.environ.get('OTP_LOG_LEVEL', 'INFO').upper())
+    root.addHandler(handler)
+    root.propagate = False
+    return root
+
+
+def reopen_after_fork():
+    """
+    Para gunicorn post_fork: los hilos no se heredan, cada worker arranca su
+    listener. La cola también es nueva: la heredada conserva en su Condition
+    la espera del hilo del maestro y no despertaría al nuevo.
+    """
+    global _listener
+    if _listener is None:
+        return
+    atexit.unregister(_listener.stop)
+    log_queue = queue.Queue(maxsize=_handler.queue.maxsize)
+    _handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers,
+                                               respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(f'otp.{name}')
@@ -1,61 +1,331 @@
+import os
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from app_logging import get_logger
+from log_rollups import BUCKET_TRUNCATE, DIMENSIONS, retention_cutoffs
+
+log = get_logger('sqlite')
+
+# OTP_SQLITE_FILE se aplica ya al importar: no queda un otp_data.db suelto en el CWD
+DB_FILE = os.environ.get('OTP_SQLITE_FILE') or 'otp_data.db'
+
+# --- Pool de conexiones ---
+# Cada conexión se abre una vez con WAL y pragmas ajustados y se reutiliza;
+# sqlite3 mantiene por conexión la caché de sentencias preparadas
+# (cached_statements), así que las consultas fijas de este módulo se
+# compilan una sola vez por conexión.
+POOL_SIZE = int(os.environ.get('OTP_SQLITE_POOL_SIZE', 8))
+BUSY_TIMEOUT = float(os.environ.get('OTP_SQLITE_BUSY_TIMEOUT', 5.0))
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    f"PRAGMA cache_size = {int(os.environ.get('OTP_SQLITE_CACHE_KB', 20000)) * -1}",
+    f"PRAGMA mmap_size = {int(os.environ.get('OTP_SQLITE_MMAP_BYTES', 268435456))}",
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA foreign_keys = ON',
+)
+
+
+class ConnectionPool:
+    """Pool de conexiones SQLite seguro entre hilos.
+
+    En modo WAL los lectores no esperan a los escritores, así que varias
+    conexiones pueden leer mientras otra escribe.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.db_file = db_file
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT,
+                               check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=BUSY_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Pool de conexiones SQLite agotado')
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Conexión inservible: se descarta y el pool abrirá otra
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_file != DB_FILE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DB_FILE)
+        return _pool
+
+
+def _connection():
+    return _get_pool().connection()
+
+
+def reset_after_fork():
+    """Para gunicorn post_fork: las conexiones abiertas en el maestro no se usan en el worker"""
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+_last_device_id = 0
+_device_id_lock = threading.Lock()
+
+
+def _new_device_id():
+    """Id en milisegundos como antes, sin colisiones entre altas seguidas"""
+    global _last_device_id
+    with _device_id_lock:
+        _last_device_id = max(_last_device_id + 1, int(datetime.now().timestamp() * 1000))
+        return str(_last_device_id)
+
+
+def configure(db_file):
+    """Cambia el archivo de base de datos y crea las tablas si no existen"""
+    global DB_FILE
+    DB_FILE = db_file
+    init_db()
+
+
+# Mismo formato que datetime.isoformat() (hora local)
+_SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+
+# Cualquier alta, cambio o borrado de un dispositivo sube la versión y
+# marca updated_at; los borrados dejan una lápida con la fecha
+_SQL_DEVICE_SYNC_TRIGGERS = f'''
+    CREATE TRIGGER IF NOT EXISTS devices_sync_insert AFTER INSERT ON devices
+    BEGIN
+        UPDATE devices SET updated_at = {_SQL_NOW} WHERE rowid = NEW.rowid;
+        DELETE FROM device_tombstones WHERE name = NEW.name;
+        UPDATE sync_versions SET version = version + 1 WHERE name = 'devices';
+    END;
+    CREATE TRIGGER IF NOT EXISTS devices_sync_update AFTER UPDATE ON devices
+    WHEN NEW.updated_at IS OLD.updated_at
+    BEGIN
+        UPDATE devices SET updated_at = {_SQL_NOW} WHERE rowid = NEW.rowid;
+        UPDATE sync_versions SET version = version + 1 WHERE name = 'devices';
+    END;
+    CREATE TRIGGER IF NOT EXISTS devices_sync_delete AFTER DELETE ON devices
+    BEGIN
+        INSERT OR REPLACE INTO device_tombstones (name, deleted_at) VALUES (OLD.name, {_SQL_NOW});
+        UPDATE sync_versions SET version = version + 1 WHERE name = 'devices';
+    END;
+'''
+
+
+# Conteos por intervalo de cada log insertado (log_rollups.py)
+def _sql_bucket(column, granularity):
+    length, suffix = BUCKET_TRUNCATE[granularity]
+    return f"substr(replace({column}, ' ', 'T'), 1, {length}) || '{suffix}'"
+
+
+_SQL_LOG_ROLLUP_TRIGGER = f'''
+    CREATE TRIGGER IF NOT EXISTS logs_rollup AFTER INSERT ON logs
+    BEGIN
+        INSERT INTO log_rollups (granularity, bucket, log_type, device_name, user_id, count)
+        VALUES {', '.join(
+            f"('{g}', {_sql_bucket('NEW.timestamp', g)}, COALESCE(NEW.type, ''), "
+            f"COALESCE(NEW.device_name, ''), COALESCE(NEW.user_id, ''), 1)"
+            for g in BUCKET_TRUNCATE
+        )}
+        ON CONFLICT (granularity, bucket, log_type, device_name, user_id)
+        DO UPDATE SET count = count + 1;
+    END;
+'''
+
+_SQL_LOG_ROLLUP_BACKFILL = [
+    f'''
+    INSERT INTO log_rollups (granularity, bucket, log_type, device_name, user_id, count)
+    SELECT '{g}', {_sql_bucket('timestamp', g)}, COALESCE(type, ''),
+           COALESCE(device_name, ''), COALESCE(user_id, ''), COUNT(*)
+    FROM logs GROUP BY 2, 3, 4, 5
+    '''
+    for g in BUCKET_TRUNCATE
+]
 
-DB_FILE = 'otp_data.db'
 
 # --- Inicialización de la base de datos ---
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-
-    # Tabla de dispositivos
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS devices (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            otp TEXT NOT NULL,
-            enabled INTEGER NOT NULL,
-            created_at TEXT NOT NULL,
-            last_used TEXT
-        )
-    ''')
-
-    # Tabla de logs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            device_name TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            action TEXT NOT NULL,
-            type TEXT NOT NULL
-        )
-    ''')
+    with _connection() as conn:
+        cursor = conn.cursor()
+
+        # Tabla de dispositivos
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                otp TEXT NOT NULL,
+                enabled INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                last_used TEXT
+            )
+        ''')
+
+        # Columna ip_address en bases creadas antes de que existiera
+        cursor.execute('PRAGMA table_info(devices)')
+        if 'ip_address' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE devices ADD COLUMN ip_address TEXT')
 
-    conn.commit()
-    conn.close()
+        # Tabla de usuarios
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                full_name TEXT,
+                email TEXT,
+                cedula TEXT,
+                totp_secret TEXT,
+                status_user INTEGER NOT NULL DEFAULT 1,
+                created_at TEXT,
+                date_totp TEXT
+            )
+        ''')
+        # Sincronización delta: updated_at, contador de versión y lápidas de borrados
+        cursor.execute('PRAGMA table_info(devices)')
+        if 'updated_at' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE devices ADD COLUMN updated_at TEXT')
+            cursor.execute('UPDATE devices SET updated_at = COALESCE(last_used, created_at)')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO sync_versions (name, version) VALUES ('devices', 0)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_tombstones (
+                name TEXT PRIMARY KEY,
+                deleted_at TEXT NOT NULL
+            )
+        ''')
+        cursor.executescript(_SQL_DEVICE_SYNC_TRIGGERS)
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_updated ON devices (updated_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_name ON devices (name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_created ON devices (created_at, name)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at, user_id)')
+
+        # Tabla de logs
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_name TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                action TEXT NOT NULL,
+                type TEXT NOT NULL
+            )
+        ''')
+
+        # Columnas de logs que usa la API (user_id, ip_address)
+        cursor.execute('PRAGMA table_info(logs)')
+        log_columns = [col[1] for col in cursor.fetchall()]
+        if 'user_id' not in log_columns:
+            cursor.execute('ALTER TABLE logs ADD COLUMN user_id TEXT')
+        if 'ip_address' not in log_columns:
+            cursor.execute('ALTER TABLE logs ADD COLUMN ip_address TEXT')
+        cursor.execute('DROP INDEX IF EXISTS idx_logs_timestamp')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_logs_timestamp_id ON logs (timestamp, id)')
+
+        # Conteos por intervalo; al crear la tabla se cargan los logs existentes
+        new_rollups = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log_rollups'"
+        ).fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS log_rollups (
+                granularity TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                log_type TEXT NOT NULL,
+                device_name TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (granularity, bucket, log_type, device_name, user_id)
+            ) WITHOUT ROWID
+        ''')
+        if new_rollups:
+            for statement in _SQL_LOG_ROLLUP_BACKFILL:
+                cursor.execute(statement)
+        cursor.executescript(_SQL_LOG_ROLLUP_TRIGGER)
+
+        conn.commit()
 
 init_db()
 
 # --- Funciones de dispositivos ---
 def add_device_db(name, otp, enabled=True):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    device_id = str(int(datetime.now().timestamp() * 1000))
+    device_id = _new_device_id()
     created_at = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT INTO devices (id, name, otp, enabled, created_at, last_used)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (device_id, name, otp, int(enabled), created_at, None))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        conn.execute('''
+            INSERT INTO devices (id, name, otp, enabled, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (device_id, name, otp, int(enabled), created_at, None))
+        conn.commit()
     return device_id
 
 def get_devices_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, otp, enabled, created_at, last_used FROM devices')
-    rows = cursor.fetchall()
-    conn.close()
+    with _connection() as conn:
+        rows = conn.execute('SELECT id, name, otp, enabled, created_at, last_used FROM devices').fetchall()
     devices = []
     for row in rows:
         devices.append({
@@ -69,8 +339,6 @@ def get_devices_db():
     return devices
 
 def update_device_db(device_id, updates):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     fields = []
     values = []
     for k, v in updates.items():
@@ -79,48 +347,99 @@ def update_device_db(device_id, updates):
         fields.append(f"{k} = ?")
         values.append(v)
     values.append(device_id)
-    cursor.execute(f'''
-        UPDATE devices
-        SET {', '.join(fields)}
-        WHERE id = ?
-    ''', values)
-    conn.commit()
-    success = cursor.rowcount > 0
-    conn.close()
-    return success
+    with _connection() as conn:
+        cursor = conn.execute(f'''
+            UPDATE devices
+            SET {', '.join(fields)}
+            WHERE id = ?
+        ''', values)
+        conn.commit()
+        return cursor.rowcount > 0
 
 def delete_device_db(device_id):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM devices WHERE id = ?', (device_id,))
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        conn.execute('DELETE FROM devices WHERE id = ?', (device_id,))
+        conn.commit()
 
 # --- Funciones de logs ---
+# Retención de logs:
+#   OTP_LOG_RETENTION         últimos N logs (0 = sin límite por cantidad)
+#   OTP_LOG_MAX_AGE_DAYS      antigüedad máxima (0 = sin límite por edad)
+#   OTP_LOG_COMPACT_INTERVAL  segundos entre compactaciones en segundo plano
+LOG_RETENTION = int(os.environ.get('OTP_LOG_RETENTION', 50))
+LOG_MAX_AGE_DAYS = float(os.environ.get('OTP_LOG_MAX_AGE_DAYS', 0))
+LOG_COMPACT_INTERVAL = float(os.environ.get('OTP_LOG_COMPACT_INTERVAL', 300))
+
+_SQL_MAX_LOG_ID = 'SELECT MAX(id) FROM logs'
+_SQL_TRIM_LOGS = 'DELETE FROM logs WHERE id <= ?'
+_SQL_EXPIRE_LOGS = 'DELETE FROM logs WHERE timestamp < ?'
+
+_compactor = None
+_compactor_lock = threading.Lock()
+
+
+def _trim_logs(conn):
+    """
+    Retención por cantidad con marca de agua sobre el id: todo id <= MAX(id) - N
+    sobra. MAX(id) se lee del índice de la clave primaria y el DELETE recorre
+    solo las filas que se borran, así que el coste por inserción es constante
+    sin importar cuántos logs se retengan.
+    """
+    if LOG_RETENTION <= 0:
+        return
+    max_id = conn.execute(_SQL_MAX_LOG_ID).fetchone()[0]
+    if max_id is not None and max_id > LOG_RETENTION:
+        conn.execute(_SQL_TRIM_LOGS, (max_id - LOG_RETENTION,))
+
+
+def compact_logs():
+    """Retención por edad y checkpoint del WAL, fuera del camino de escritura"""
+    with _connection() as conn:
+        if LOG_MAX_AGE_DAYS > 0:
+            limit = datetime.now() - timedelta(days=LOG_MAX_AGE_DAYS)
+            conn.execute(_SQL_EXPIRE_LOGS, (limit.isoformat(),))
+        _trim_logs(conn)
+        for granularity, cutoff in retention_cutoffs().items():
+            conn.execute('DELETE FROM log_rollups WHERE granularity = ? AND bucket < ?',
+                         (granularity, cutoff))
+        conn.commit()
+        conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+def _run_log_compactor():
+    while True:
+        time.sleep(LOG_COMPACT_INTERVAL)
+        try:
+            compact_logs()
+        except Exception as e:
+            log.error("Error compactando logs", extra={'error': str(e)})
+
+
+def _ensure_log_compactor():
+    global _compactor
+    if _compactor is not None or LOG_COMPACT_INTERVAL <= 0:
+        return
+    with _compactor_lock:
+        if _compactor is None:
+            _compactor = threading.Thread(target=_run_log_compactor,
+                                          name='log-compactor', daemon=True)
+            _compactor.start()
+
+
 def add_log_db(device_name, action, type_):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     timestamp = datetime.now().isoformat()
-    cursor.execute('''
-        INSERT INTO logs (device_name, timestamp, action, type)
-        VALUES (?, ?, ?, ?)
-    ''', (device_name, timestamp, action, type_))
-    # Mantener solo últimos 50 logs
-    cursor.execute('''
-        DELETE FROM logs
-        WHERE id NOT IN (
-            SELECT id FROM logs ORDER BY id DESC LIMIT 50
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with _connection() as conn:
+        conn.execute('''
+            INSERT INTO logs (device_name, timestamp, action, type)
+            VALUES (?, ?, ?, ?)
+        ''', (device_name, timestamp, action, type_))
+        _trim_logs(conn)
+        conn.commit()
+    _ensure_log_compactor()
 
 def get_logs_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT device_name, timestamp, action, type FROM logs ORDER BY id DESC')
-    rows = cursor.fetchall()
-    conn.close()
+    with _connection() as conn:
+        rows = conn.execute('SELECT device_name, timestamp, action, type FROM logs ORDER BY id DESC').fetchall()
     logs = []
     for row in rows:
         logs.append({
@@ -130,3 +449,345 @@ def get_logs_db():
             'type': row[3]
         })
     return logs
+
+# --- Validación combinada usuario + dispositivo ---
+_SQL_USER_DEVICE = '''
+    SELECT u.user_id, u.full_name, u.email, u.cedula, u.totp_secret,
+           u.status_user, u.created_at, u.date_totp,
+           d.id, d.name, d.otp, d.enabled, d.created_at, d.last_used, d.ip_address,
+           d.updated_at
+    FROM (SELECT 1)
+    LEFT JOIN users u ON u.user_id = ?
+    LEFT JOIN devices d ON d.name = ?
+    LIMIT 1
+'''
+
+
+def validate_user_device_db(user_id, device_name):
+    """
+    Equivalente SQLite de la RPC validate_user_device: usuario y dispositivo
+    en una sola consulta, sin escribir.
+
+    Retorna: (user: dict|None, device: dict|None)
+    """
+    with _connection() as conn:
+        row = conn.execute(_SQL_USER_DEVICE, (user_id, device_name)).fetchone()
+
+    user = _row_to_user(row[0:8]) if row[0] is not None else None
+    device = _row_to_device(row[8:16]) if row[8] is not None else None
+    return user, device
+
+
+# --- Filas con el formato de la API (usuarios, dispositivos y logs) ---
+USER_COLUMNS = ('user_id', 'full_name', 'email', 'cedula', 'totp_secret',
+                'status_user', 'created_at', 'date_totp')
+DEVICE_COLUMNS = ('id', 'name', 'otp', 'enabled', 'created_at', 'last_used', 'ip_address',
+                  'updated_at')
+LOG_COLUMNS = ('id', 'user_id', 'device_name', 'action', 'type', 'timestamp', 'ip_address')
+
+_SQL_GET_USER = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id = ?"
+_SQL_LIST_USERS = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+_SQL_INSERT_USER = f"""
+    INSERT INTO users ({', '.join(USER_COLUMNS)})
+    VALUES ({', '.join('?' for _ in USER_COLUMNS)})
+"""
+_SQL_GET_DEVICE = f"SELECT {', '.join(DEVICE_COLUMNS)} FROM devices WHERE name = ? LIMIT 1"
+_SQL_LIST_DEVICES = f"SELECT {', '.join(DEVICE_COLUMNS)} FROM devices ORDER BY created_at DESC"
+_SQL_INSERT_DEVICE = '''
+    INSERT INTO devices (id, name, otp, enabled, created_at, last_used, ip_address)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+_SQL_INSERT_LOG = '''
+    INSERT INTO logs (user_id, device_name, action, type, timestamp, ip_address)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+_SQL_LIST_LOGS = f"SELECT {', '.join(LOG_COLUMNS)} FROM logs ORDER BY timestamp DESC, id DESC LIMIT ?"
+
+
+def _row_to_user(row):
+    user = dict(zip(USER_COLUMNS, row))
+    user['status_user'] = bool(user['status_user'])
+    return user
+
+
+def _row_to_device(row):
+    device = dict(zip(DEVICE_COLUMNS, row))
+    device['enabled'] = bool(device['enabled'])
+    return device
+
+
+def _row_to_log(row):
+    log = dict(zip(LOG_COLUMNS, row))
+    log['log_type'] = log.pop('type')
+    return log
+
+
+def _assignments(values, allowed):
+    """SET col = ? solo para columnas conocidas; los booleanos se guardan como 0/1"""
+    fields = []
+    params = []
+    for k, v in values.items():
+        if k not in allowed:
+            continue
+        if isinstance(v, bool):
+            v = int(v)
+        fields.append(f"{k} = ?")
+        params.append(v)
+    return fields, params
+
+
+# SQLite admite hasta 999 parámetros por consulta en versiones antiguas
+_IN_CHUNK = 500
+
+
+def _select_in(query, values):
+    """Ejecuta query + (?, ?, ...) por tramos de _IN_CHUNK valores"""
+    values = list(values)
+    rows = []
+    with _connection() as conn:
+        for start in range(0, len(values), _IN_CHUNK):
+            chunk = values[start:start + _IN_CHUNK]
+            rows.extend(conn.execute(f"{query}({', '.join('?' * len(chunk))})", chunk).fetchall())
+    return rows
+
+
+def get_user_db(user_id):
+    with _connection() as conn:
+        row = conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
+    return _row_to_user(row) if row else None
+
+
+def get_users_db(user_ids):
+    return [_row_to_user(row) for row in _select_in(
+        f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE user_id IN ", user_ids)]
+
+
+def list_users_db(active_only=False):
+    query = _SQL_LIST_USERS + (' WHERE status_user = 1' if active_only else '')
+    with _connection() as conn:
+        rows = conn.execute(query).fetchall()
+    return [_row_to_user(row) for row in rows]
+
+
+def list_stale_users_db(cutoff, after=None, limit=500):
+    """Usuarios activos con secreto anterior a cutoff (o sin fecha), por user_id ascendente"""
+    query = _SQL_LIST_USERS + """
+        WHERE status_user = 1 AND (date_totp IS NULL OR date_totp <= ?) AND user_id > ?
+        ORDER BY user_id LIMIT ?
+    """
+    with _connection() as conn:
+        rows = conn.execute(query, (cutoff, after or '', limit)).fetchall()
+    return [_row_to_user(row) for row in rows]
+
+
+def rotate_secrets_db(rotations):
+    """Actualiza totp_secret y date_totp de varios usuarios en una transacción"""
+    with _connection() as conn:
+        conn.executemany(
+            "UPDATE users SET totp_secret = ?, date_totp = ? WHERE user_id = ?",
+            [(r['totp_secret'], r['date_totp'], r['user_id']) for r in rotations]
+        )
+        conn.commit()
+
+
+def insert_user_db(user):
+    values = [user.get(col) for col in USER_COLUMNS]
+    values[USER_COLUMNS.index('status_user')] = int(bool(user.get('status_user', True)))
+    with _connection() as conn:
+        conn.execute(_SQL_INSERT_USER, values)
+        conn.commit()
+        row = conn.execute(_SQL_GET_USER, (user['user_id'],)).fetchone()
+    return _row_to_user(row) if row else None
+
+
+def insert_users_db(users):
+    """Inserción multi-fila en una sola transacción"""
+    rows = []
+    for user in users:
+        values = [user.get(col) for col in USER_COLUMNS]
+        values[USER_COLUMNS.index('status_user')] = int(bool(user.get('status_user', True)))
+        rows.append(values)
+    with _connection() as conn:
+        conn.executemany(_SQL_INSERT_USER, rows)
+        conn.commit()
+    return [_row_to_user(values) for values in rows]
+
+
+def update_user_db(user_id, updates):
+    fields, values = _assignments(updates, USER_COLUMNS)
+    if not fields:
+        return get_user_db(user_id)
+    with _connection() as conn:
+        cursor = conn.execute(f"UPDATE users SET {', '.join(fields)} WHERE user_id = ?",
+                              values + [user_id])
+        conn.commit()
+        if cursor.rowcount == 0:
+            return None
+        row = conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
+    return _row_to_user(row) if row else None
+
+
+def get_device_by_name_db(name):
+    with _connection() as conn:
+        row = conn.execute(_SQL_GET_DEVICE, (name,)).fetchone()
+    return _row_to_device(row) if row else None
+
+
+def get_devices_by_name_db(names):
+    return [_row_to_device(row) for row in _select_in(
+        f"SELECT {', '.join(DEVICE_COLUMNS)} FROM devices WHERE name IN ", names)]
+
+
+def list_device_rows_db():
+    with _connection() as conn:
+        rows = conn.execute(_SQL_LIST_DEVICES).fetchall()
+    return [_row_to_device(row) for row in rows]
+
+
+def insert_device_row_db(device):
+    device_id = _new_device_id()
+    with _connection() as conn:
+        conn.execute(_SQL_INSERT_DEVICE, (
+            device_id, device['name'], device.get('otp', '000000'),
+            int(bool(device.get('enabled', True))),
+            device.get('created_at') or datetime.now().isoformat(),
+            device.get('last_used'), device.get('ip_address')
+        ))
+        conn.commit()
+        row = conn.execute(_SQL_GET_DEVICE, (device['name'],)).fetchone()
+    return _row_to_device(row) if row else None
+
+
+def update_device_by_name_db(name, updates):
+    fields, values = _assignments(updates, DEVICE_COLUMNS)
+    if not fields:
+        return get_device_by_name_db(name)
+    with _connection() as conn:
+        cursor = conn.execute(f"UPDATE devices SET {', '.join(fields)} WHERE name = ?",
+                              values + [name])
+        conn.commit()
+        if cursor.rowcount == 0:
+            return None
+        row = conn.execute(_SQL_GET_DEVICE, (name,)).fetchone()
+    return _row_to_device(row) if row else None
+
+
+def touch_devices_db(rows):
+    """last_used / ip_address de varios dispositivos en una transacción"""
+    with _connection() as conn:
+        conn.executemany(
+            "UPDATE devices SET last_used = ?, ip_address = COALESCE(?, ip_address) WHERE name = ?",
+            [(row['last_used'], row.get('ip_address'), row['name']) for row in rows]
+        )
+        conn.commit()
+
+
+def delete_device_by_name_db(name):
+    with _connection() as conn:
+        cursor = conn.execute('DELETE FROM devices WHERE name = ?', (name,))
+        conn.commit()
+    return cursor.rowcount > 0
+
+
+def device_version_db():
+    with _connection() as conn:
+        row = conn.execute("SELECT version FROM sync_versions WHERE name = 'devices'").fetchone()
+    return row[0] if row else 0
+
+
+def list_devices_since_db(since):
+    """Dispositivos con updated_at >= since y lápidas de los borrados desde entonces"""
+    with _connection() as conn:
+        rows = conn.execute(
+            f"SELECT {', '.join(DEVICE_COLUMNS)} FROM devices WHERE updated_at >= ? ORDER BY updated_at",
+            (since,)
+        ).fetchall()
+        tombstones = conn.execute(
+            'SELECT name, deleted_at FROM device_tombstones WHERE deleted_at >= ? ORDER BY deleted_at',
+            (since,)
+        ).fetchall()
+    return ([_row_to_device(row) for row in rows],
+            [{'name': name, 'deleted_at': deleted_at} for name, deleted_at in tombstones])
+
+
+def add_logs_db(logs):
+    """Inserción multi-fila de logs con el formato de la API"""
+    with _connection() as conn:
+        conn.executemany(_SQL_INSERT_LOG, [
+            (log.get('user_id'), log.get('device_name') or '', log.get('action') or '',
+             log.get('log_type') or '', log.get('timestamp') or datetime.now().isoformat(),
+             log.get('ip_address'))
+            for log in logs
+        ])
+        _trim_logs(conn)
+        conn.commit()
+    _ensure_log_compactor()
+
+
+def list_logs_db(limit=100):
+    with _connection() as conn:
+        rows = conn.execute(_SQL_LIST_LOGS, (limit,)).fetchall()
+    return [_row_to_log(row) for row in rows]
+
+
+# --- Paginación por cursor ---
+_PAGE_SOURCES = {
+    'users': (USER_COLUMNS, _row_to_user, 'created_at', 'user_id'),
+    'devices': (DEVICE_COLUMNS, _row_to_device, 'created_at', 'name'),
+    'logs': (LOG_COLUMNS, _row_to_log, 'timestamp', 'id'),
+}
+
+
+def log_rollup_db(granularity, since=None, until=None, group_by=(), filters=None):
+    """Suma de log_rollups por intervalo y por las dimensiones de group_by"""
+    unknown = [dim for dim in list(group_by) + list(filters or {}) if dim not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Dimensiones desconocidas: {', '.join(unknown)}")
+    where, params = ['granularity = ?'], [granularity]
+    if since is not None:
+        where.append('bucket >= ?')
+        params.append(since)
+    if until is not None:
+        where.append('bucket < ?')
+        params.append(until)
+    for dim, value in (filters or {}).items():
+        where.append(f'{dim} = ?')
+        params.append(value)
+    columns = ', '.join(('bucket',) + tuple(group_by))
+    with _connection() as conn:
+        rows = conn.execute(
+            f"SELECT {columns}, SUM(count) FROM log_rollups WHERE {' AND '.join(where)} "
+            f"GROUP BY {columns} ORDER BY {columns}",
+            params
+        ).fetchall()
+    result = []
+    for row in rows:
+        item = {'bucket': row[0]}
+        item.update({dim: None for dim in DIMENSIONS})
+        item.update(zip(group_by, row[1:-1]))
+        item['count'] = row[-1]
+        result.append(item)
+    return result
+
+
+def list_page_db(table, after=None, limit=100):
+    """
+    Página keyset: (orden, desempate) descendente con nulos al final, que es
+    el orden natural de SQLite en DESC. Usa los índices (orden, desempate).
+    """
+    columns, to_row, sort_col, tie_col = _PAGE_SOURCES[table]
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    params = []
+    if after is not None:
+        value, tie = after
+        if value is None:
+            query += f" WHERE {sort_col} IS NULL AND {tie_col} < ?"
+            params = [tie]
+        else:
+            query += f" WHERE ({sort_col}, {tie_col}) < (?, ?) OR {sort_col} IS NULL"
+            params = [value, tie]
+    query += f" ORDER BY {sort_col} DESC, {tie_col} DESC LIMIT ?"
+    params.append(limit)
+    with _connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [to_row(row) for row in rows]
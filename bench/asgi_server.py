@@ -0,0 +1,445 @@
+"""
+API OTP - Modo asíncrono (ASGI), SOLO PARA BENCHMARKS
+
+Variante mínima de los endpoints de autenticación, usuarios, dispositivos y
+logs de api_server.py, con Starlette sobre el cliente asíncrono de Supabase.
+Existe para comparar WSGI contra ASGI (bench_asgi.py, load_test.py --mode
+asgi). No usa storage_manager ni InstrumentedStorage: no tiene paginación,
+ETags, métricas, feed de cambios ni los demás backends. No desplegar; la API
+es api_server.py.
+
+Ejecutar (desde la raíz del repositorio, con bench/requirements.txt):
+    pip install -r bench/requirements.txt
+    uvicorn bench.asgi_server:app --port 5000
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+from datetime import datetime
+
+import httpx
+import pyotp
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+
+from lookup_cache import users_cache, devices_cache
+from log_writer import create_log_writer
+from device_touch import create_device_touch
+from totp_verifier import verifier
+from replay_guard import create_replay_guard
+from rate_limiter import create_rate_limiter, rate_limit_keys
+from storage_manager import _missing
+from app_logging import get_logger
+
+log = get_logger('asgi')
+
+# Configuración Supabase
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+
+if not SUPABASE_URL or not SUPABASE_KEY:
+    raise ValueError("SUPABASE_URL y SUPABASE_KEY deben estar configuradas")
+
+# Conexiones simultáneas hacia Supabase por proceso
+MAX_CONNECTIONS = int(os.environ.get('OTP_ASGI_MAX_CONNECTIONS', 100))
+
+replay_guard = create_replay_guard(window=verifier.window)
+rate_limiter = create_rate_limiter()
+
+supabase: AsyncClient = None
+_loop = None
+
+
+async def _insert_logs_async(rows):
+    await supabase.table("logs").insert(rows).execute()
+
+
+def _insert_logs(rows):
+    """Sink del escritor de logs: corre en su hilo y delega en el event loop"""
+    asyncio.run_coroutine_threadsafe(_insert_logs_async(rows), _loop).result()
+
+
+log_writer = create_log_writer(_insert_logs)
+
+_touch_rpc = os.environ.get('OTP_VALIDATION_RPC', '1') == '1'
+
+
+async def _touch_devices_async(rows):
+    """Una llamada RPC (sql/touch_devices.sql) o, si no existe, updates en paralelo"""
+    global _touch_rpc
+    if _touch_rpc:
+        try:
+            await supabase.rpc('touch_devices', {'p_rows': rows}).execute()
+            return
+        except Exception as e:
+            # Un error pasajero se propaga: el coalescedor repone las filas
+            if not _missing(e):
+                raise
+            log.warning("RPC touch_devices no disponible", extra={'error': str(e)})
+            _touch_rpc = False
+    await asyncio.gather(*(
+        supabase.table("devices").update(
+            {'last_used': row['last_used'], 'ip_address': row['ip_address']}
+            if row.get('ip_address') else {'last_used': row['last_used']}
+        ).eq("name", row['name']).execute()
+        for row in rows
+    ))
+
+
+def _touch_devices(rows):
+    asyncio.run_coroutine_threadsafe(_touch_devices_async(rows), _loop).result()
+
+
+device_touch = create_device_touch(_touch_devices)
+
+
+async def _touch_device(device_name, ip_address):
+    now = datetime.now().isoformat()
+    if device_touch.flush_interval <= 0:
+        # Sin agrupación: escribir ya, desde el propio event loop
+        await _touch_devices_async([{'name': device_name, 'last_used': now, 'ip_address': ip_address}])
+    else:
+        device_touch.touch(device_name, now, ip_address)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global supabase, _loop
+    _loop = asyncio.get_running_loop()
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                            max_keepalive_connections=MAX_CONNECTIONS),
+        timeout=30
+    )
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY,
+                                    options=AsyncClientOptions(httpx_client=http_client))
+    log_writer.start()
+    yield
+    # Vaciar las colas mientras el event loop sigue vivo
+    await asyncio.to_thread(device_touch.close)
+    await asyncio.to_thread(log_writer.close)
+    await http_client.aclose()
+
+
+def get_client_ip(request):
+    """Obtiene la IP real del cliente incluso detrás de Render/Cloudflare"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.client.host if request.client else None
+
+
+async def _json_body(request):
+    try:
+        return await request.json() or {}
+    except Exception:
+        return {}
+
+
+# ============================================
+# HOME
+# ============================================
+async def home(request):
+    return JSONResponse({
+        'service': 'OTP Authentication API',
+        'version': '2.0',
+        'mode': 'asgi',
+        'security': 'Dual Layer (User + Device)',
+        'status': 'online',
+        'endpoints': {
+            'auth': '/api/validate_totp',
+            'users': '/api/users',
+            'devices': '/api/devices',
+            'logs': '/api/logs'
+        }
+    })
+
+
+# ============================================
+# AUTENTICACIÓN OTP
+# ============================================
+async def _fetch_user(user_id):
+    user = users_cache.get(user_id)
+    if user is None:
+        response = await supabase.table("users").select("*").eq("user_id", user_id).limit(1).execute()
+        users = response.data or []
+        user = users[0] if users else None
+        if user is not None:
+            users_cache.set(user_id, user)
+    return user
+
+
+async def _fetch_device(device_name):
+    device = devices_cache.get(device_name)
+    if device is None:
+        response = await supabase.table("devices").select("*").eq("name", device_name).limit(1).execute()
+        devices = response.data or []
+        device = devices[0] if devices else None
+        if device is not None:
+            devices_cache.set(device_name, device)
+    return device
+
+
+def _log_attempt(request, user_id, device_name, action, log_type):
+    """Registra intento de autenticación (encolado, se inserta por lotes)"""
+    success = log_type == 'login_success'
+    log.log(logging.INFO if success else logging.WARNING, action, extra={
+        'event': log_type, 'user_id': user_id, 'device_name': device_name, 'sample': success
+    })
+    log_writer.write({
+        'user_id': user_id,
+        'device_name': device_name,
+        'action': action,
+        'log_type': log_type,
+        'timestamp': datetime.now().isoformat(),
+        'ip_address': get_client_ip(request)
+    })
+
+
+async def _register_failure(request, user_id, device_name, limit_keys):
+    # Límite de intentos y códigos usados son SQLite síncrono: fuera del event loop
+    if rate_limiter and await asyncio.to_thread(rate_limiter.failure, limit_keys):
+        _log_attempt(request, user_id, device_name, "Bloqueo temporal por intentos fallidos", "rate_locked")
+
+
+async def validate_totp(request):
+    """
+    Valida OTP con doble capa de seguridad (usuario y dispositivo se
+    consultan en paralelo)
+    """
+    try:
+        req = await _json_body(request)
+
+        user_id = req.get("user_id")
+        otp = req.get("otp")
+        device_name = req.get("device_name")
+
+        if not user_id or not otp or not device_name:
+            missing = []
+            if not user_id: missing.append("user_id")
+            if not otp: missing.append("otp")
+            if not device_name: missing.append("device_name")
+            return JSONResponse({'valid': False, 'message': f'Faltan: {", ".join(missing)}'}, 400)
+
+        limit_keys = rate_limit_keys(user_id, device_name, get_client_ip(request))
+        if rate_limiter:
+            retry_after = await asyncio.to_thread(rate_limiter.check, limit_keys)
+            if retry_after:
+                return JSONResponse(
+                    {'valid': False, 'message': 'Demasiados intentos', 'retry_after': retry_after},
+                    429, headers={'Retry-After': str(retry_after)}
+                )
+
+        user, device = await asyncio.gather(_fetch_user(user_id), _fetch_device(device_name))
+
+        if not user:
+            _log_attempt(request, user_id, device_name, "Usuario no encontrado", "user_not_found")
+            return JSONResponse({'valid': False, 'message': 'Usuario no encontrado'}, 404)
+
+        if not user.get("status_user", False):
+            _log_attempt(request, user_id, device_name, "Usuario inactivo", "user_inactive")
+            return JSONResponse({'valid': False, 'message': 'Usuario inactivo'}, 403)
+
+        totp_secret = user.get("totp_secret")
+        if not totp_secret:
+            return JSONResponse({'valid': False, 'message': 'Usuario sin TOTP'}, 400)
+
+        if not device:
+            _log_attempt(request, user_id, device_name, "Dispositivo no registrado", "device_not_found")
+            return JSONResponse({'valid': False, 'message': 'Dispositivo no autorizado'}, 403)
+
+        if not device.get("enabled", False):
+            _log_attempt(request, user_id, device_name, "Dispositivo deshabilitado", "device_disabled")
+            return JSONResponse({'valid': False, 'message': 'Dispositivo deshabilitado'}, 403)
+
+        step = verifier.verify(totp_secret, otp)
+        if step is not None:
+            if not await asyncio.to_thread(replay_guard.claim, user_id, step):
+                _log_attempt(request, user_id, device_name, "OTP reutilizado", "otp_replay")
+                await _register_failure(request, user_id, device_name, limit_keys)
+                return JSONResponse({'valid': False, 'message': 'OTP ya utilizado'}, 401)
+
+            await _touch_device(device_name, get_client_ip(request))
+
+            if rate_limiter:
+                await asyncio.to_thread(rate_limiter.success, limit_keys)
+            _log_attempt(request, user_id, device_name, "Acceso exitoso", "login_success")
+
+            return JSONResponse({
+                'valid': True,
+                'message': 'Autenticación exitosa',
+                'user': {
+                    'user_id': user_id,
+                    'full_name': user.get('full_name'),
+                    'email': user.get('email')
+                }
+            }, 200)
+
+        _log_attempt(request, user_id, device_name, "OTP incorrecto", "otp_invalid")
+        await _register_failure(request, user_id, device_name, limit_keys)
+        return JSONResponse({'valid': False, 'message': 'OTP inválido'}, 401)
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.url.path})
+        return JSONResponse({'valid': False, 'error': str(e)}, 500)
+
+
+# ============================================
+# GESTIÓN DE USUARIOS
+# ============================================
+async def get_users(request):
+    """Listar todos los usuarios"""
+    try:
+        response = await supabase.table("users")\
+            .select("user_id, full_name, email, cedula, status_user, created_at")\
+            .execute()
+
+        return JSONResponse({
+            "users": response.data or [],
+            "message": "Usuarios cargados"
+        }, 200)
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.url.path})
+        return JSONResponse({"error": str(e)}, 500)
+
+
+async def create_user(request):
+    """Crear nuevo usuario con TOTP (el QR se sirve desde api_server)"""
+    try:
+        data = await _json_body(request)
+
+        user_id = data.get("user_id")
+        full_name = data.get("full_name")
+        email = data.get("email")
+        cedula = data.get("cedula")
+
+        if not user_id or not full_name or not email or not cedula:
+            return JSONResponse({'error': 'Faltan datos'}, 400)
+
+        totp_secret = pyotp.random_base32()
+
+        response = await supabase.table('users').insert({
+            "user_id": user_id,
+            "full_name": full_name,
+            "email": email,
+            "cedula": cedula,
+            "totp_secret": totp_secret,
+            "created_at": datetime.now().isoformat(),
+            "date_totp": datetime.now().isoformat(),
+            "status_user": True
+        }).execute()
+
+        if not response.data:
+            return JSONResponse({'error': 'No se pudo crear usuario'}, 500)
+
+        otpauth_url = pyotp.totp.TOTP(totp_secret).provisioning_uri(
+            name=email,
+            issuer_name="OTP Auth System"
+        )
+
+        return JSONResponse({
+            'user': response.data[0],
+            'qr_url': f"/api/users/{user_id}/qr",
+            'otpauth_url': otpauth_url
+        }, 201)
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.url.path})
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def users_endpoint(request):
+    if request.method == 'POST':
+        return await create_user(request)
+    return await get_users(request)
+
+
+# ============================================
+# GESTIÓN DE DISPOSITIVOS
+# ============================================
+async def get_devices(request):
+    """Listar todos los dispositivos"""
+    try:
+        response = await supabase.table('devices')\
+            .select('*')\
+            .order('created_at', desc=True)\
+            .execute()
+
+        return JSONResponse({
+            'devices': response.data or [],
+            'count': len(response.data or [])
+        }, 200)
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.url.path})
+        return JSONResponse({'error': str(e)}, 500)
+
+
+# ============================================
+# LOGS
+# ============================================
+async def get_logs(request):
+    """Obtener logs de actividad"""
+    try:
+        try:
+            limit = int(request.query_params.get('limit', 100))
+        except ValueError:
+            limit = 100
+
+        response = await supabase.table('logs')\
+            .select('*')\
+            .order('timestamp', desc=True)\
+            .limit(limit)\
+            .execute()
+
+        return JSONResponse({
+            'logs': response.data or [],
+            'count': len(response.data or [])
+        }, 200)
+
+    except Exception as e:
+        log.exception("Error no controlado", extra={'path': request.url.path})
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def log_activity(request):
+    try:
+        data = await _json_body(request)
+        user_id = data.get("user_id")
+        device_name = data.get("device_name")
+        action = data.get("action", "Actividad detectada")
+        ip = data.get("ip_address") or (request.client.host if request.client else None)
+
+        log_writer.write({
+            'user_id': user_id,
+            'device_name': device_name,
+            'action': action,
+            'log_type': 'session_resume',
+            'timestamp': datetime.now().isoformat(),
+            'ip_address': ip
+        })
+
+        if device_name:
+            await _touch_device(device_name, ip)
+
+        return JSONResponse({'status': 'logged'}, 200)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, 500)
+
+
+app = Starlette(
+    routes=[
+        Route('/', home),
+        Route('/api/validate_totp', validate_totp, methods=['POST']),
+        Route('/api/users', users_endpoint, methods=['GET', 'POST']),
+        Route('/api/devices', get_devices, methods=['GET']),
+        Route('/api/logs', get_logs, methods=['GET']),
+        Route('/api/log_activity', log_activity, methods=['POST']),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,167 @@
+"""
+Comparativa WSGI (gunicorn + Flask) vs ASGI (uvicorn + Starlette) contra el
+stub local de Supabase con latencia inyectada.
+
+Ejecutar (dependencias en bench/requirements.txt):
+    python -m bench.bench_asgi --requests 2000 --concurrency 200 --latency-ms 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import pyotp
+
+from bench.supabase_stub import (
+    STUB_KEY, spawn, synthetic_secret, synthetic_user_id, synthetic_device_name
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_port(port, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"El servidor no arrancó en el puerto {port}")
+
+
+def _launch(mode, port, env):
+    if mode == 'wsgi':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}', 'api_server:app']
+    elif mode == 'wsgi-multi':
+        # Perfil de producción (gunicorn.conf.py): un worker por núcleo con hilos
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}',
+               'api_server:app']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'bench.asgi_server:app', '--port', str(port), '--log-level', 'warning']
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def _post(reader, writer, path, payload):
+    """POST mínimo sobre HTTP/1.1. Retorna (status, la conexión sigue abierta)"""
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    keep_alive = True
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection" and value.strip().lower() == b"close":
+            keep_alive = False
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def _drive(port, total, concurrency, users):
+    """Carga en lazo cerrado: cada conexión envía la siguiente petición al recibir la respuesta"""
+    latencies = []
+    statuses = {}
+    counter = iter(range(total))
+
+    async def worker():
+        reader = writer = None
+        try:
+            for i in counter:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                index = i % users
+                payload = {
+                    'user_id': synthetic_user_id(index),
+                    'device_name': synthetic_device_name(index),
+                    'otp': pyotp.TOTP(synthetic_secret(index)).now()
+                }
+                start = time.perf_counter()
+                status, keep_alive = await _post(reader, writer, '/api/validate_totp', payload)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+                if not keep_alive:
+                    writer.close()
+                    writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'rps': total / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        'statuses': statuses
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark WSGI vs ASGI')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--modes', default='wsgi,asgi')
+    args = parser.parse_args()
+
+    stub_port = _free_port()
+    stub = spawn(stub_port, users=args.users, devices=args.users, latency_ms=args.latency_ms)
+    _wait_port(stub_port)
+
+    env = dict(os.environ)
+    env.update({
+        'SUPABASE_URL': f'http://127.0.0.1:{stub_port}',
+        'SUPABASE_KEY': STUB_KEY,
+        # Sin caché: se mide el coste real de las llamadas al backend
+        'OTP_CACHE_TTL': '0',
+        'OTP_VALIDATION_RPC': '0',
+        # El generador repite códigos del mismo paso para cada usuario
+        'OTP_REPLAY_BACKEND': 'off',
+        'OTP_RATE_LIMIT': '0'
+    })
+
+    print(f"Backend stub con {args.latency_ms} ms de latencia, "
+          f"{args.requests} peticiones, concurrencia {args.concurrency}")
+    for mode in args.modes.split(','):
+        port = _free_port()
+        proc = _launch(mode, port, env)
+        try:
+            _wait_port(port)
+            result = asyncio.run(_drive(port, args.requests,
+                                        args.concurrency, args.users))
+        finally:
+            proc.terminate()
+            proc.wait(10)
+        print(f"{mode:5s}  {result['rps']:8.1f} req/s  p50 {result['p50_ms']:7.1f} ms  "
+              f"p95 {result['p95_ms']:7.1f} ms  {result['statuses']}")
+
+    stub.terminate()
+    stub.wait(10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Tiempo de arranque en frío: importación de api_server y primera respuesta
+
+Cada corrida es un proceso nuevo con -X importtime que mide cuánto tarda
+`import api_server` y la primera petición a /api/devices (que construye el
+cliente de Supabase contra el stub local). Reporta la mediana de --runs
+corridas y los paquetes que más tiempo propio suman al importar.
+
+Ejecutar:
+    python -m bench.bench_startup --runs 5 --save bench/startup.json
+    python -m bench.bench_startup --runs 5 --compare bench/startup.json
+
+--backend memory mide el arranque sin Supabase (ni stub).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+from bench.bench_asgi import ROOT, _free_port, _wait_port
+from bench.load_test import _git_commit
+from bench.supabase_stub import STUB_KEY, spawn
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import api_server
+imported = time.perf_counter()
+response = api_server.app.test_client().get('/api/devices')
+answered = time.perf_counter()
+sys.stdout.write(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (answered - imported) * 1000,
+    'status': response.status_code
+}))
+'''
+
+METRICS = ('import_ms', 'first_request_ms', 'total_ms')
+
+
+def parse_importtime(text):
+    """Microsegundos propios por paquete raíz a partir de la salida de -X importtime"""
+    by_package = defaultdict(int)
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            self_us, _, name = line[len('import time:'):].split('|')
+            by_package[name.strip().split('.')[0]] += int(self_us)
+        except ValueError:
+            continue
+    return by_package
+
+
+def run_once(env):
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0 or not proc.stdout:
+        raise RuntimeError(f"la corrida falló ({proc.returncode}): {proc.stderr[-2000:]}")
+    sample = json.loads(proc.stdout)
+    sample['total_ms'] = sample['import_ms'] + sample['first_request_ms']
+    return sample, parse_importtime(proc.stderr)
+
+
+def measure(runs, env, top):
+    samples, packages = [], defaultdict(list)
+    for _ in range(runs):
+        sample, by_package = run_once(env)
+        samples.append(sample)
+        for name, self_us in by_package.items():
+            packages[name].append(self_us / 1000)
+    result = {key: statistics.median(s[key] for s in samples) for key in METRICS}
+    result['statuses'] = sorted({s['status'] for s in samples})
+    ranked = sorted(((name, statistics.median(values)) for name, values in packages.items()),
+                    key=lambda item: item[1], reverse=True)
+    result['packages'] = [{'package': name, 'ms': round(ms, 2)} for name, ms in ranked[:top]]
+    return result
+
+
+def print_report(result):
+    print(f"importación   {result['import_ms']:8.1f} ms")
+    print(f"1ª respuesta  {result['first_request_ms']:8.1f} ms  (estados {result['statuses']})")
+    print(f"total         {result['total_ms']:8.1f} ms")
+    print("\nPaquetes por tiempo propio de importación (mediana):")
+    for item in result['packages']:
+        print(f"  {item['package']:24s} {item['ms']:8.1f} ms")
+
+
+def compare(baseline, result, threshold):
+    """Imprime la diferencia con la línea base; retorna las métricas que empeoraron"""
+    regressions = []
+    print(f"\nComparación con {baseline.get('commit') or 'línea base'} "
+          f"({baseline.get('timestamp', '?')}), umbral +{threshold:.0f}%")
+    for key in METRICS:
+        before, after = baseline[key], result[key]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = change > threshold
+        if worse:
+            regressions.append(key)
+        print(f"{key:18s} {before:8.1f} → {after:8.1f} ms ({change:+.1f}%){'  ❌' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiempo de arranque en frío de la API')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--backend', choices=('supabase', 'memory'), default='supabase')
+    parser.add_argument('--top', type=int, default=15, help='paquetes a listar')
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR',
+                        help='variable de entorno extra para la API')
+    parser.add_argument('--save', metavar='RUTA', help='guardar el resultado como línea base')
+    parser.add_argument('--compare', metavar='RUTA', help='comparar con una línea base')
+    parser.add_argument('--threshold', type=float, default=15.0,
+                        help='empeoramiento tolerado, en porcentaje')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({'OTP_STORAGE': args.backend, 'OTP_LOG_LEVEL': 'ERROR'})
+    stub = None
+    try:
+        if args.backend == 'supabase':
+            stub_port = _free_port()
+            stub = spawn(stub_port, users=10, devices=10)
+            _wait_port(stub_port)
+            env.update({'SUPABASE_URL': f'http://127.0.0.1:{stub_port}', 'SUPABASE_KEY': STUB_KEY})
+        env.update(item.split('=', 1) for item in args.env)
+        print(f"Arranque en frío ({args.backend}), {args.runs} corridas")
+        result = measure(args.runs, env, args.top)
+    finally:
+        if stub is not None:
+            stub.terminate()
+            stub.wait(10)
+
+    result.update({
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('save', 'compare')}
+    })
+    print_report(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"\n💾 Línea base guardada en {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, result, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
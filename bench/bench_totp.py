@@ -0,0 +1,66 @@
+"""
+Microbenchmark de verificación TOTP: pyotp por petición vs TOTPVerifier
+
+Ejecutar:
+    python -m bench.bench_totp --users 100000
+"""
+
+import argparse
+import random
+import time
+
+import pyotp
+
+from bench.supabase_stub import synthetic_secret
+from totp_verifier import TOTPVerifier
+
+
+def _timed(label, fn, items):
+    start = time.perf_counter()
+    ok = 0
+    for secret, otp in items:
+        if fn(secret, otp):
+            ok += 1
+    elapsed = time.perf_counter() - start
+    print(f"{label:38s} {elapsed:7.3f} s  {elapsed / len(items) * 1e6:7.2f} µs/verif  "
+          f"({ok}/{len(items)} válidos)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de verificación TOTP')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=3, help='verificaciones por usuario')
+    parser.add_argument('--invalid', type=float, default=0.5, help='fracción de códigos incorrectos')
+    args = parser.parse_args()
+
+    now = time.time()
+    # Fijar el instante a mitad de un paso para que no cambie durante la medición
+    now = (now // 30) * 30 + 15
+    secrets = [synthetic_secret(i) for i in range(args.users)]
+
+    rng = random.Random(42)
+    items = []
+    for _ in range(args.rounds):
+        for secret in secrets:
+            if rng.random() < args.invalid:
+                otp = str(rng.randrange(10 ** 6)).zfill(6)
+            else:
+                otp = pyotp.TOTP(secret).at(now)
+            items.append((secret, otp))
+    rng.shuffle(items)
+
+    print(f"{args.users} usuarios, {len(items)} verificaciones, ventana ±1")
+    baseline = _timed('pyotp.TOTP(secret).verify',
+                      lambda s, o: pyotp.TOTP(s).verify(o, for_time=now, valid_window=1), items)
+
+    verifier = TOTPVerifier(maxsize=args.users)
+    cold = _timed('TOTPVerifier (caché fría + caliente)',
+                  lambda s, o: verifier.verify(s, o, for_time=now) is not None, items)
+    warm = _timed('TOTPVerifier (caché caliente)',
+                  lambda s, o: verifier.verify(s, o, for_time=now) is not None, items)
+    print(f"Aceleración: {baseline / cold:.1f}x (primera pasada), {baseline / warm:.1f}x (caliente)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""
+Prueba de carga del flujo de autenticación contra el stub local de Supabase
+
+Genera códigos TOTP válidos (y una fracción de incorrectos) para usuarios
+sintéticos y reparte las peticiones entre /api/validate_totp,
+/api/validate_totp/batch (BATCH_ITEMS códigos por petición),
+/api/log_activity y los listados según --mix. Reporta req/s y latencias
+p50/p95/p99 por endpoint; --save guarda el resultado como línea base y
+--compare lo contrasta con una anterior (código de salida 1 si alguna p95
+empeora más que --threshold por ciento).
+
+Ejecutar (dependencias en bench/requirements.txt):
+    python -m bench.load_test --requests 5000 --concurrency 50 --save bench/baseline.json
+    python -m bench.load_test --requests 5000 --concurrency 50 --compare bench/baseline.json
+
+Con --url se ataca un servidor ya levantado en lugar de arrancar stub + API.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import pyotp
+
+from bench.bench_asgi import ROOT, _free_port, _launch, _wait_port
+from bench.supabase_stub import (
+    STUB_KEY, spawn, synthetic_secret, synthetic_user_id, synthetic_device_name
+)
+
+DEFAULT_MIX = 'validate=80,log_activity=10,users=4,devices=4,logs=2'
+
+
+# Elementos por petición del escenario validate_batch
+BATCH_ITEMS = 50
+
+
+def _credentials(rng, index, invalid):
+    otp = pyotp.TOTP(synthetic_secret(index)).now()
+    if rng.random() < invalid:
+        otp = str((int(otp) + 1) % 10 ** 6).zfill(6)
+    return {
+        'user_id': synthetic_user_id(index),
+        'device_name': synthetic_device_name(index),
+        'otp': otp
+    }
+
+
+def _validate(rng, users, invalid):
+    return 'POST', '/api/validate_totp', _credentials(rng, rng.randrange(users), invalid)
+
+
+def _validate_batch(rng, users, invalid):
+    return 'POST', '/api/validate_totp/batch', {
+        'items': [_credentials(rng, rng.randrange(users), invalid) for _ in range(BATCH_ITEMS)]
+    }
+
+
+def _log_activity(rng, users, invalid):
+    index = rng.randrange(users)
+    return 'POST', '/api/log_activity', {
+        'user_id': synthetic_user_id(index),
+        'device_name': synthetic_device_name(index),
+        'action': 'Actividad detectada'
+    }
+
+
+SCENARIOS = {
+    'validate': _validate,
+    'validate_batch': _validate_batch,
+    'log_activity': _log_activity,
+    'users': lambda rng, users, invalid: ('GET', '/api/users?limit=50', None),
+    'devices': lambda rng, users, invalid: ('GET', '/api/devices', None),
+    'logs': lambda rng, users, invalid: ('GET', '/api/logs?limit=100', None),
+}
+
+
+def parse_mix(text):
+    """'validate=80,users=20' -> [('validate', 80.0), ('users', 20.0)]"""
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Escenario desconocido: {name} (disponibles: {', '.join(SCENARIOS)})")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+async def _request(reader, writer, host, method, path, payload=None):
+    """Petición HTTP/1.1 mínima. Retorna (status, la conexión sigue abierta)"""
+    body = b'' if payload is None else json.dumps(payload).encode()
+    head = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+    if payload is not None:
+        head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+    writer.write(head.encode() + b"\r\n" + body)
+    await writer.drain()
+
+    response = await reader.readuntil(b"\r\n\r\n")
+    lines = response.split(b"\r\n")
+    status = int(lines[0].split()[1])
+    length = None
+    chunked = False
+    keep_alive = True
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"transfer-encoding" and value == b"chunked":
+            chunked = True
+        elif name == b"connection" and value == b"close":
+            keep_alive = False
+
+    if chunked:
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length is not None:
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+
+def percentile(sorted_values, fraction):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, elapsed):
+    """samples: {escenario: [(segundos, status), ...]} -> métricas por escenario y total"""
+    def stats(items):
+        latencies = sorted(seconds for seconds, _ in items)
+        statuses = {}
+        for _, status in items:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return {
+            'count': len(items),
+            'rps': round(len(items) / elapsed, 1) if elapsed else 0.0,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+            'statuses': statuses
+        }
+
+    everything = [item for items in samples.values() for item in items]
+    result = {'elapsed_seconds': round(elapsed, 3), 'total': stats(everything), 'endpoints': {}}
+    for name in sorted(samples):
+        result['endpoints'][name] = stats(samples[name])
+    return result
+
+
+async def run_load(base_url, total, concurrency, users, mix, invalid=0.1,
+                   duration=None, warmup=0, seed=42):
+    """Carga en lazo cerrado: cada conexión envía la siguiente petición al recibir la respuesta"""
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+    prefix = parts.path.rstrip('/')
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    rng = random.Random(seed)
+    samples = {name: [] for name in names}
+    errors = []
+    counter = iter(range(total))
+    deadline = None
+
+    async def worker():
+        reader = writer = None
+        try:
+            for i in counter:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+                name = rng.choices(names, weights)[0]
+                method, path, payload = SCENARIOS[name](rng, users, invalid)
+                if writer is None:
+                    reader, writer = await asyncio.open_connection(host, port)
+                start = time.perf_counter()
+                try:
+                    status, keep_alive = await _request(reader, writer, host, method,
+                                                        prefix + path, payload)
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    errors.append(f"{name}: {e!r}")
+                    writer.close()
+                    writer = None
+                    continue
+                if i >= warmup:
+                    samples[name].append((time.perf_counter() - start, status))
+                if not keep_alive:
+                    writer.close()
+                    writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    start = time.perf_counter()
+    if duration:
+        deadline = start + duration
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    result = summarize({name: items for name, items in samples.items() if items}, elapsed)
+    result['errors'] = len(errors)
+    if errors:
+        result['first_errors'] = errors[:5]
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(result):
+    print(f"{'endpoint':14s} {'n':>7s} {'req/s':>9s} {'p50 ms':>9s} {'p95 ms':>9s} "
+          f"{'p99 ms':>9s} {'max ms':>9s}  estados")
+    rows = list(result['endpoints'].items()) + [('TOTAL', result['total'])]
+    for name, s in rows:
+        print(f"{name:14s} {s['count']:7d} {s['rps']:9.1f} {s['p50_ms']:9.2f} {s['p95_ms']:9.2f} "
+              f"{s['p99_ms']:9.2f} {s['max_ms']:9.2f}  {s['statuses']}")
+    if result.get('errors'):
+        print(f"⚠️  {result['errors']} errores de conexión: {result.get('first_errors')}")
+
+
+def compare(baseline, result, threshold):
+    """Imprime la diferencia con la línea base; retorna los endpoints cuya p95 empeoró"""
+    regressions = []
+    print(f"\nComparación con {baseline.get('commit') or 'línea base'} "
+          f"({baseline.get('timestamp', '?')}), umbral p95 +{threshold:.0f}%")
+    rows = list(result['endpoints'].items()) + [('TOTAL', result['total'])]
+    for name, current in rows:
+        previous = baseline['total'] if name == 'TOTAL' else baseline['endpoints'].get(name)
+        if not previous:
+            print(f"{name:14s} (sin datos en la línea base)")
+            continue
+        deltas = []
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            before, after = previous[key], current[key]
+            change = (after - before) / before * 100 if before else 0.0
+            deltas.append(f"{key} {before:.1f}→{after:.1f} ({change:+.1f}%)")
+        before_p95 = previous['p95_ms']
+        worse = before_p95 and (current['p95_ms'] - before_p95) / before_p95 * 100 > threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:14s} {'  '.join(deltas)}{'  ❌' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga del flujo de autenticación')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--duration', type=float, help='segundos; corta antes si se cumple')
+    parser.add_argument('--warmup', type=int, default=200, help='peticiones iniciales no medidas')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--invalid', type=float, default=0.1, help='fracción de códigos incorrectos')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='latencia del stub')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='variación ± de la latencia del stub')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fracción de errores del stub')
+    parser.add_argument('--stub-arg', action='append', default=[], metavar='ARG',
+                        help='argumento extra para bench.supabase_stub (p. ej. --stub-arg=--no-rpc)')
+    parser.add_argument('--mode', choices=('wsgi', 'wsgi-multi', 'asgi'), default='wsgi')
+    parser.add_argument('--url', help='servidor ya levantado (no se arranca stub ni API)')
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR',
+                        help='variable de entorno extra para la API')
+    parser.add_argument('--save', metavar='RUTA', help='guardar el resultado como línea base')
+    parser.add_argument('--compare', metavar='RUTA', help='comparar con una línea base')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='empeoramiento de p95 tolerado, en porcentaje')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    stub = api = None
+    url = args.url
+    try:
+        if url is None:
+            stub_port = _free_port()
+            stub = spawn(stub_port, users=args.users, devices=args.users, latency_ms=args.latency_ms,
+                         jitter_ms=args.jitter_ms, error_rate=args.error_rate, seed=args.seed,
+                         extra_args=args.stub_arg)
+            _wait_port(stub_port)
+            env = dict(os.environ)
+            env.update({
+                'SUPABASE_URL': f'http://127.0.0.1:{stub_port}',
+                'SUPABASE_KEY': STUB_KEY,
+                # El generador repite códigos del mismo paso para cada usuario
+                'OTP_REPLAY_BACKEND': 'off',
+                'OTP_RATE_LIMIT': '0',
+                'OTP_LOG_LEVEL': 'ERROR'
+            })
+            env.update(item.split('=', 1) for item in args.env)
+            port = _free_port()
+            api = _launch(args.mode, port, env)
+            _wait_port(port)
+            url = f'http://127.0.0.1:{port}'
+
+        print(f"{url} ({args.mode if args.url is None else 'externo'}), {args.requests} peticiones, "
+              f"concurrencia {args.concurrency}, mix {args.mix}")
+        result = asyncio.run(run_load(url, args.requests + args.warmup, args.concurrency,
+                                      args.users, mix, args.invalid, args.duration,
+                                      args.warmup, args.seed))
+    finally:
+        for proc in (api, stub):
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+
+    result.update({
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('save', 'compare')}
+    })
+    print_report(result)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"\n💾 Línea base guardada en {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, result, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
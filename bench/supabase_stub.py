@@ -0,0 +1,655 @@
+"""
+Servidor local compatible con PostgREST (/rest/v1) para pruebas de carga
+sin conexión. Mantiene en memoria las tablas users, devices y logs (y
+sync_versions / device_tombstones de sql/device_sync.sql), y emula las
+funciones de sql/ (validate_user_device, touch_devices, rotate_secrets,
+log_rollup_counts) y los triggers de sincronización de dispositivos y de
+log_rollups.
+
+Soporta lo que usan storage_manager.py y bench/asgi_server.py: select (con
+columnas), insert, upsert (on_conflict), update, delete, filtros eq, neq,
+gt, gte, lt, lte, is, in, like, ilike, not.*, or=(...) / and(...)
+anidados, order (asc/desc, nullsfirst/nullslast), limit y offset.
+
+Inyección de fallos, para medir cachés, lotes y concurrencia con un
+backend realista:
+    --latency-ms   retardo base de cada respuesta
+    --jitter-ms    variación uniforme ± sobre el retardo base
+    --spike-rate / --spike-ms   fracción de respuestas con retardo extra (cola larga)
+    --error-rate / --error-status   fracción de respuestas con error (el
+                   cliente postgrest reintenta 503/520 con espera: aparecen
+                   como latencia; con 500 el fallo llega a la API)
+    --fault-targets   tablas o rpc/<función> afectadas (por defecto todas)
+    --seed         semilla del generador, para corridas reproducibles
+
+La configuración también se cambia en caliente con PATCH /__stub/config y
+GET /__stub/stats devuelve el conteo de peticiones y fallos inyectados.
+
+Ejecutar (dependencias en bench/requirements.txt):
+    python -m bench.supabase_stub --port 54321 --users 1000 --latency-ms 20 --jitter-ms 5
+
+y arrancar la API con:
+    SUPABASE_URL=http://127.0.0.1:54321 SUPABASE_KEY=<STUB_KEY> gunicorn api_server:app
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from log_rollups import LogRollup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Clave con forma de JWT: el cliente de Supabase valida el formato
+STUB_KEY = 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.c3R1Yg'
+
+TABLES = ('users', 'devices', 'logs')
+PRIMARY_KEYS = {'users': 'user_id', 'devices': 'name', 'sync_versions': 'name',
+                'device_tombstones': 'name'}
+
+
+def synthetic_secret(index):
+    """Secreto TOTP determinista para el usuario sintético número index"""
+    digest = hashlib.sha1(f"otp-bench-{index}".encode()).digest()
+    return base64.b32encode(digest).decode()[:32]
+
+
+def synthetic_user_id(index):
+    return f"bench-user-{index}"
+
+
+def synthetic_device_name(index):
+    return f"bench-device-{index}"
+
+
+class StubError(Exception):
+    """Error con la forma de respuesta de PostgREST"""
+
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+# ============================================
+# FILTROS
+# ============================================
+_OPERATORS = ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'is', 'in', 'like', 'ilike')
+
+
+def _split_top(text):
+    """Separa por comas fuera de paréntesis y comillas"""
+    parts, depth, quoted, current = [], 0, False, []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch == '\\' and quoted and i + 1 < len(text):
+            current.append(text[i:i + 2])
+            i += 2
+            continue
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and ch == ',':
+            parts.append(''.join(current))
+            current = []
+            i += 1
+            continue
+        current.append(ch)
+        i += 1
+    if current:
+        parts.append(''.join(current))
+    return parts
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return value
+
+
+def _cast(current, value):
+    """Convierte el operando de texto al tipo de la columna"""
+    if value is None:
+        return None
+    if isinstance(current, bool):
+        return {'true': True, 'false': False}.get(str(value).lower(), value)
+    if isinstance(current, (int, float)):
+        try:
+            return type(current)(value)
+        except (TypeError, ValueError):
+            return value
+    return value
+
+
+def _like(pattern, flags=0):
+    regex = ''.join('.*' if ch in '*%' else '.' if ch == '_' else re.escape(ch) for ch in pattern)
+    return re.compile(f'^{regex}$', flags | re.DOTALL)
+
+
+def _operator(column, op, operand):
+    """Predicado fila -> bool con la semántica de NULL de SQL"""
+    if op == 'is':
+        if operand.lower() not in ('null', 'true', 'false'):
+            raise StubError(400, 'PGRST100', f"Valor inválido para is: {operand}")
+        expected = {'null': None, 'true': True, 'false': False}[operand.lower()]
+        return lambda row: row.get(column) is expected
+
+    if op == 'in':
+        raw = [_unquote(v) for v in _split_top(operand.strip()[1:-1])] if operand.strip() else []
+
+        def check_in(row):
+            current = row.get(column)
+            return current is not None and current in {_cast(current, v) for v in raw}
+        return check_in
+
+    if op in ('like', 'ilike'):
+        pattern = _like(_unquote(operand), re.IGNORECASE if op == 'ilike' else 0)
+        return lambda row: row.get(column) is not None and bool(pattern.match(str(row[column])))
+
+    value = _unquote(operand)
+    compare = {
+        'eq': lambda a, b: a == b,
+        'neq': lambda a, b: a != b,
+        'gt': lambda a, b: a > b,
+        'gte': lambda a, b: a >= b,
+        'lt': lambda a, b: a < b,
+        'lte': lambda a, b: a <= b,
+    }.get(op)
+    if compare is None:
+        raise StubError(400, 'PGRST100', f"Operador no soportado por el stub: {op}")
+
+    def check(row):
+        current = row.get(column)
+        if current is None:
+            return False
+        try:
+            return compare(current, _cast(current, value))
+        except TypeError:
+            return compare(str(current), str(value))
+    return check
+
+
+def _negate(predicate):
+    return lambda row: not predicate(row)
+
+
+def _column_filter(column, expression):
+    """col + 'op.valor' | 'not.op.valor'"""
+    negate = expression.startswith('not.')
+    if negate:
+        expression = expression[4:]
+    op, _, operand = expression.partition('.')
+    if op not in _OPERATORS:
+        raise StubError(400, 'PGRST100', f"Operador no soportado por el stub: {op}")
+    predicate = _operator(column, op, operand)
+    return _negate(predicate) if negate else predicate
+
+
+def _logic(kind, inner):
+    """kind = and | or; inner = lista separada por comas sin los paréntesis exteriores"""
+    predicates = [_expression(part) for part in _split_top(inner)]
+    if kind == 'and':
+        return lambda row: all(p(row) for p in predicates)
+    return lambda row: any(p(row) for p in predicates)
+
+
+def _expression(text):
+    """Elemento dentro de or=(...): col.op.valor, and(...), or(...) o not.and(...)"""
+    text = text.strip()
+    negate = text.startswith('not.and(') or text.startswith('not.or(')
+    if negate:
+        text = text[4:]
+    for kind in ('and', 'or'):
+        if text.startswith(kind + '(') and text.endswith(')'):
+            predicate = _logic(kind, text[len(kind) + 1:-1])
+            return _negate(predicate) if negate else predicate
+    column, _, expression = text.partition('.')
+    return _column_filter(column, expression)
+
+
+def parse_query(query):
+    """
+    Traduce la query string de PostgREST a
+    (predicado, orden [(col, desc, nullsfirst)], limit, offset, columnas, on_conflict)
+    """
+    predicates, order = [], []
+    limit = offset = columns = on_conflict = None
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        if key == 'select':
+            names = [c.strip() for c in value.split(',') if c.strip()]
+            columns = None if not names or '*' in names else names
+        elif key == 'columns':
+            continue
+        elif key == 'on_conflict':
+            on_conflict = value
+        elif key == 'limit':
+            limit = int(value)
+        elif key == 'offset':
+            offset = int(value)
+        elif key == 'order':
+            for part in value.split(','):
+                bits = part.strip().split('.')
+                desc = len(bits) > 1 and bits[1] == 'desc'
+                nullsfirst = desc
+                if 'nullsfirst' in bits[2:]:
+                    nullsfirst = True
+                elif 'nullslast' in bits[2:]:
+                    nullsfirst = False
+                order.append((bits[0], desc, nullsfirst))
+        elif key in ('or', 'and', 'not.or', 'not.and'):
+            kind = key.split('.')[-1]
+            predicate = _logic(kind, value.strip()[1:-1])
+            predicates.append(_negate(predicate) if key.startswith('not.') else predicate)
+        else:
+            predicates.append(_column_filter(key, value))
+
+    def condition(row):
+        return all(p(row) for p in predicates)
+    return condition, order, limit, offset, columns, on_conflict
+
+
+def _sort(rows, order):
+    for column, desc, nullsfirst in reversed(order):
+        nulls = [r for r in rows if r.get(column) is None]
+        values = [r for r in rows if r.get(column) is not None]
+        values.sort(key=lambda r: r[column], reverse=desc)
+        rows = nulls + values if nullsfirst else values + nulls
+    return rows
+
+
+# ============================================
+# TABLAS
+# ============================================
+class StubDatabase:
+    """Tablas en memoria protegidas por un único lock"""
+
+    def __init__(self, rpc=True, device_sync=True):
+        self.tables = {name: [] for name in TABLES}
+        self.rpc_enabled = rpc
+        self.device_sync = device_sync
+        if device_sync:
+            self.tables['sync_versions'] = [{'name': 'devices', 'version': 0}]
+            self.tables['device_tombstones'] = []
+        # Conteos de sql/log_rollups.sql; solo se consultan vía RPC
+        self.log_rollup = LogRollup()
+        self.lock = threading.Lock()
+        self._next_id = 1
+
+    def seed(self, users=0, devices=0):
+        now = datetime.now().isoformat()
+        with self.lock:
+            for i in range(users):
+                self.tables['users'].append({
+                    'user_id': synthetic_user_id(i),
+                    'full_name': f"Usuario {i}",
+                    'email': f"user{i}@bench.local",
+                    'cedula': str(10000000 + i),
+                    'totp_secret': synthetic_secret(i),
+                    'status_user': True,
+                    'created_at': now,
+                    'date_totp': now
+                })
+            for i in range(devices):
+                device = {
+                    'id': self._take_id(),
+                    'name': synthetic_device_name(i),
+                    'otp': '000000',
+                    'enabled': True,
+                    'created_at': now,
+                    'last_used': None,
+                    'ip_address': None
+                }
+                if self.device_sync:
+                    device['updated_at'] = now
+                self.tables['devices'].append(device)
+
+    def _take_id(self):
+        value = self._next_id
+        self._next_id += 1
+        return value
+
+    def _table(self, table):
+        rows = self.tables.get(table)
+        if rows is None:
+            raise StubError(404, 'PGRST205', f"Could not find the table 'public.{table}' in the schema cache")
+        return rows
+
+    # --- Emulación de sql/device_sync.sql ---
+    def _devices_written(self, table, rows, deleted=False):
+        if table != 'devices' or not self.device_sync:
+            return
+        now = datetime.now().isoformat()
+        tombstones = self.tables['device_tombstones']
+        for row in rows:
+            if deleted:
+                tombstones[:] = [t for t in tombstones if t['name'] != row['name']]
+                tombstones.append({'name': row['name'], 'deleted_at': now})
+            else:
+                row['updated_at'] = now
+        # Una subida de versión por sentencia, como el trigger for each statement
+        self.tables['sync_versions'][0]['version'] += 1
+
+    def insert(self, table, rows, on_conflict=None, merge=False):
+        """Inserción o upsert: con on_conflict los duplicados se fusionan (merge) o se ignoran"""
+        with self.lock:
+            target = self._table(table)
+            key = on_conflict or PRIMARY_KEYS.get(table)
+            index = {r.get(key): r for r in target} if key else {}
+            if key and on_conflict is None:
+                for row in rows:
+                    if row.get(key) in index:
+                        raise StubError(409, '23505',
+                                        f"duplicate key value violates unique constraint ({key})")
+            written = []
+            for row in rows:
+                existing = index.get(row.get(key)) if key else None
+                if existing is not None:
+                    if merge:
+                        existing.update(row)
+                        written.append(existing)
+                    continue
+                row = dict(row)
+                row.setdefault('id', self._take_id())
+                target.append(row)
+                if key:
+                    index[row.get(key)] = row
+                if table == 'devices' and self.device_sync:
+                    tombstones = self.tables['device_tombstones']
+                    tombstones[:] = [t for t in tombstones if t['name'] != row['name']]
+                written.append(row)
+            self._devices_written(table, written)
+            if table == 'logs':
+                self.log_rollup.add(written)
+            return [dict(r) for r in written]
+
+    def select(self, table, condition, order=(), limit=None, offset=None, columns=None):
+        with self.lock:
+            rows = [dict(r) for r in self._table(table) if condition(r)]
+        total = len(rows)
+        rows = _sort(rows, order)
+        if offset:
+            rows = rows[offset:]
+        if limit is not None:
+            rows = rows[:limit]
+        if columns:
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        return rows, total
+
+    def update(self, table, condition, values):
+        with self.lock:
+            changed = []
+            for row in self._table(table):
+                if condition(row):
+                    row.update(values)
+                    changed.append(row)
+            self._devices_written(table, changed)
+            return [dict(r) for r in changed]
+
+    def delete(self, table, condition):
+        with self.lock:
+            target = self._table(table)
+            removed = [r for r in target if condition(r)]
+            target[:] = [r for r in target if not condition(r)]
+            self._devices_written(table, removed, deleted=True)
+            return removed
+
+    # --- Emulación de las funciones de sql/ ---
+    def rpc(self, name, params):
+        if not self.rpc_enabled or name not in ('validate_user_device', 'touch_devices',
+                                                'rotate_secrets', 'log_rollup_counts'):
+            raise StubError(404, 'PGRST202', f"Could not find the function public.{name}")
+        if name == 'log_rollup_counts':
+            return self._log_rollup_counts(**params)
+        with self.lock:
+            if name == 'touch_devices':
+                return self._touch_devices(params.get('p_rows') or [])
+            if name == 'rotate_secrets':
+                return self._rotate_secrets(params.get('p_rows') or [])
+            return self._validate_user_device(**params)
+
+    def _touch_devices(self, rows):
+        by_name = {r['name']: r for r in self.tables['devices']}
+        changed = []
+        for item in rows:
+            device = by_name.get(item.get('name'))
+            if device is None:
+                continue
+            device['last_used'] = item.get('last_used')
+            if item.get('ip_address') is not None:
+                device['ip_address'] = item['ip_address']
+            changed.append(device)
+        self._devices_written('devices', changed)
+        return len(changed)
+
+    def _rotate_secrets(self, rows):
+        by_id = {r['user_id']: r for r in self.tables['users']}
+        count = 0
+        for item in rows:
+            user = by_id.get(item.get('user_id'))
+            if user is None:
+                continue
+            user['totp_secret'] = item.get('totp_secret')
+            user['date_totp'] = item.get('date_totp')
+            count += 1
+        return count
+
+    def _log_rollup_counts(self, p_granularity, p_since=None, p_until=None, p_group_by=(),
+                           p_log_type=None, p_device_name=None, p_user_id=None):
+        filters = {dim: value for dim, value in
+                   (('log_type', p_log_type), ('device_name', p_device_name), ('user_id', p_user_id))
+                   if value is not None}
+        return self.log_rollup.query(p_granularity, p_since, p_until, p_group_by or (), filters)
+
+    def _validate_user_device(self, p_user_id, p_device_name):
+        user = next((r for r in self.tables['users'] if r.get('user_id') == p_user_id), None)
+        device = next((r for r in self.tables['devices'] if r.get('name') == p_device_name), None)
+        return {
+            'user': dict(user) if user else None,
+            'device': dict(device) if device else None
+        }
+
+
+# ============================================
+# FALLOS INYECTADOS
+# ============================================
+class FaultInjector:
+    """Latencia, jitter, picos y errores aleatorios (reproducibles con seed)"""
+
+    FIELDS = ('latency_ms', 'jitter_ms', 'spike_rate', 'spike_ms', 'error_rate', 'error_status')
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, spike_rate=0.0, spike_ms=0.0,
+                 error_rate=0.0, error_status=503, targets=None, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.spike_rate = spike_rate
+        self.spike_ms = spike_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.targets = set(targets) if targets else None
+        self._rng = random.Random(seed)
+        self.requests = {}
+        self.injected_errors = 0
+        self.spikes = 0
+
+    def applies(self, target):
+        return self.targets is None or target in self.targets
+
+    def delay(self):
+        """Segundos de espera para la siguiente respuesta"""
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if self.spike_rate and self._rng.random() < self.spike_rate:
+            self.spikes += 1
+            delay += self.spike_ms
+        return max(delay, 0.0) / 1000.0
+
+    def error(self):
+        if self.error_rate and self._rng.random() < self.error_rate:
+            self.injected_errors += 1
+            return True
+        return False
+
+    def config(self):
+        config = {field: getattr(self, field) for field in self.FIELDS}
+        config['targets'] = sorted(self.targets) if self.targets else None
+        return config
+
+    def configure(self, values):
+        for field in self.FIELDS:
+            if field in values:
+                setattr(self, field, type(getattr(self, field))(values[field]))
+        if 'targets' in values:
+            self.targets = set(values['targets']) if values['targets'] else None
+        if 'seed' in values:
+            self._rng.seed(values['seed'])
+
+    def stats(self):
+        return {'requests': dict(self.requests), 'injected_errors': self.injected_errors,
+                'spikes': self.spikes}
+
+
+def _error_response(status, code, message):
+    return JSONResponse({'code': code, 'message': message, 'details': None, 'hint': None}, status)
+
+
+def create_app(db, faults=None):
+    """Aplicación ASGI que expone las tablas con la sintaxis de PostgREST"""
+    faults = faults or FaultInjector()
+
+    async def rest(request):
+        target = request.path_params['table']
+        key = f"{request.method} {target}"
+        faults.requests[key] = faults.requests.get(key, 0) + 1
+        if faults.applies(target):
+            delay = faults.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            if faults.error():
+                return _error_response(faults.error_status, 'PGRST000',
+                                       'Error inyectado por el stub')
+
+        prefer = request.headers.get('prefer', '')
+        try:
+            if target.startswith('rpc/'):
+                body = await request.json() if await request.body() else {}
+                return JSONResponse(db.rpc(target[4:], body))
+
+            condition, order, limit, offset, columns, on_conflict = parse_query(request.url.query)
+            if request.method == 'GET':
+                rows, total = db.select(target, condition, order, limit, offset, columns)
+                headers = {}
+                if 'count=' in prefer:
+                    start = offset or 0
+                    headers['Content-Range'] = f"{start}-{start + len(rows) - 1}/{total}" if rows else f"*/{total}"
+                return JSONResponse(rows, headers=headers)
+
+            if request.method == 'DELETE':
+                rows = db.delete(target, condition)
+            else:
+                body = await request.json()
+                if request.method == 'POST':
+                    rows = body if isinstance(body, list) else [body]
+                    rows = db.insert(target, rows, on_conflict,
+                                     merge='resolution=merge-duplicates' in prefer)
+                else:
+                    rows = db.update(target, condition, body or {})
+        except StubError as e:
+            return _error_response(e.status, e.code, str(e))
+
+        if 'return=minimal' in prefer:
+            return Response(status_code=201 if request.method == 'POST' else 204)
+        return JSONResponse(rows, 201 if request.method == 'POST' else 200)
+
+    async def stub_config(request):
+        if request.method == 'PATCH':
+            faults.configure(await request.json())
+        return JSONResponse(faults.config())
+
+    async def stub_stats(request):
+        with db.lock:
+            sizes = {name: len(rows) for name, rows in db.tables.items()}
+        return JSONResponse(dict(faults.stats(), tables=sizes))
+
+    return Starlette(routes=[
+        Route('/rest/v1/{table:path}', rest, methods=['GET', 'POST', 'PATCH', 'DELETE']),
+        Route('/__stub/config', stub_config, methods=['GET', 'PATCH']),
+        Route('/__stub/stats', stub_stats, methods=['GET'])
+    ])
+
+
+def create_server(port=54321, users=0, devices=0, host='127.0.0.1', rpc=True,
+                  device_sync=True, **fault_options):
+    """Crea el servidor uvicorn (sin arrancarlo) con una base sembrada"""
+    db = StubDatabase(rpc=rpc, device_sync=device_sync)
+    db.seed(users=users, devices=devices)
+    config = uvicorn.Config(create_app(db, FaultInjector(**fault_options)), host=host, port=port,
+                            log_level='warning', backlog=4096)
+    return uvicorn.Server(config)
+
+
+def spawn(port, users=0, devices=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0,
+          seed=None, extra_args=()):
+    """Arranca el stub en un proceso aparte (no compite por el GIL con el cliente)"""
+    cmd = [sys.executable, '-m', 'bench.supabase_stub', '--port', str(port),
+           '--users', str(users), '--devices', str(devices), '--latency-ms', str(latency_ms),
+           '--jitter-ms', str(jitter_ms), '--error-rate', str(error_rate)]
+    if seed is not None:
+        cmd += ['--seed', str(seed)]
+    cmd += list(extra_args)
+    return subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub local de Supabase/PostgREST')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=54321)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--spike-rate', type=float, default=0.0)
+    parser.add_argument('--spike-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--fault-targets', help='p. ej. users,devices,rpc/touch_devices')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--no-rpc', action='store_true',
+                        help='como una base sin sql/validate_user_device.sql ni touch_devices.sql')
+    parser.add_argument('--no-device-sync', action='store_true',
+                        help='como una base sin sql/device_sync.sql')
+    args = parser.parse_args()
+
+    server = create_server(
+        args.port, args.users, args.devices, args.host,
+        rpc=not args.no_rpc, device_sync=not args.no_device_sync,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        spike_rate=args.spike_rate, spike_ms=args.spike_ms,
+        error_rate=args.error_rate, error_status=args.error_status,
+        targets=args.fault_targets.split(',') if args.fault_targets else None,
+        seed=args.seed
+    )
+    print(f"🧪 Stub Supabase en http://{args.host}:{args.port} (clave: {STUB_KEY})", flush=True)
+    server.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Alta masiva de usuarios desde CSV o NDJSON
+
+Los secretos y los PNG de QR se generan en un pool de procesos único por
+proceso (creado al primer uso, con forkserver/spawn: nunca se hace fork de
+un worker con hilos); los usuarios se insertan en lotes multi-fila y el
+resultado de cada fila se entrega en cuanto su lote termina. Lo usan POST /api/users/bulk y la línea de comandos:
+
+    python -m bulk_provision empleados.csv --zip qrs.zip
+"""
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+import pyotp
+
+from qr_cache import provisioning_uri
+
+REQUIRED_FIELDS = ('user_id', 'full_name', 'email', 'cedula')
+
+BATCH_SIZE = int(os.environ.get('OTP_BULK_BATCH_SIZE', 500))
+WORKERS = int(os.environ.get('OTP_BULK_WORKERS', os.cpu_count() or 1))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _shared_pool(workers):
+    """
+    Pool compartido por todas las altas del proceso; su tamaño (el workers
+    del primer uso) acota los procesos aunque haya varias altas a la vez
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def _discard_pool(pool):
+    """Un pool roto (un proceso murió) se reemplaza en la próxima alta"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def parse_rows(text, fmt):
+    """Filas como dict desde CSV (con encabezado) o NDJSON (un objeto por línea)"""
+    if fmt == 'csv':
+        for row in csv.DictReader(io.StringIO(text)):
+            yield {key.strip(): (value or '').strip() for key, value in row.items() if key}
+    elif fmt == 'ndjson':
+        for line in text.splitlines():
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        raise ValueError(f"Formato desconocido: {fmt}")
+
+
+def detect_format(content_type, filename=None):
+    if (content_type and 'csv' in content_type) or (filename and filename.endswith('.csv')):
+        return 'csv'
+    return 'ndjson'
+
+
+def _prepare(item):
+    """
+    Se ejecuta en los procesos del pool: valida la fila y genera secreto,
+    URI otpauth y QR. Retorna (número de fila, usuario, uri, png, error).
+    """
+    number, row = item
+    if not isinstance(row, dict):
+        return number, None, None, None, 'Fila inválida'
+    missing = [field for field in REQUIRED_FIELDS if not row.get(field)]
+    if missing:
+        return number, None, None, None, f'Faltan: {", ".join(missing)}'
+
+    import qrcode
+
+    now = datetime.now().isoformat()
+    user = {
+        "user_id": str(row['user_id']),
+        "full_name": row['full_name'],
+        "email": row['email'],
+        "cedula": str(row['cedula']),
+        "totp_secret": pyotp.random_base32(),
+        "created_at": now,
+        "date_totp": now,
+        "status_user": True
+    }
+    uri = provisioning_uri(user['totp_secret'], user['email'])
+    buffer = io.BytesIO()
+    qrcode.make(uri).save(buffer)
+    return number, user, uri, buffer.getvalue(), None
+
+
+def _insert_batch(storage, prepared):
+    """
+    Inserta el lote en una sola operación; si falla (p. ej. un usuario ya
+    existe) reintenta fila por fila para saber cuál falló.
+    """
+    users = [user for _, user, _, _, _ in prepared]
+    try:
+        storage.insert_users(users)
+        return [None] * len(prepared)
+    except Exception:
+        errors = []
+        for user in users:
+            try:
+                storage.insert_user(user)
+                errors.append(None)
+            except Exception as e:
+                errors.append(str(e) or 'No se pudo crear usuario')
+        return errors
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def provision(rows, storage, on_qr=None, batch_size=BATCH_SIZE, workers=WORKERS):
+    """
+    Genera e inserta los usuarios de rows. Produce un dict por fila:
+    {'row', 'user_id', 'status': 'created' | 'error', ...}.
+    on_qr(user_id, uri, png) se llama por cada usuario creado.
+    """
+    seen = set()
+    pool = _shared_pool(workers) if workers > 1 else None
+    for batch in _batches(enumerate(rows, start=1), batch_size):
+        if pool:
+            try:
+                prepared = list(pool.map(_prepare, batch, chunksize=max(1, len(batch) // (workers * 4))))
+            except BrokenProcessPool:
+                _discard_pool(pool)
+                raise
+        else:
+            prepared = [_prepare(item) for item in batch]
+
+        valid = []
+        for (_, row), (number, user, uri, png, error) in zip(batch, prepared):
+            if error is None and user['user_id'] in seen:
+                error = 'user_id duplicado en el archivo'
+            if error:
+                user_id = row.get('user_id') if isinstance(row, dict) else None
+                yield {'row': number, 'user_id': user_id, 'status': 'error', 'error': error}
+                continue
+            seen.add(user['user_id'])
+            valid.append((number, user, uri, png, None))
+
+        if not valid:
+            continue
+        for (number, user, uri, png, _), error in zip(valid, _insert_batch(storage, valid)):
+            if error:
+                yield {'row': number, 'user_id': user['user_id'], 'status': 'error', 'error': error}
+                continue
+            if on_qr:
+                on_qr(user['user_id'], uri, png)
+            yield {
+                'row': number,
+                'user_id': user['user_id'],
+                'status': 'created',
+                'qr_url': f"/api/users/{user['user_id']}/qr",
+                'otpauth_url': uri
+            }
+
+
+def write_zip(target, rows, storage, on_qr=None, **kwargs):
+    """Archivo zip con qrs/<user_id>.png y results.ndjson"""
+    results = []
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+        def add_qr(user_id, uri, png):
+            safe_name = user_id.replace('/', '_').replace('\\', '_')
+            archive.writestr(f"qrs/{safe_name}.png", png)
+            if on_qr:
+                on_qr(user_id, uri, png)
+
+        for result in provision(rows, storage, on_qr=add_qr, **kwargs):
+            results.append(result)
+        archive.writestr('results.ndjson', ''.join(json.dumps(r) + '\n' for r in results))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Alta masiva de usuarios OTP')
+    parser.add_argument('file', help='archivo CSV o NDJSON (- para stdin)')
+    parser.add_argument('--format', choices=('csv', 'ndjson'), help='por defecto según la extensión')
+    parser.add_argument('--zip', help='guardar los QR y resultados en este zip')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    from storage_manager import create_storage
+
+    if args.file == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.file, encoding='utf-8-sig') as f:
+            text = f.read()
+    rows = parse_rows(text, args.format or detect_format(None, args.file))
+    storage = create_storage()
+    options = {'workers': args.workers, 'batch_size': args.batch_size}
+
+    if args.zip:
+        results = write_zip(args.zip, rows, storage, **options)
+    else:
+        results = []
+        for result in provision(rows, storage, **options):
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+    created = sum(1 for r in results if r['status'] == 'created')
+    print(f"✅ {created} creados, {len(results) - created} con error", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Feed de cambios de dispositivos y logs
+
+Cada cambio recibe un número de secuencia y se guarda en un buffer circular.
+Un cliente envía el cursor del último evento que vio y recibe solo lo nuevo
+(por SSE o long-poll). El cursor incluye una época: si el servidor se
+reinicia o el cursor es más antiguo que el buffer, la respuesta lleva
+reset=True y el cliente debe recargar las listas completas una vez.
+
+Con un solo proceso la época y la secuencia son locales. Con varios workers
+(shared_state.py) el feed sigue la secuencia global de shared_events y la
+época del archivo compartido: cualquier worker atiende el cursor emitido por
+otro. Los cambios propios se publican en shared_events y entran al buffer,
+en orden, cuando el worker los lee de vuelta.
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class ChangeFeed:
+    def __init__(self, maxlen=10000):
+        self._maxlen = maxlen
+        self._reset()
+        # on_publish(kind, rows) tras publicar un cambio local
+        self.on_publish = None
+
+    def _reset(self):
+        """Época, buffer y lock nuevos (al crear el feed y en el hijo tras fork)"""
+        self.epoch = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=self._maxlen)
+        self._seq = 0
+        # Secuencia desde la que el buffer está completo
+        self._floor = 0
+        self._shared = False
+        self._cond = threading.Condition()
+        self.published = 0
+
+    def follow(self, epoch, seq):
+        """
+        Pasa a la secuencia global (shared_state): desde ahora el buffer solo
+        recibe eventos por append(), con la época compartida, a partir de seq
+        """
+        with self._cond:
+            self.epoch = epoch
+            self._events.clear()
+            self._seq = self._floor = seq
+            self._shared = True
+            self._cond.notify_all()
+
+    def cursor(self, seq=None):
+        return f"{self.epoch}-{self._seq if seq is None else seq}"
+
+    def _parse(self, cursor):
+        """Retorna el número de secuencia o None si el cursor no es de esta época"""
+        if not cursor:
+            return None
+        epoch, _, seq = cursor.rpartition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _append(self, seq, kind, row):
+        if len(self._events) == self._events.maxlen:
+            # El evento que sale del buffer ya no se puede entregar
+            self._floor = self._events[0][0]
+        self._events.append((seq, kind, row))
+        self._seq = seq
+
+    def publish(self, kind, rows, broadcast=True):
+        if not rows:
+            return
+        if self._shared and broadcast:
+            # Entra al buffer con su número global al volver de shared_events
+            self.on_publish(kind, rows)
+            return
+        with self._cond:
+            for row in rows:
+                self._append(self._seq + 1, kind, row)
+            self.published += len(rows)
+            self._cond.notify_all()
+        if broadcast and self.on_publish is not None:
+            self.on_publish(kind, rows)
+
+    def append(self, seq, kind, row):
+        """Evento con número global leído de shared_events (en orden creciente)"""
+        with self._cond:
+            if seq <= self._seq:
+                return
+            self._append(seq, kind, row)
+            self.published += 1
+            self._cond.notify_all()
+
+    def read(self, cursor, kinds=None, limit=500):
+        """
+        Eventos posteriores al cursor. Retorna (eventos, nuevo cursor, reset).
+        Sin cursor se empieza desde ahora.
+        """
+        with self._cond:
+            seq = self._parse(cursor)
+            if seq is None or seq < self._floor:
+                return [], self.cursor(), bool(cursor)
+            if seq >= self._seq:
+                if seq > self._seq and not self._shared:
+                    return [], self.cursor(), True
+                # Secuencia global: otro worker ya vio más; este se pondrá al día
+                return [], self.cursor(seq), False
+
+            # Los eventos nuevos están al final del buffer
+            newer = []
+            for event in reversed(self._events):
+                if event[0] <= seq:
+                    break
+                newer.append(event)
+
+            events = []
+            last = seq
+            for event_seq, kind, row in reversed(newer):
+                last = event_seq
+                if kinds is None or kind in kinds:
+                    events.append({'seq': event_seq, 'type': kind, 'data': row})
+                    if len(events) >= limit:
+                        break
+            return events, self.cursor(last), False
+
+    def wait(self, cursor, timeout):
+        """Bloquea hasta que haya eventos posteriores al cursor o venza timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            seq = self._parse(cursor)
+            if seq is None:
+                return
+            while self._seq <= seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(remaining)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'epoch': self.epoch,
+                'seq': self._seq,
+                'shared': self._shared,
+                'buffered': len(self._events),
+                'capacity': self._events.maxlen,
+                'published': self.published
+            }
+
+
+change_feed = ChangeFeed(maxlen=int(os.environ.get('OTP_CHANGE_FEED_SIZE', 10000)))
+
+# Corre en el hijo justo después del fork, antes de que atienda peticiones;
+# con estado compartido el worker vuelve a seguir la secuencia global
+os.register_at_fork(after_in_child=change_feed._reset)
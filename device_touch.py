@@ -0,0 +1,123 @@
+"""
+Escrituras agrupadas de last_used / ip_address de dispositivos
+
+Cada validación o heartbeat solo anota en memoria el último uso del
+dispositivo; un hilo escribe todos los pendientes en una operación por
+lotes cada flush_interval segundos (la máxima antigüedad que puede tener
+last_used en la base). Así el volumen de escrituras depende del número de
+dispositivos activos y no del número de peticiones.
+"""
+
+import atexit
+import os
+import threading
+
+from app_logging import get_logger
+
+log = get_logger('device_touch')
+
+
+class DeviceTouchCoalescer:
+    def __init__(self, sink, flush_interval=5.0, max_pending=5000):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.touches = 0
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='device-touch', daemon=True)
+                self._thread.start()
+        return self
+
+    def touch(self, name, last_used, ip_address=None):
+        """Anota el último uso; una IP vacía conserva la anterior"""
+        self.touch_many([{'name': name, 'last_used': last_used, 'ip_address': ip_address}])
+
+    def touch_many(self, rows):
+        """Varios [{name, last_used, ip_address}]; sin agrupación, una sola escritura"""
+        if not rows:
+            return
+        if self.flush_interval <= 0:
+            self.sink(list({row['name']: row for row in rows}.values()))
+            return
+        if self._thread is None:
+            self.start()
+        with self._lock:
+            for row in rows:
+                name, ip_address = row['name'], row.get('ip_address')
+                previous = self._pending.get(name)
+                if ip_address is None and previous is not None:
+                    ip_address = previous['ip_address']
+                self._pending[name] = {'name': name, 'last_used': row['last_used'], 'ip_address': ip_address}
+                self.touches += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Escribe de forma síncrona todo lo pendiente"""
+        with self._flush_lock:
+            with self._lock:
+                rows = list(self._pending.values())
+                self._pending = {}
+            if not rows:
+                return
+            try:
+                self.sink(rows)
+                with self._lock:
+                    self.written += len(rows)
+                    self.flushes += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += len(rows)
+                    # Reponer lo que no se escribió, salvo que ya haya un uso más reciente
+                    for row in rows:
+                        self._pending.setdefault(row['name'], row)
+                log.error("Error actualizando dispositivos", extra={'rows': len(rows), 'error': str(e)})
+
+    def close(self, timeout=5.0):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'flush_interval': self.flush_interval,
+                'touches': self.touches,
+                'written': self.written,
+                'flushes': self.flushes,
+                'failed': self.failed
+            }
+
+
+def create_device_touch(sink):
+    """OTP_DEVICE_TOUCH_INTERVAL=0 escribe cada uso de inmediato"""
+    coalescer = DeviceTouchCoalescer(
+        sink,
+        flush_interval=float(os.environ.get('OTP_DEVICE_TOUCH_INTERVAL', 5.0)),
+        max_pending=int(os.environ.get('OTP_DEVICE_TOUCH_MAX_PENDING', 5000))
+    )
+    atexit.register(coalescer.close)
+    return coalescer
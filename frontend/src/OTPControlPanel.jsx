@@ -24,6 +24,59 @@ useEffect(() => {
     if (tab === "logs") fetchLogs();
   }, [tab]);
 
+  // Cambios en vivo de dispositivos y logs (long-poll), sin recargar las listas completas
+  useEffect(() => {
+    if (tab !== "dispositivos" && tab !== "logs") return;
+    const types = tab === "dispositivos" ? "device" : "log";
+    let active = true;
+    const controller = new AbortController();
+    const applyEvent = (event) => {
+      if (event.type === "device") {
+        const device = event.data;
+        setDevices((prev) => {
+          // Un borrado se quita de la lista y nunca se agrega como fila
+          if (device.deleted) return prev.filter((d) => d.name !== device.name);
+          const index = prev.findIndex((d) => d.name === device.name);
+          if (index === -1) return [device, ...prev];
+          const next = [...prev];
+          next[index] = { ...prev[index], ...device };
+          return next;
+        });
+      } else if (event.type === "log") {
+        setLogs((prev) => [event.data, ...prev]);
+      }
+    };
+    const pollChanges = async () => {
+      let cursor = "";
+      while (active) {
+        try {
+          // El servidor espera hasta 25 s por eventos nuevos
+          const res = await fetch(
+            `${API}/changes?types=${types}&timeout=25&cursor=${encodeURIComponent(cursor)}`,
+            { signal: controller.signal }
+          );
+          if (!res.ok) throw new Error(`HTTP ${res.status}`);
+          const data = await res.json();
+          if (data.reset) {
+            if (tab === "dispositivos") fetchDevices();
+            else fetchLogs();
+          }
+          data.events.forEach(applyEvent);
+          cursor = data.cursor;
+          if (!data.events.length) await new Promise((r) => setTimeout(r, 1000));
+        } catch (e) {
+          if (!active) return;
+          await new Promise((r) => setTimeout(r, 5000));
+        }
+      }
+    };
+    pollChanges();
+    return () => {
+      active = false;
+      controller.abort();
+    };
+  }, [tab]);
+
   async function fetchUsers() {
     try {
       setLoading(true);
@@ -0,0 +1,81 @@
+"""
+Perfil de gunicorn con varios workers en un host
+
+    gunicorn -c gunicorn.conf.py api_server:app
+
+Un worker por núcleo (WEB_CONCURRENCY) con hilos (OTP_THREADS): las
+peticiones pasan la mayor parte del tiempo esperando a Supabase, así que los
+hilos cubren la E/S y los procesos reparten el trabajo de CPU (verificación
+TOTP, JSON, QR). La aplicación se carga una vez en el maestro (preload) y
+los workers la heredan por fork.
+
+Cachés, límites de peticiones, códigos usados, feed de cambios y métricas se
+comparten entre workers por archivos SQLite locales (shared_state.py,
+rate_limiter.SQLiteRateLimiter, replay_guard.SQLiteUsedCodeIndex). Cada
+variable se puede fijar antes de arrancar para cambiar el valor por defecto.
+"""
+
+import multiprocessing
+import os
+import sys
+
+# Antes de que preload importe api_server
+os.environ.setdefault('OTP_SHARED_STATE', '1')
+os.environ.setdefault('OTP_RATE_BACKEND', 'sqlite')
+os.environ.setdefault('OTP_REPLAY_BACKEND', 'sqlite')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY') or multiprocessing.cpu_count())
+worker_class = 'gthread'
+
+# Con memory cada worker tendría su propio almacén, distinto de los demás
+if os.environ.get('OTP_STORAGE', 'supabase').lower() == 'memory' and workers > 1:
+    raise ValueError(
+        f"OTP_STORAGE=memory no se comparte entre workers ({workers}): "
+        "usar WEB_CONCURRENCY=1 u OTP_STORAGE=sqlite / supabase"
+    )
+
+# Cada espera de /api/changes (long-poll o SSE) ocupa un hilo; api_server las
+# acota a OTP_CHANGES_MAX_WAITERS por worker, que debe quedar por debajo de esto
+threads = int(os.environ.get('OTP_THREADS', 8))
+preload_app = True
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Reciclar workers de a poco acota la memoria sin reiniciarlos todos a la vez
+max_requests = int(os.environ.get('OTP_MAX_REQUESTS', 20000))
+max_requests_jitter = max_requests // 10
+
+# Latido de los workers en memoria y no en disco
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def on_starting(server):
+    import shared_state
+    shared_state.reset()
+
+
+def when_ready(server):
+    # La app ya está cargada (preload) pero el cliente de Supabase es perezoso:
+    # se importa el paquete una vez en el maestro y cada worker crea su cliente
+    # (y sus conexiones) después del fork
+    if os.environ.get('OTP_STORAGE', 'supabase').lower() == 'supabase':
+        import supabase  # noqa: F401
+
+
+def post_fork(server, worker):
+    # Hilos y conexiones abiertos en el maestro no sirven en el worker
+    import app_logging
+    import shared_state
+    app_logging.reopen_after_fork()
+    # Importar bd_nr crea otp_data.db: solo si el backend sqlite ya lo cargó
+    if 'bd_nr' in sys.modules:
+        sys.modules['bd_nr'].reset_after_fork()
+    shared_state.after_fork()
+
+
+def worker_exit(server, worker):
+    import shared_state
+    shared_state.shutdown()
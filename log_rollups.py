@@ -0,0 +1,117 @@
+"""
+Conteos de logs por tipo, dispositivo, usuario e intervalo de tiempo
+
+Cada log suma 1 en tres granularidades (minuto, hora y día) por
+(log_type, device_name, user_id). Las consultas agregan sobre esas filas y
+no sobre la tabla logs, así que un panel puede pedir meses de datos sin
+recorrer los logs crudos (que además se recortan por retención).
+
+    supabase  tabla log_rollups mantenida por trigger (sql/log_rollups.sql)
+    sqlite    la misma tabla con triggers en bd_nr.py
+    memory    LogRollup en proceso
+
+Los intervalos son textos ISO sin zona, en la hora de los timestamps de los
+logs: '2026-01-31T14:05:00' (minuto), '2026-01-31T14:00:00' (hora),
+'2026-01-31T00:00:00' (día). device_name y user_id vacíos se guardan como ''.
+"""
+
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+GRANULARITIES = ('minute', 'hour', 'day')
+DIMENSIONS = ('log_type', 'device_name', 'user_id')
+
+# Días que se conservan por granularidad (None: sin límite)
+RETENTION_DAYS = {'minute': 7, 'hour': 400, 'day': None}
+
+# Posiciones del timestamp ISO que se conservan y relleno del resto
+BUCKET_TRUNCATE = {
+    'minute': (16, ':00'),
+    'hour': (13, ':00:00'),
+    'day': (10, 'T00:00:00'),
+}
+
+
+def bucket_of(timestamp, granularity):
+    """Inicio del intervalo que contiene timestamp (datetime o texto ISO)"""
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    length, suffix = BUCKET_TRUNCATE[granularity]
+    return timestamp[:length].replace(' ', 'T') + suffix
+
+
+def rollup_key(row):
+    return tuple(row.get(dim) or '' for dim in DIMENSIONS)
+
+
+def retention_cutoffs(now=None):
+    """{granularidad: intervalo más antiguo que se conserva} de las que tienen límite"""
+    now = now or datetime.now()
+    return {
+        granularity: bucket_of(now - timedelta(days=days), granularity)
+        for granularity, days in RETENTION_DAYS.items() if days
+    }
+
+
+def aggregate(entries, group_by):
+    """
+    Suma [(bucket, (log_type, device_name, user_id), count)] por intervalo y
+    las dimensiones de group_by. Las dimensiones no agrupadas quedan en None.
+    """
+    positions = [DIMENSIONS.index(dim) for dim in group_by]
+    totals = Counter()
+    for bucket, key, count in entries:
+        totals[(bucket,) + tuple(key[i] for i in positions)] += count
+    rows = []
+    for group in sorted(totals):
+        row = {'bucket': group[0]}
+        row.update({dim: None for dim in DIMENSIONS})
+        row.update(zip(group_by, group[1:]))
+        row['count'] = totals[group]
+        rows.append(row)
+    return rows
+
+
+def matches(key, filters):
+    return all(key[DIMENSIONS.index(dim)] == value for dim, value in (filters or {}).items())
+
+
+class LogRollup:
+    """Contadores en proceso: {granularidad: Counter((bucket, clave) -> n)}"""
+
+    def __init__(self):
+        self._counts = {granularity: Counter() for granularity in GRANULARITIES}
+        self._lock = threading.Lock()
+        self._last_purge = None
+
+    def add(self, rows):
+        with self._lock:
+            for row in rows:
+                timestamp = row.get('timestamp') or datetime.now().isoformat()
+                key = rollup_key(row)
+                for granularity, counts in self._counts.items():
+                    counts[(bucket_of(timestamp, granularity), key)] += 1
+            self._purge()
+
+    def _purge(self):
+        """A lo sumo una vez por hora, como la compactación de los demás backends"""
+        hour = bucket_of(datetime.now(), 'hour')
+        if self._last_purge == hour:
+            return
+        self._last_purge = hour
+        for granularity, cutoff in retention_cutoffs().items():
+            counts = self._counts[granularity]
+            for entry in [entry for entry in counts if entry[0] < cutoff]:
+                del counts[entry]
+
+    def query(self, granularity, since=None, until=None, group_by=(), filters=None):
+        """Filas {bucket, log_type, device_name, user_id, count} con since <= bucket < until"""
+        with self._lock:
+            entries = [
+                (bucket, key, count)
+                for (bucket, key), count in self._counts[granularity].items()
+                if (since is None or bucket >= since) and (until is None or bucket < until)
+                and matches(key, filters)
+            ]
+        return aggregate(entries, group_by)
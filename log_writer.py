@@ -0,0 +1,144 @@
+"""
+Escritor asíncrono de logs de auditoría con inserciones masivas por lotes
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+
+from app_logging import get_logger
+
+log = get_logger('log_writer')
+
+
+class LogWriter:
+    """Cola acotada + hilo que envía los logs en inserciones multi-fila.
+
+    Un lote se envía cuando alcanza batch_size filas o cuando pasa
+    flush_interval segundos desde la primera fila pendiente.
+    """
+
+    def __init__(self, sink, maxsize=10000, batch_size=200, flush_interval=1.0,
+                 put_timeout=0.01):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self.overflows = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+        return self
+
+    def write(self, row):
+        """Encola una fila. Si la cola está llena espera put_timeout y luego descarta."""
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self.overflows += 1
+            try:
+                self._queue.put(row, timeout=self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def write_many(self, rows):
+        """Encola varias filas; retorna cuántas se aceptaron"""
+        return sum(1 for row in rows if self.write(row))
+
+    def _drain(self, first=None, deadline=None):
+        batch = [] if first is None else [first]
+        while len(batch) < self.batch_size:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            try:
+                if timeout is None or timeout <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            self.sink(batch)
+            with self._lock:
+                self.written += len(batch)
+                self.batches += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += len(batch)
+            log.error("Error insertando lote de logs", extra={'rows': len(batch), 'error': str(e)})
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = self._drain(first, time.monotonic() + self.flush_interval)
+            self._send(batch)
+
+    def flush(self):
+        """Envía de forma síncrona todo lo que quede en la cola"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._send(batch)
+
+    def close(self, timeout=5.0):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'capacity': self._queue.maxsize,
+                'enqueued': self.enqueued,
+                'written': self.written,
+                'batches': self.batches,
+                'dropped': self.dropped,
+                'overflows': self.overflows,
+                'failed': self.failed
+            }
+
+
+def create_log_writer(sink):
+    """Crea el escritor con la configuración del entorno y lo vacía al salir"""
+    writer = LogWriter(
+        sink,
+        maxsize=int(os.environ.get('OTP_LOG_QUEUE_SIZE', 10000)),
+        batch_size=int(os.environ.get('OTP_LOG_BATCH_SIZE', 200)),
+        flush_interval=float(os.environ.get('OTP_LOG_FLUSH_INTERVAL', 1.0)),
+        put_timeout=float(os.environ.get('OTP_LOG_PUT_TIMEOUT', 0.01))
+    )
+    atexit.register(writer.close)
+    return writer
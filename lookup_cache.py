@@ -0,0 +1,105 @@
+"""
+Caché en proceso con TTL + LRU para lecturas de usuarios y dispositivos
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Caché LRU con expiración por TTL y contadores de aciertos/fallos"""
+
+    def __init__(self, name, maxsize=10000, ttl=30.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # on_invalidate(nombre, clave) tras una invalidación local; clave None = clear
+        self.on_invalidate = None
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Lectura a través de la caché: solo llama a loader() en un fallo.
+
+        Los resultados vacíos (None) no se guardan para no ocultar altas nuevas.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key, broadcast=True):
+        with self._lock:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self.invalidations += 1
+        if broadcast and self.on_invalidate is not None:
+            self.on_invalidate(self.name, key)
+
+    def clear(self, broadcast=True):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+        if broadcast and self.on_invalidate is not None:
+            self.on_invalidate(self.name, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+# Configuración por variables de entorno
+CACHE_TTL = float(os.environ.get('OTP_CACHE_TTL', 30))
+CACHE_MAXSIZE = int(os.environ.get('OTP_CACHE_MAXSIZE', 10000))
+
+users_cache = TTLCache('users', maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+devices_cache = TTLCache('devices', maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+
+# Versiones de tablas para ETag: una lectura a la base por segundo como máximo
+version_cache = TTLCache('versions', maxsize=16, ttl=float(os.environ.get('OTP_VERSION_TTL', 1)))
@@ -0,0 +1,270 @@
+"""
+Métricas en formato Prometheus sin dependencias externas
+
+Cada hilo acumula en su propio shard (diccionarios que solo él escribe), así
+que registrar una medición no toma ningún lock. /metrics suma los shards al
+momento de exportar; los de hilos terminados se fusionan en uno acumulado.
+"""
+
+import bisect
+import threading
+import time
+
+# Segundos; cubren desde aciertos de caché hasta llamadas lentas a Supabase
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MAX_SHARDS = 256
+
+
+class _Shard:
+    __slots__ = ('counters', 'gauges', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+        self._help = {}
+        self._callbacks = []
+        # Con varios workers: objeto con collect(registry) -> (_Shard, valores de callbacks)
+        self.aggregator = None
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    # --- Registro (sin locks) ---
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def gauge_add(self, name, labels=(), value=1):
+        gauges = self._shard().gauges
+        key = (name, labels)
+        gauges[key] = gauges.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        entry = histograms.get(key)
+        if entry is None:
+            # [conteo por bucket..., +Inf], suma
+            entry = histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        entry[1] += seconds
+
+    def time(self, name, labels=(), error_counter=None):
+        return _Timer(self, name, labels, error_counter)
+
+    def register_callback(self, fn):
+        """fn() -> [(nombre, labels, valor)] de gauges leídos al exportar"""
+        self._callbacks.append(fn)
+
+    # --- Exportación ---
+    def _retire_dead(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard)
+        self._shards = alive
+
+    def collect(self):
+        total = _Shard()
+        with self._lock:
+            self._retire_dead()
+            _merge(total, self._retired)
+            for _, shard in self._shards:
+                _merge(total, shard)
+        return total
+
+    def callback_values(self):
+        values = []
+        for fn in self._callbacks:
+            values.extend(fn())
+        return values
+
+    def snapshot(self):
+        """Estado del proceso serializable en JSON (para sumar entre workers)"""
+        return dump_snapshot(self.collect(), self.callback_values())
+
+    def render(self):
+        if self.aggregator is not None:
+            total, callback_values = self.aggregator.collect(self)
+        else:
+            total, callback_values = self.collect(), self.callback_values()
+        families = {}
+
+        def add(name, labels, value):
+            families.setdefault(name, []).append((labels, [f"{name}{_labels(labels)} {_number(value)}"]))
+
+        for (name, labels), value in total.counters.items():
+            add(name, labels, value)
+        for (name, labels), value in total.gauges.items():
+            add(name, labels, value)
+        for name, labels, value in callback_values:
+            add(name, labels, value)
+        for (name, labels), (counts, total_seconds) in total.histograms.items():
+            lines = []
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total_seconds!r}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+            families.setdefault(name, []).append((labels, lines))
+
+        output = []
+        for name in sorted(families):
+            kind, help_text = self._help.get(name, ('untyped', name))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            for _, lines in sorted(families[name], key=lambda item: item[0]):
+                output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'error_counter', 'start')
+
+    def __init__(self, registry, name, labels, error_counter):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.error_counter = error_counter
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, self.labels, time.perf_counter() - self.start)
+        if exc_type is not None and self.error_counter:
+            self.registry.inc(self.error_counter, self.labels)
+        return False
+
+
+def _merge(target, source):
+    # dict.copy() es atómico con el GIL: el hilo dueño puede seguir escribiendo
+    for key, value in source.counters.copy().items():
+        target.counters[key] = target.counters.get(key, 0) + value
+    for key, value in source.gauges.copy().items():
+        target.gauges[key] = target.gauges.get(key, 0) + value
+    for key, (counts, seconds) in source.histograms.copy().items():
+        entry = target.histograms.get(key)
+        if entry is None:
+            entry = target.histograms[key] = [[0] * len(counts), 0.0]
+        for i, count in enumerate(list(counts)):
+            entry[0][i] += count
+        entry[1] += seconds
+
+
+def _labels_key(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def dump_snapshot(shard, callbacks=()):
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in shard.counters.items()],
+        'gauges': [[name, labels, value] for (name, labels), value in shard.gauges.items()],
+        'histograms': [[name, labels, counts, seconds]
+                       for (name, labels), (counts, seconds) in shard.histograms.items()],
+        'callbacks': [[name, labels, value] for name, labels, value in callbacks]
+    }
+
+
+def load_snapshot(snapshot, include_gauges=True):
+    """Inverso de MetricsRegistry.snapshot: (_Shard, valores de callbacks)"""
+    shard = _Shard()
+    for name, labels, value in snapshot.get('counters', ()):
+        shard.counters[(name, _labels_key(labels))] = value
+    if include_gauges:
+        for name, labels, value in snapshot.get('gauges', ()):
+            shard.gauges[(name, _labels_key(labels))] = value
+    for name, labels, counts, seconds in snapshot.get('histograms', ()):
+        shard.histograms[(name, _labels_key(labels))] = [list(counts), seconds]
+    callbacks = [(name, _labels_key(labels), value)
+                 for name, labels, value in snapshot.get('callbacks', ())] if include_gauges else []
+    return shard, callbacks
+
+
+def merge_snapshots(snapshots):
+    """Suma instantáneas ya cargadas: [(_Shard, callbacks)] -> (_Shard, callbacks)"""
+    total = _Shard()
+    callbacks = {}
+    for shard, values in snapshots:
+        _merge(total, shard)
+        for name, labels, value in values:
+            callbacks[(name, labels)] = callbacks.get((name, labels), 0) + value
+    return total, [(name, labels, value) for (name, labels), value in callbacks.items()]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class InstrumentedStorage:
+    """Proxy del backend de almacenamiento que mide cada llamada"""
+
+    def __init__(self, storage, registry):
+        self._storage = storage
+        self._registry = registry
+        self._wrapped = {}
+
+    def __getattr__(self, name):
+        wrapped = self._wrapped.get(name)
+        if wrapped is not None:
+            return wrapped
+        attr = getattr(self._storage, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        labels = (('backend', self._storage.name), ('operation', name))
+        registry = self._registry
+
+        def timed(*args, **kwargs):
+            with registry.time('otp_backend_call_duration_seconds', labels,
+                               error_counter='otp_backend_errors_total'):
+                return attr(*args, **kwargs)
+
+        self._wrapped[name] = timed
+        return timed
+
+
+registry = MetricsRegistry()
+registry.describe('otp_http_requests_total', 'counter', 'Peticiones HTTP por endpoint, método y estado')
+registry.describe('otp_http_request_duration_seconds', 'histogram', 'Latencia de las peticiones HTTP')
+registry.describe('otp_http_requests_in_flight', 'gauge', 'Peticiones HTTP en curso')
+registry.describe('otp_backend_call_duration_seconds', 'histogram', 'Latencia de las llamadas al almacenamiento')
+registry.describe('otp_backend_errors_total', 'counter', 'Llamadas al almacenamiento que fallaron')
+registry.describe('otp_auth_outcomes_total', 'counter', 'Resultados de autenticación por log_type')
@@ -0,0 +1,98 @@
+"""
+Paginación por cursor (keyset) para usuarios, dispositivos y logs
+"""
+
+import base64
+import json
+import os
+import uuid
+from datetime import datetime
+
+# Orden de cada listado: (columna de orden, desempate único), siempre descendente
+PAGE_KEYS = {
+    'users': ('created_at', 'user_id'),
+    'devices': ('created_at', 'name'),
+    'logs': ('timestamp', 'id'),
+}
+
+# Tipo de cada columna de PAGE_KEYS: los valores del cursor se validan con él
+# antes de llegar a un filtro (el cursor lo envía el cliente)
+KEY_TYPES = {
+    'created_at': 'timestamp',
+    'timestamp': 'timestamp',
+    'user_id': 'text',
+    'name': 'text',
+    'id': 'id',
+}
+
+# Página de un cursor sin limit. Sin limit ni cursor, /api/users y
+# /api/devices devuelven el listado completo, como antes de paginar.
+DEFAULT_PAGE_SIZE = int(os.environ.get('OTP_PAGE_SIZE', 500))
+MAX_PAGE_SIZE = int(os.environ.get('OTP_MAX_PAGE_SIZE', 1000))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size(requested, default=DEFAULT_PAGE_SIZE):
+    """Tamaño de página acotado por el servidor"""
+    if requested is None or requested <= 0:
+        requested = default
+    return min(requested, MAX_PAGE_SIZE)
+
+
+def encode_cursor(table, row):
+    """Cursor opaco con la clave de orden de la última fila entregada"""
+    sort_col, tie_col = PAGE_KEYS[table]
+    raw = json.dumps([row.get(sort_col), row.get(tie_col)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def _check_key(column, value):
+    """True si value es válido para la columna (los nulos solo en la de orden)"""
+    kind = KEY_TYPES[column]
+    if kind == 'timestamp':
+        if not isinstance(value, str):
+            return False
+        try:
+            datetime.fromisoformat(value)
+        except ValueError:
+            return False
+        return True
+    if kind == 'id':
+        if isinstance(value, int) and not isinstance(value, bool):
+            return True
+        try:
+            uuid.UUID(value)
+        except (TypeError, ValueError, AttributeError):
+            return False
+        return True
+    return isinstance(value, str)
+
+
+def decode_cursor(table, cursor):
+    """Retorna (valor de orden, desempate) o None si no hay cursor"""
+    if not cursor:
+        return None
+    sort_col, tie_col = PAGE_KEYS[table]
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(value, list) or len(value) != 2:
+            raise ValueError
+        if value[0] is not None and not _check_key(sort_col, value[0]):
+            raise ValueError
+        if not _check_key(tie_col, value[1]):
+            raise ValueError
+        return value[0], value[1]
+    except ValueError:
+        raise InvalidCursor('Cursor inválido')
+
+
+def split_page(table, rows, limit):
+    """Las consultas piden limit + 1 filas: la extra indica que hay otra página"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(table, rows[-1])
+    return rows, None
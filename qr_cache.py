@@ -0,0 +1,133 @@
+"""
+Caché de códigos QR direccionada por contenido
+
+La clave es el SHA-256 del URI otpauth: un mismo usuario con el mismo secreto
+siempre produce la misma clave, y al rotar el secreto la clave cambia sola.
+Dos niveles: LRU en memoria y archivos PNG en disco (OTP_QR_CACHE_DIR).
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import pyotp
+
+from app_logging import get_logger
+
+log = get_logger('qr_cache')
+
+ISSUER_NAME = "OTP Auth System"
+
+
+def provisioning_uri(totp_secret, email):
+    return pyotp.totp.TOTP(totp_secret).provisioning_uri(name=email, issuer_name=ISSUER_NAME)
+
+
+def uri_key(uri):
+    return hashlib.sha256(uri.encode()).hexdigest()
+
+
+class QRCache:
+    def __init__(self, directory, maxsize=256):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+
+    def etag(self, uri):
+        """Etiqueta sin comillas para ETag / If-None-Match"""
+        return uri_key(uri)[:32]
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _remember(self, key, png):
+        with self._lock:
+            self._entries[key] = png
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _render(self, uri):
+        import qrcode
+
+        buffer = io.BytesIO()
+        qrcode.make(uri).save(buffer)
+        return buffer.getvalue()
+
+    def _write(self, key, png):
+        """Escritura atómica; el PNG contiene el secreto, el archivo queda con permisos 0600"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, uri):
+        """PNG del URI: memoria, luego disco y, si no existe, se genera"""
+        key = uri_key(uri)
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return png
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                png = f.read()
+            self.disk_hits += 1
+        except FileNotFoundError:
+            png = self._render(uri)
+            self.renders += 1
+            try:
+                self._write(key, png)
+            except OSError as e:
+                log.warning("No se pudo guardar QR en disco", extra={'error': str(e)})
+
+        self._remember(key, png)
+        return png
+
+    def store(self, uri, png):
+        """Guarda en disco un QR ya generado (altas masivas) sin ocupar la LRU"""
+        try:
+            self._write(uri_key(uri), png)
+        except OSError as e:
+            log.warning("No se pudo guardar QR en disco", extra={'error': str(e)})
+
+    def forget(self, uri):
+        """Descarta el QR de un URI (p. ej. tras rotar el secreto)"""
+        key = uri_key(uri)
+        with self._lock:
+            self._entries.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'renders': self.renders
+            }
+
+
+qr_cache = QRCache(
+    os.environ.get('OTP_QR_CACHE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'qrs'),
+    maxsize=int(os.environ.get('OTP_QR_CACHE_SIZE', 256))
+)
@@ -0,0 +1,336 @@
+"""
+Límite de peticiones y bloqueo por fuerza bruta para la validación OTP
+
+Cada petición se cuenta por usuario, dispositivo e IP con una ventana
+deslizante aproximada (ventana anterior ponderada + ventana actual). Los
+fallos consecutivos bloquean la clave temporalmente; cada bloqueo repetido
+dobla la duración hasta OTP_LOCKOUT_MAX segundos. Se decide antes de
+consultar la base de datos. Backends (OTP_RATE_BACKEND):
+
+    memory  contadores en proceso (un solo worker)
+    sqlite  archivo local compartido por todos los workers del host
+            (OTP_RATE_DB; por defecto el de shared_state)
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from shared_state import connect, default_path
+
+# Tipos de clave y sus límites por defecto (peticiones por ventana, fallos antes de bloquear)
+DEFAULT_LIMITS = {
+    'user': (30, 5),
+    'device': (60, 10),
+    'ip': (120, 20),
+}
+
+
+def _union(key_sets):
+    """Claves de varias peticiones sin repetir, en orden de aparición"""
+    return list(dict.fromkeys(key for keys in key_sets for key in keys))
+
+
+class _Counter:
+    __slots__ = ('start', 'prev', 'curr', 'failures', 'last_failure', 'strikes', 'locked_until')
+
+    def __init__(self, start):
+        self.start = start
+        self.prev = 0
+        self.curr = 0
+        self.failures = 0
+        self.last_failure = 0.0
+        self.strikes = 0
+        self.locked_until = 0.0
+
+
+class RateLimiter:
+    def __init__(self, limits=None, window=60, lockout=60, lockout_max=3600):
+        self.limits = limits or DEFAULT_LIMITS
+        self.window = window
+        self.lockout = lockout
+        self.lockout_max = lockout_max
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._last_sweep = self._now()
+        self.rejected = 0
+        self.lockouts = 0
+
+    def _now(self):
+        return time.monotonic()
+
+    def _advance(self, counter, now):
+        elapsed = now - counter.start
+        if elapsed >= self.window:
+            # Avanzar la ventana; si pasó más de una, la anterior queda vacía
+            counter.prev = counter.curr if elapsed < 2 * self.window else 0
+            counter.curr = 0
+            counter.start = now - (elapsed % self.window)
+        return counter
+
+    def _estimate(self, counter, now):
+        weight = 1.0 - (now - counter.start) / self.window
+        return counter.prev * max(weight, 0.0) + counter.curr
+
+    def _sweep(self, now):
+        """Elimina claves inactivas una vez por ventana"""
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        idle = 2 * self.window
+        stale = [
+            key for key, c in self._counters.items()
+            if now - c.start >= idle and c.locked_until <= now
+            and now - c.last_failure >= self.lockout_max
+        ]
+        for key in stale:
+            del self._counters[key]
+
+    @contextmanager
+    def _locked(self, keys, now, create=True):
+        """Contadores de las claves (con la ventana al día) de forma exclusiva"""
+        with self._lock:
+            self._sweep(now)
+            counters = {}
+            for key in keys:
+                counter = self._counters.get(key)
+                if counter is None:
+                    if not create:
+                        continue
+                    counter = self._counters[key] = _Counter(now)
+                counters[key] = self._advance(counter, now)
+            yield counters
+
+    def _check(self, counters, keys, now):
+        retry_after = 0.0
+        for key in keys:
+            counter = counters[key]
+            if counter.locked_until > now:
+                retry_after = max(retry_after, counter.locked_until - now)
+            elif self._estimate(counter, now) + 1 > self.limits[key[0]][0]:
+                retry_after = max(retry_after, self.window - (now - counter.start))
+
+        if retry_after:
+            self.rejected += 1
+            return max(1, math.ceil(retry_after))
+
+        for key in keys:
+            counters[key].curr += 1
+        return 0
+
+    def _failure(self, counters, keys, now):
+        locked = False
+        for key in keys:
+            counter = counters[key]
+            if now - counter.last_failure >= self.window:
+                counter.failures = 0
+            if now - counter.last_failure >= self.lockout_max:
+                counter.strikes = 0
+            counter.failures += 1
+            counter.last_failure = now
+            if counter.failures >= self.limits[key[0]][1]:
+                duration = min(self.lockout * 2 ** counter.strikes, self.lockout_max)
+                counter.locked_until = now + duration
+                counter.strikes += 1
+                counter.failures = 0
+                self.lockouts += 1
+                locked = True
+        return locked
+
+    def _success(self, counters, keys):
+        for key in keys:
+            counter = counters.get(key)
+            if counter is not None:
+                counter.failures = 0
+                counter.strikes = 0
+
+    def check(self, keys):
+        """
+        Cuenta una petición para cada clave (tipo, valor).
+        Retorna 0 si se permite o los segundos a esperar si se rechaza.
+        """
+        now = self._now()
+        with self._locked(keys, now) as counters:
+            return self._check(counters, keys, now)
+
+    def failure(self, keys):
+        """Registra un intento fallido. Retorna True si alguna clave quedó bloqueada."""
+        now = self._now()
+        with self._locked(keys, now) as counters:
+            return self._failure(counters, keys, now)
+
+    def success(self, keys):
+        """Un acceso correcto reinicia los fallos acumulados"""
+        with self._locked(keys, self._now(), create=False) as counters:
+            self._success(counters, keys)
+
+    def check_many(self, key_sets):
+        """
+        check() de varias peticiones con un solo bloqueo o transacción, en
+        orden. Va antes de cualquier consulta: solo las admitidas (0) llegan a
+        la base de datos. Retorna retry_after por petición.
+        """
+        now = self._now()
+        with self._locked(_union(key_sets), now) as counters:
+            return [self._check(counters, keys, now) for keys in key_sets]
+
+    def record_many(self, key_sets, outcomes):
+        """
+        success() (outcome True) o failure() (False) de varias peticiones ya
+        admitidas, en orden; None no cuenta como intento de código. Un bloqueo
+        que salta aquí rechaza desde la siguiente petición, igual que con
+        peticiones concurrentes. Retorna locked por petición.
+        """
+        now = self._now()
+        results = []
+        with self._locked(_union(key_sets), now) as counters:
+            for keys, outcome in zip(key_sets, outcomes):
+                locked = False
+                if outcome is True:
+                    self._success(counters, keys)
+                elif outcome is False:
+                    locked = self._failure(counters, keys, now)
+                results.append(locked)
+        return results
+
+    def stats(self):
+        with self._lock:
+            now = self._now()
+            return {
+                'backend': 'memory',
+                'keys': len(self._counters),
+                'locked': sum(1 for c in self._counters.values() if c.locked_until > now),
+                'rejected': self.rejected,
+                'lockouts': self.lockouts
+            }
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    Contadores en un archivo SQLite local compartido por todos los workers del
+    host. Cada operación lee y reescribe sus claves dentro de una transacción
+    BEGIN IMMEDIATE, así que dos workers no pueden contar la misma petición a
+    medias. Usa el reloj de pared porque el monotónico no es comparable entre
+    procesos.
+    """
+
+    COLUMNS = _Counter.__slots__
+
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        self._local = threading.local()
+        super().__init__(*args, **kwargs)
+        self._connection().execute('''
+            CREATE TABLE IF NOT EXISTS rate_counters (
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                start REAL NOT NULL,
+                prev INTEGER NOT NULL,
+                curr INTEGER NOT NULL,
+                failures INTEGER NOT NULL,
+                last_failure REAL NOT NULL,
+                strikes INTEGER NOT NULL,
+                locked_until REAL NOT NULL,
+                PRIMARY KEY (kind, value)
+            ) WITHOUT ROWID
+        ''')
+
+    def _now(self):
+        return time.time()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = connect(self.path)
+            self._local.pid = os.getpid()
+        return conn
+
+    def _sweep(self, now):
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        self._connection().execute(
+            'DELETE FROM rate_counters WHERE ? - start >= ? AND locked_until <= ? AND ? - last_failure >= ?',
+            (now, 2 * self.window, now, now, self.lockout_max)
+        )
+
+    @contextmanager
+    def _locked(self, keys, now, create=True):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._sweep(now)
+            counters = {}
+            for kind, value in keys:
+                row = conn.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM rate_counters WHERE kind = ? AND value = ?",
+                    (kind, str(value))
+                ).fetchone()
+                if row is None:
+                    if not create:
+                        continue
+                    counter = _Counter(now)
+                else:
+                    counter = _Counter(row[0])
+                    for column, field in zip(self.COLUMNS, row):
+                        setattr(counter, column, field)
+                counters[(kind, value)] = self._advance(counter, now)
+            yield counters
+            conn.executemany(
+                f"INSERT OR REPLACE INTO rate_counters (kind, value, {', '.join(self.COLUMNS)}) "
+                f"VALUES (?, ?, {', '.join('?' * len(self.COLUMNS))})",
+                [(kind, str(value)) + tuple(getattr(c, column) for column in self.COLUMNS)
+                 for (kind, value), c in counters.items()]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self):
+        now = self._now()
+        keys, locked = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(locked_until > ?), 0) FROM rate_counters', (now,)
+        ).fetchone()
+        return {
+            'backend': 'sqlite',
+            'keys': keys,
+            'locked': locked,
+            # Rechazos y bloqueos de este worker
+            'rejected': self.rejected,
+            'lockouts': self.lockouts
+        }
+
+
+def rate_limit_keys(user_id, device_name, ip_address):
+    keys = [('user', user_id), ('device', device_name)]
+    if ip_address:
+        keys.append(('ip', ip_address))
+    return keys
+
+
+def create_rate_limiter():
+    """None si OTP_RATE_LIMIT=0"""
+    if os.environ.get('OTP_RATE_LIMIT', '1') == '0':
+        return None
+    limits = {}
+    for kind, (requests, failures) in DEFAULT_LIMITS.items():
+        prefix = f'OTP_RATE_{kind.upper()}'
+        limits[kind] = (
+            int(os.environ.get(f'{prefix}_REQUESTS', requests)),
+            int(os.environ.get(f'{prefix}_FAILURES', failures))
+        )
+    backend = os.environ.get('OTP_RATE_BACKEND', 'memory').lower()
+    options = dict(
+        limits=limits,
+        window=float(os.environ.get('OTP_RATE_WINDOW', 60)),
+        lockout=float(os.environ.get('OTP_LOCKOUT_SECONDS', 60)),
+        lockout_max=float(os.environ.get('OTP_LOCKOUT_MAX', 3600))
+    )
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(os.environ.get('OTP_RATE_DB') or default_path(), **options)
+    if backend != 'memory':
+        raise ValueError(f"OTP_RATE_BACKEND desconocido: {backend}")
+    return RateLimiter(**options)
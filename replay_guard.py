@@ -0,0 +1,162 @@
+"""
+Protección contra reutilización de códigos TOTP
+
+Un código aceptado queda registrado por (user_id, paso de tiempo) hasta que
+sale de la ventana de validez; cualquier otro intento con ese mismo paso se
+rechaza. Backends (OTP_REPLAY_BACKEND):
+
+    memory  índice en proceso (un solo worker)
+    sqlite  archivo local compartido por todos los workers del host
+            (OTP_REPLAY_DB; por defecto el de shared_state, en /dev/shm)
+    off     sin protección
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from shared_state import connect, default_path
+
+
+class MemoryUsedCodeIndex:
+    """Diccionario (user_id, paso) -> vencimiento con purga incremental"""
+
+    def __init__(self):
+        self._used = {}
+        self._expiry = deque()
+        self._lock = threading.Lock()
+
+    def claim(self, user_id, step, expires_at):
+        """True si es el primer uso del código; False si ya se usó"""
+        key = (user_id, step)
+        now = time.time()
+        with self._lock:
+            # Los vencimientos llegan casi en orden: purgar por la cabeza es O(1) amortizado
+            while self._expiry and self._expiry[0][0] <= now:
+                expires, old_key = self._expiry.popleft()
+                if self._used.get(old_key) == expires:
+                    del self._used[old_key]
+            current = self._used.get(key)
+            if current is not None and current > now:
+                return False
+            self._used[key] = expires_at
+            self._expiry.append((expires_at, key))
+            return True
+
+    def claim_many(self, claims):
+        """claim() de varios (user_id, paso, vencimiento), en orden"""
+        return [self.claim(*item) for item in claims]
+
+    def __len__(self):
+        return len(self._used)
+
+
+class SQLiteUsedCodeIndex:
+    """
+    Índice compartido entre procesos sobre un archivo SQLite local. Un único
+    INSERT OR IGNORE por clave primaria decide si el código es nuevo.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._claims = 0
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS used_codes (
+                    user_id TEXT NOT NULL,
+                    step INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, step)
+                ) WITHOUT ROWID
+            ''')
+
+    def _connection(self):
+        # Una conexión heredada por fork (preload_app) no se reutiliza
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = connect(self.path)
+            self._local.pid = os.getpid()
+        return conn
+
+    def claim(self, user_id, step, expires_at):
+        return self._claim(self._connection(), user_id, step, expires_at, time.time())
+
+    def claim_many(self, claims):
+        """Varios (user_id, paso, vencimiento) en una sola transacción"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            results = [self._claim(conn, *item, now) for item in claims]
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+
+    def _claim(self, conn, user_id, step, expires_at, now):
+        self._claims += 1
+        if self._claims % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM used_codes WHERE expires_at <= ?', (now,))
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO used_codes (user_id, step, expires_at) VALUES (?, ?, ?)',
+            (user_id, step, expires_at)
+        )
+        if cursor.rowcount == 1:
+            return True
+        # Clave existente pero vencida (aún no purgada): se reclama de nuevo
+        cursor = conn.execute(
+            'UPDATE used_codes SET expires_at = ? WHERE user_id = ? AND step = ? AND expires_at <= ?',
+            (expires_at, user_id, step, now)
+        )
+        return cursor.rowcount == 1
+
+
+class ReplayGuard:
+    def __init__(self, index, interval=30, window=1):
+        self.index = index
+        self.interval = interval
+        self.window = window
+        self.rejected = 0
+
+    def claim(self, user_id, step):
+        """Registra el uso de (user_id, step). False si el código ya se había usado."""
+        if self.index is None:
+            return True
+        # El código deja de ser aceptable cuando el paso actual supera step + window
+        expires_at = (step + self.window + 1) * self.interval
+        if self.index.claim(user_id, step, expires_at):
+            return True
+        self.rejected += 1
+        return False
+
+    def claim_many(self, claims):
+        """claim() de varios (user_id, step) con una sola operación sobre el índice"""
+        if self.index is None:
+            return [True] * len(claims)
+        results = self.index.claim_many([
+            (user_id, step, (step + self.window + 1) * self.interval) for user_id, step in claims
+        ])
+        self.rejected += results.count(False)
+        return results
+
+    def stats(self):
+        backend = 'off' if self.index is None else type(self.index).__name__
+        return {'backend': backend, 'rejected': self.rejected}
+
+
+def create_replay_guard(window=1):
+    backend = os.environ.get('OTP_REPLAY_BACKEND', 'memory').lower()
+    if backend == 'off':
+        index = None
+    elif backend == 'sqlite':
+        index = SQLiteUsedCodeIndex(os.environ.get('OTP_REPLAY_DB') or default_path())
+    elif backend == 'memory':
+        index = MemoryUsedCodeIndex()
+    else:
+        raise ValueError(f"OTP_REPLAY_BACKEND desconocido: {backend}")
+    return ReplayGuard(index, window=window)
@@ -0,0 +1,153 @@
+"""
+Rotación programada de secretos TOTP
+
+Recorre los usuarios activos con secreto vencido (filtro en el servidor por
+date_totp) en bloques paginados por user_id, y escribe cada bloque en una
+sola operación por lotes. El avance se guarda en un checkpoint JSON: si el
+proceso se detiene, la siguiente ejecución continúa desde el último bloque
+con la misma fecha de corte.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pyotp
+
+from app_logging import get_logger
+
+log = get_logger('rotation')
+
+
+class SecretRotationJob:
+    def __init__(self, storage, max_age_days=30, chunk_size=500, checkpoint_path=None,
+                 on_rotated=None):
+        self.storage = storage
+        self.max_age_days = max_age_days
+        self.chunk_size = chunk_size
+        self.checkpoint_path = checkpoint_path
+        # on_rotated(usuarios con el secreto anterior) tras escribir cada bloque
+        self.on_rotated = on_rotated
+        self._lock = threading.Lock()
+        self.progress = {'status': 'idle', 'runs': 0}
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_path:
+            return None
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return checkpoint if checkpoint.get('status') == 'running' else None
+
+    def _save_checkpoint(self, checkpoint):
+        if not self.checkpoint_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def run(self):
+        """Ejecuta (o reanuda) una rotación completa. Retorna las métricas."""
+        if not self._lock.acquire(blocking=False):
+            return dict(self.progress, skipped=True)
+        try:
+            return self._run()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        checkpoint = self._load_checkpoint()
+        if checkpoint:
+            log.info("Reanudando rotación", extra={'after': checkpoint['after']})
+        else:
+            cutoff = (datetime.now() - timedelta(days=self.max_age_days)).isoformat()
+            checkpoint = {'status': 'running', 'cutoff': cutoff, 'after': None,
+                          'rotated': 0, 'chunks': 0, 'started_at': datetime.now().isoformat()}
+
+        started = time.monotonic()
+        base_rotated = checkpoint['rotated']
+        progress = dict(checkpoint, runs=self.progress['runs'] + 1,
+                        elapsed_seconds=0.0, rate_per_second=0.0)
+        self.progress = progress
+
+        try:
+            while True:
+                fetch_start = time.monotonic()
+                users = self.storage.list_stale_users(
+                    checkpoint['cutoff'], checkpoint['after'], self.chunk_size
+                )
+                if not users:
+                    break
+                fetch_seconds = time.monotonic() - fetch_start
+
+                now = datetime.now().isoformat()
+                rotations = [
+                    {'user_id': user['user_id'], 'totp_secret': pyotp.random_base32(), 'date_totp': now}
+                    for user in users
+                ]
+                write_start = time.monotonic()
+                self.storage.rotate_secrets(rotations)
+                write_seconds = time.monotonic() - write_start
+
+                if self.on_rotated:
+                    self.on_rotated(users)
+
+                checkpoint['after'] = users[-1]['user_id']
+                checkpoint['rotated'] += len(users)
+                checkpoint['chunks'] += 1
+                self._save_checkpoint(checkpoint)
+
+                elapsed = time.monotonic() - started
+                progress.update(checkpoint, elapsed_seconds=round(elapsed, 3),
+                                rate_per_second=round((checkpoint['rotated'] - base_rotated) / elapsed, 1),
+                                last_fetch_seconds=round(fetch_seconds, 4),
+                                last_write_seconds=round(write_seconds, 4))
+
+                if len(users) < self.chunk_size:
+                    break
+        except Exception as e:
+            progress.update(status='failed', error=str(e))
+            log.exception("Error en rotación; se reanudará desde el checkpoint", extra={'after': checkpoint['after']})
+            return dict(progress)
+
+        checkpoint['status'] = 'done'
+        checkpoint['finished_at'] = datetime.now().isoformat()
+        self._save_checkpoint(checkpoint)
+        elapsed = time.monotonic() - started
+        progress.update(checkpoint, elapsed_seconds=round(elapsed, 3))
+        progress.pop('error', None)
+        log.info("Rotación completada", extra={'rotated': checkpoint['rotated'], 'elapsed_seconds': round(elapsed, 3)})
+        return dict(progress)
+
+
+def create_rotation_job(storage, on_rotated=None):
+    return SecretRotationJob(
+        storage,
+        max_age_days=int(os.environ.get('OTP_ROTATION_MAX_AGE_DAYS', 30)),
+        chunk_size=int(os.environ.get('OTP_ROTATION_CHUNK_SIZE', 500)),
+        checkpoint_path=os.environ.get('OTP_ROTATION_CHECKPOINT')
+            or os.path.join(tempfile.gettempdir(), 'otp_rotation_checkpoint.json'),
+        on_rotated=on_rotated
+    )
+
+
+def start_scheduler(job):
+    """Programa job.run con APScheduler cada OTP_ROTATION_INTERVAL_HOURS horas"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = BackgroundScheduler(daemon=True)
+    scheduler.add_job(
+        job.run, 'interval',
+        hours=float(os.environ.get('OTP_ROTATION_INTERVAL_HOURS', 24)),
+        id='refresh_totp_secrets', max_instances=1, coalesce=True,
+        next_run_time=datetime.now()
+    )
+    scheduler.start()
+    return scheduler
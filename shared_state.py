@@ -0,0 +1,346 @@
+"""
+Estado compartido entre los workers de un mismo host
+
+Con gunicorn -w N cada worker es un proceso con sus propias cachés, feed de
+cambios y métricas. Este módulo los coordina a través de un archivo SQLite
+en memoria compartida (/dev/shm si existe; OTP_SHARED_STATE_DB):
+
+    invalidaciones y cambios  cada worker anota lo que invalida o publica;
+                              un hilo por worker aplica lo de los demás cada
+                              OTP_SHARED_POLL_INTERVAL segundos
+    métricas                  cada worker guarda una instantánea de su
+                              registro y /metrics suma las de todos
+
+Los contadores del límite de peticiones usan el mismo archivo
+(rate_limiter.SQLiteRateLimiter). OTP_SHARED_STATE=1 lo activa;
+gunicorn.conf.py lo hace por defecto.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from app_logging import get_logger
+from metrics import dump_snapshot, load_snapshot, merge_snapshots
+
+log = get_logger('shared_state')
+
+# Instancias del proceso, para reiniciarlas después de fork
+_instances = []
+
+
+def default_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.environ.get('OTP_SHARED_STATE_DB') or os.path.join(directory, 'otp_shared_state.db')
+
+
+def connect(path):
+    """Conexión en autocommit; se puede perder en un corte de energía, no en un fallo del proceso"""
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    return conn
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedState:
+    RETAIN_SECONDS = 300
+    PURGE_EVERY = 500
+
+    def __init__(self, path, poll_interval=0.2, snapshot_interval=5.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.snapshot_interval = snapshot_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._caches = {}
+        self._feed = None
+        self._registry = None
+        self._pid = None
+        self._worker = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._last_seen = 0
+        self._polls = 0
+        self.sent = 0
+        self.applied = 0
+        self.errors = 0
+        conn = self._connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shared_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                worker TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                payload TEXT,
+                created_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shared_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS metric_snapshots (
+                worker TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        _instances.append(self)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = connect(self.path)
+            self._local.pid = os.getpid()
+        return conn
+
+    # --- Ciclo de vida por proceso ---
+    def ensure_started(self):
+        """Arranca el hilo del worker actual (después de fork los hilos no se heredan)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            conn = self._connection()
+            oldest = conn.execute('SELECT MIN(seq) FROM shared_events').fetchone()[0]
+            if oldest is None:
+                row = conn.execute(
+                    "SELECT seq FROM sqlite_sequence WHERE name = 'shared_events'"
+                ).fetchone()
+                self._last_seen = row[0] if row else 0
+            else:
+                # Los eventos retenidos se vuelven a aplicar: el feed de este
+                # worker atiende también cursores emitidos antes de que arrancara
+                self._last_seen = oldest - 1
+            self._worker = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            if self._feed is not None:
+                self._feed.follow(self._epoch(conn), self._last_seen)
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='shared-state', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def close(self):
+        """Detiene el hilo y deja la última instantánea de métricas"""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(2.0)
+            self.push_snapshot()
+
+    def _run(self):
+        last_snapshot = 0.0
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+                now = time.monotonic()
+                if self._registry is not None and now - last_snapshot >= self.snapshot_interval:
+                    last_snapshot = now
+                    self.push_snapshot()
+            except Exception as e:
+                self.errors += 1
+                log.error("Error sincronizando estado compartido", extra={'error': str(e)})
+
+    # --- Cachés y feed de cambios ---
+    def attach_cache(self, cache):
+        self._caches[cache.name] = cache
+        cache.on_invalidate = self._cache_invalidated
+
+    def attach_feed(self, feed):
+        self._feed = feed
+        feed.on_publish = self._feed_published
+
+    def _send(self, kind, name, payload):
+        self.ensure_started()
+        try:
+            self._connection().execute(
+                'INSERT INTO shared_events (worker, kind, name, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                (self._worker, kind, name, json.dumps(payload, default=str), time.time())
+            )
+            self.sent += 1
+        except sqlite3.Error as e:
+            # Sin difusión los demás workers siguen acotados por el TTL de sus cachés
+            self.errors += 1
+            log.error("No se pudo difundir a los demás workers", extra={'kind': kind, 'error': str(e)})
+
+    def _epoch(self, conn):
+        """Época del feed común a los workers; reset() la renueva al reiniciar"""
+        conn.execute("INSERT OR IGNORE INTO shared_meta (key, value) VALUES ('epoch', ?)",
+                     (uuid.uuid4().hex[:8],))
+        return conn.execute("SELECT value FROM shared_meta WHERE key = 'epoch'").fetchone()[0]
+
+    def _cache_invalidated(self, name, key):
+        self._send('cache', name, key)
+
+    def _feed_published(self, kind, rows):
+        """Una fila de shared_events por evento: su seq es el número global del feed"""
+        self.ensure_started()
+        now = time.time()
+        try:
+            self._connection().executemany(
+                'INSERT INTO shared_events (worker, kind, name, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                [(self._worker, 'feed', kind, json.dumps(row, default=str), now) for row in rows]
+            )
+            self.sent += len(rows)
+        except sqlite3.Error as e:
+            self.errors += 1
+            log.error("No se pudo publicar en el feed compartido", extra={'kind': kind, 'error': str(e)})
+            return
+        # Los eventos propios entran al feed sin esperar al hilo
+        self.poll()
+
+    def poll(self):
+        """
+        Aplica lo que publicaron los demás workers desde la última lectura, y
+        pasa al feed todos los eventos (también los propios) en orden de seq
+        """
+        with self._poll_lock:
+            return self._poll()
+
+    def _poll(self):
+        conn = self._connection()
+        rows = conn.execute(
+            'SELECT seq, worker, kind, name, payload FROM shared_events WHERE seq > ? ORDER BY seq',
+            (self._last_seen,)
+        ).fetchall()
+        for seq, worker, kind, name, payload in rows:
+            self._last_seen = seq
+            if kind == 'feed':
+                if self._feed is not None:
+                    self._feed.append(seq, name, json.loads(payload))
+                    self.applied += 1
+                continue
+            if worker == self._worker:
+                continue
+            value = json.loads(payload) if payload is not None else None
+            if kind == 'cache':
+                cache = self._caches.get(name)
+                if cache is None:
+                    continue
+                if value is None:
+                    cache.clear(broadcast=False)
+                else:
+                    cache.invalidate(value, broadcast=False)
+            self.applied += 1
+
+        self._polls += 1
+        if self._polls % self.PURGE_EVERY == 0:
+            conn.execute('DELETE FROM shared_events WHERE created_at < ?',
+                         (time.time() - self.RETAIN_SECONDS,))
+        return len(rows)
+
+    # --- Métricas ---
+    def attach_metrics(self, registry):
+        self._registry = registry
+        registry.aggregator = self
+
+    def push_snapshot(self):
+        if self._registry is None or self._worker is None:
+            return
+        self._connection().execute(
+            'INSERT OR REPLACE INTO metric_snapshots (worker, pid, data, updated_at) VALUES (?, ?, ?, ?)',
+            (self._worker, os.getpid(), json.dumps(self._registry.snapshot()), time.time())
+        )
+
+    def collect(self, registry):
+        """
+        Suma de todos los workers. Los contadores e histogramas de workers
+        terminados se acumulan en una fila 'retired'; sus gauges se descartan.
+        """
+        self.ensure_started()
+        self.push_snapshot()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT worker, pid, data FROM metric_snapshots').fetchall()
+            snapshots, dead = [], []
+            for worker, pid, data in rows:
+                alive = worker != 'retired' and _alive(pid)
+                snapshots.append(load_snapshot(json.loads(data), include_gauges=alive))
+                if worker != 'retired' and not alive:
+                    dead.append(worker)
+            if dead:
+                # Fusionar los terminados para que la tabla no crezca con cada reinicio
+                retired, _ = merge_snapshots([
+                    snapshot for (worker, _, _), snapshot in zip(rows, snapshots)
+                    if worker == 'retired' or worker in dead
+                ])
+                conn.executemany('DELETE FROM metric_snapshots WHERE worker = ?', [(w,) for w in dead])
+                conn.execute(
+                    'INSERT OR REPLACE INTO metric_snapshots (worker, pid, data, updated_at) VALUES (?, 0, ?, ?)',
+                    ('retired', json.dumps(dump_snapshot(retired)), time.time())
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return merge_snapshots(snapshots)
+
+    def stats(self):
+        conn = self._connection()
+        workers = conn.execute(
+            "SELECT COUNT(*) FROM metric_snapshots WHERE worker != 'retired'"
+        ).fetchone()[0]
+        return {
+            'path': self.path,
+            'worker': self._worker,
+            'workers_reporting': workers,
+            'sent': self.sent,
+            'applied': self.applied,
+            'errors': self.errors
+        }
+
+
+def after_fork():
+    """Para gunicorn post_fork: conexiones e hilos propios en el worker"""
+    for state in _instances:
+        state.ensure_started()
+
+
+def shutdown():
+    """Para gunicorn worker_exit: última instantánea antes de salir"""
+    for state in _instances:
+        state.close()
+
+
+def reset(path=None):
+    """Para el arranque del maestro: descarta eventos e instantáneas de una ejecución anterior"""
+    conn = connect(path or default_path())
+    try:
+        for table in ('shared_events', 'metric_snapshots', 'shared_meta'):
+            try:
+                conn.execute(f'DELETE FROM {table}')
+            except sqlite3.OperationalError:
+                pass
+    finally:
+        conn.close()
+
+
+def create_shared_state():
+    """None salvo OTP_SHARED_STATE=1"""
+    if os.environ.get('OTP_SHARED_STATE', '0') != '1':
+        return None
+    return SharedState(
+        default_path(),
+        poll_interval=float(os.environ.get('OTP_SHARED_POLL_INTERVAL', 0.2)),
+        snapshot_interval=float(os.environ.get('OTP_SHARED_SNAPSHOT_INTERVAL', 5.0))
+    )
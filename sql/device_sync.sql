@@ -0,0 +1,76 @@
+-- ============================================
+-- Sincronización delta de dispositivos
+-- ============================================
+-- updated_at en cada alta o cambio, un contador de versión por sentencia
+-- (para ETag) y lápidas de los dispositivos borrados.
+--
+-- GET /api/devices lee la versión con
+--   supabase.table('sync_versions').select('version').eq('name', 'devices')
+-- y los cambios con ?updated_since=.
+
+alter table public.devices add column if not exists updated_at timestamptz;
+update public.devices set updated_at = coalesce(last_used, created_at) where updated_at is null;
+create index if not exists idx_devices_updated on public.devices (updated_at);
+
+create table if not exists public.sync_versions (
+    name text primary key,
+    version bigint not null default 0
+);
+insert into public.sync_versions (name, version) values ('devices', 0)
+on conflict (name) do nothing;
+
+create table if not exists public.device_tombstones (
+    name text primary key,
+    deleted_at timestamptz not null default now()
+);
+
+create or replace function public.devices_set_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    if tg_op = 'INSERT' then
+        delete from public.device_tombstones where name = new.name;
+    end if;
+    return new;
+end;
+$$;
+
+create or replace function public.devices_tombstone()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into public.device_tombstones (name, deleted_at)
+    values (old.name, now())
+    on conflict (name) do update set deleted_at = excluded.deleted_at;
+    return old;
+end;
+$$;
+
+-- Una sola subida de versión por sentencia, aunque toque muchas filas
+create or replace function public.devices_bump_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    update public.sync_versions set version = version + 1 where name = 'devices';
+    return null;
+end;
+$$;
+
+drop trigger if exists devices_set_updated_at on public.devices;
+create trigger devices_set_updated_at
+    before insert or update on public.devices
+    for each row execute function public.devices_set_updated_at();
+
+drop trigger if exists devices_tombstone on public.devices;
+create trigger devices_tombstone
+    after delete on public.devices
+    for each row execute function public.devices_tombstone();
+
+drop trigger if exists devices_bump_version on public.devices;
+create trigger devices_bump_version
+    after insert or update or delete on public.devices
+    for each statement execute function public.devices_bump_version();
@@ -0,0 +1,122 @@
+-- ============================================
+-- Conteos de logs por intervalo (minuto, hora, día)
+-- ============================================
+-- Cada inserción en logs suma en log_rollups por (granularidad, intervalo,
+-- log_type, device_name, user_id) con un trigger por sentencia: una
+-- inserción multi-fila del escritor de logs es un solo upsert agrupado.
+-- GET /api/logs/stats consulta con la función log_rollup_counts y nunca
+-- recorre la tabla logs.
+--
+-- Uso desde el cliente:
+--   supabase.rpc('log_rollup_counts', {
+--       'p_granularity': 'hour', 'p_since': '...', 'p_until': '...',
+--       'p_group_by': ['log_type'], 'p_log_type': None,
+--       'p_device_name': None, 'p_user_id': None
+--   }).execute()
+--
+-- Los intervalos usan la hora de logs.timestamp sin zona, igual que
+-- log_rollups.py. Para acotar el tamaño, programar purge_log_rollups (por
+-- ejemplo con pg_cron: select cron.schedule('0 * * * *', 'select public.purge_log_rollups()')).
+
+create table if not exists public.log_rollups (
+    granularity text not null check (granularity in ('minute', 'hour', 'day')),
+    bucket timestamp not null,
+    log_type text not null,
+    device_name text not null default '',
+    user_id text not null default '',
+    count bigint not null default 0,
+    primary key (granularity, bucket, log_type, device_name, user_id)
+);
+
+create or replace function public.logs_rollup()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into public.log_rollups (granularity, bucket, log_type, device_name, user_id, count)
+    select g.granularity,
+           date_trunc(g.granularity, n."timestamp"::timestamp),
+           coalesce(n.log_type, ''),
+           coalesce(n.device_name, ''),
+           coalesce(n.user_id, ''),
+           count(*)
+    from new_rows n
+    cross join (values ('minute'), ('hour'), ('day')) as g(granularity)
+    group by 1, 2, 3, 4, 5
+    on conflict (granularity, bucket, log_type, device_name, user_id)
+    do update set count = public.log_rollups.count + excluded.count;
+    return null;
+end;
+$$;
+
+-- Logs anteriores a la instalación (solo si la tabla está vacía)
+insert into public.log_rollups (granularity, bucket, log_type, device_name, user_id, count)
+select g.granularity,
+       date_trunc(g.granularity, l."timestamp"::timestamp),
+       coalesce(l.log_type, ''),
+       coalesce(l.device_name, ''),
+       coalesce(l.user_id, ''),
+       count(*)
+from public.logs l
+cross join (values ('minute'), ('hour'), ('day')) as g(granularity)
+where not exists (select 1 from public.log_rollups)
+group by 1, 2, 3, 4, 5;
+
+drop trigger if exists logs_rollup on public.logs;
+create trigger logs_rollup
+    after insert on public.logs
+    referencing new table as new_rows
+    for each statement execute function public.logs_rollup();
+
+-- Suma por intervalo y por las dimensiones de p_group_by
+-- (log_type, device_name, user_id); las demás vuelven en null
+create or replace function public.log_rollup_counts(
+    p_granularity text,
+    p_since timestamp default null,
+    p_until timestamp default null,
+    p_group_by text[] default '{}',
+    p_log_type text default null,
+    p_device_name text default null,
+    p_user_id text default null
+)
+returns table (bucket timestamp, log_type text, device_name text, user_id text, count bigint)
+language sql
+stable
+as $$
+    select r.bucket,
+           case when 'log_type' = any(p_group_by) then r.log_type end,
+           case when 'device_name' = any(p_group_by) then r.device_name end,
+           case when 'user_id' = any(p_group_by) then r.user_id end,
+           sum(r.count)::bigint
+    from public.log_rollups r
+    where r.granularity = p_granularity
+      and (p_since is null or r.bucket >= p_since)
+      and (p_until is null or r.bucket < p_until)
+      and (p_log_type is null or r.log_type = p_log_type)
+      and (p_device_name is null or r.device_name = p_device_name)
+      and (p_user_id is null or r.user_id = p_user_id)
+    group by 1, 2, 3, 4
+    order by 1, 2, 3, 4;
+$$;
+
+-- Retención por granularidad (RETENTION_DAYS de log_rollups.py)
+create or replace function public.purge_log_rollups(
+    p_minute_days integer default 7,
+    p_hour_days integer default 400
+)
+returns integer
+language plpgsql
+as $$
+declare
+    v_minute integer;
+    v_hour integer;
+begin
+    delete from public.log_rollups
+    where granularity = 'minute' and bucket < date_trunc('minute', now()::timestamp - make_interval(days => p_minute_days));
+    get diagnostics v_minute = row_count;
+    delete from public.log_rollups
+    where granularity = 'hour' and bucket < date_trunc('hour', now()::timestamp - make_interval(days => p_hour_days));
+    get diagnostics v_hour = row_count;
+    return v_minute + v_hour;
+end;
+$$;
@@ -0,0 +1,28 @@
+-- ============================================
+-- Rotación de secretos TOTP de varios usuarios en una llamada
+-- ============================================
+-- Recibe un arreglo [{user_id, totp_secret, date_totp}] y actualiza solo
+-- esas dos columnas en una sola sentencia. No inserta: un usuario borrado
+-- mientras corre la rotación no se vuelve a crear, y un bloqueo o edición
+-- hecho en ese lapso no se pisa.
+--
+-- Uso desde el cliente:
+--   supabase.rpc('rotate_secrets', {'p_rows': [...]}).execute()
+
+create or replace function public.rotate_secrets(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    v_count integer;
+begin
+    update public.users u
+    set totp_secret = r.totp_secret,
+        date_totp = r.date_totp
+    from jsonb_to_recordset(p_rows) as r(user_id text, totp_secret text, date_totp timestamptz)
+    where u.user_id = r.user_id;
+
+    get diagnostics v_count = row_count;
+    return v_count;
+end;
+$$;
@@ -0,0 +1,26 @@
+-- ============================================
+-- Último uso de varios dispositivos en una llamada
+-- ============================================
+-- Recibe un arreglo [{name, last_used, ip_address}] y actualiza todas las
+-- filas en una sola sentencia. Una IP nula conserva la anterior.
+--
+-- Uso desde el cliente:
+--   supabase.rpc('touch_devices', {'p_rows': [...]}).execute()
+
+create or replace function public.touch_devices(p_rows jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    v_count integer;
+begin
+    update public.devices d
+    set last_used = r.last_used,
+        ip_address = coalesce(r.ip_address, d.ip_address)
+    from jsonb_to_recordset(p_rows) as r(name text, last_used timestamptz, ip_address text)
+    where d.name = r.name;
+
+    get diagnostics v_count = row_count;
+    return v_count;
+end;
+$$;
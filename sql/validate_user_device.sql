@@ -0,0 +1,29 @@
+-- ============================================
+-- Validación combinada Usuario + Dispositivo
+-- ============================================
+-- Devuelve en una sola llamada el usuario (estado + secreto TOTP) y el
+-- dispositivo (estado). Es solo lectura: last_used / ip_address se
+-- actualizan después de verificar el OTP (touch_devices.sql), nunca con un
+-- intento incorrecto, repetido o limitado.
+--
+-- Uso desde el cliente:
+--   supabase.rpc('validate_user_device', {
+--       'p_user_id': ..., 'p_device_name': ...
+--   }).execute()
+
+-- Versión anterior, que podía actualizar el dispositivo antes de validar
+drop function if exists public.validate_user_device(text, text, text, boolean);
+
+create or replace function public.validate_user_device(
+    p_user_id text,
+    p_device_name text
+)
+returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'user', (select to_jsonb(u) from public.users u where u.user_id = p_user_id limit 1),
+        'device', (select to_jsonb(d) from public.devices d where d.name = p_device_name limit 1)
+    );
+$$;
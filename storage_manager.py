@@ -1,24 +1,719 @@
-from database import conn, cursor
+"""
+Capa de almacenamiento: interfaz única para usuarios, dispositivos y logs
+con tres backends intercambiables
+
+    OTP_STORAGE=supabase  (por defecto) tablas de Supabase
+    OTP_STORAGE=sqlite    base local bd_nr.py (OTP_SQLITE_FILE)
+    OTP_STORAGE=memory    diccionarios en proceso, sin red ni disco
+"""
+
+import copy
+import os
+import threading
+from collections import deque
 from datetime import datetime
 
-# Agregar dispositivo
-def add_device(name, otp):
-    cursor.execute("INSERT INTO devices (name, otp) VALUES (?, ?)", (name, otp))
-    conn.commit()
-
-# Obtener todos los dispositivos
-def get_devices():
-    cursor.execute("SELECT * FROM devices")
-    return cursor.fetchall()
-
-# Agregar log
-def add_log(device_name, app_name):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    cursor.execute("INSERT INTO logs (device_name, event_time, app_name) VALUES (?, ?, ?)",
-                   (device_name, now, app_name))
-    conn.commit()
-
-# Obtener logs
-def get_logs():
-    cursor.execute("SELECT * FROM logs")
-    return cursor.fetchall()
+from pagination import PAGE_KEYS
+from app_logging import get_logger
+from log_rollups import LogRollup, aggregate, bucket_of, rollup_key
+
+log = get_logger('storage')
+
+# Columnas de usuario que se pueden listar sin exponer el secreto TOTP
+USER_PUBLIC_COLUMNS = ('user_id', 'full_name', 'email', 'cedula', 'status_user', 'created_at')
+
+# Códigos de PostgREST / PostgreSQL para objetos que no existen en la base
+MISSING_FUNCTION = ('PGRST202', '42883')
+MISSING_TABLE = ('PGRST205', '42P01')
+
+
+def _project(row, columns):
+    if columns is None:
+        return row
+    return {col: row.get(col) for col in columns}
+
+
+def _missing(error, codes=MISSING_FUNCTION):
+    """True si el error de PostgREST indica que la función (o tabla) no está instalada"""
+    return getattr(error, 'code', None) in codes
+
+
+def _quoted(value):
+    """Valor entre comillas para un filtro or=(...) de PostgREST"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _page_key(table, row):
+    """Clave de orden descendente con los nulos al final, como en SQL"""
+    sort_col, tie_col = PAGE_KEYS[table]
+    value = row.get(sort_col)
+    return (value is not None, value or '', row.get(tie_col))
+
+
+class Storage:
+    """Interfaz común. Los backends devuelven filas como dict, igual que Supabase."""
+
+    name = 'base'
+
+    # --- Usuarios ---
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def get_users(self, user_ids):
+        """Filas de varios user_id en una operación; los que no existen se omiten"""
+        return [user for user in map(self.get_user, user_ids) if user]
+
+    def list_users(self, columns=None, active_only=False):
+        raise NotImplementedError
+
+    def insert_user(self, user):
+        raise NotImplementedError
+
+    def insert_users(self, users):
+        """
+        Inserción multi-fila. Si falla, no se inserta ninguna fila del lote
+        (el llamador puede reintentar fila por fila).
+        """
+        return [self.insert_user(user) for user in users]
+
+    def update_user(self, user_id, values):
+        """Retorna la fila actualizada o None si no existe"""
+        raise NotImplementedError
+
+    def list_stale_users(self, cutoff, after=None, limit=500):
+        """
+        Usuarios activos con date_totp <= cutoff o sin fecha, ordenados por
+        user_id y a partir de after (paginación por clave).
+        """
+        raise NotImplementedError
+
+    def rotate_secrets(self, rotations):
+        """Escritura por lotes de [{user_id, totp_secret, date_totp}]"""
+        raise NotImplementedError
+
+    # --- Dispositivos ---
+    def get_device(self, name):
+        raise NotImplementedError
+
+    def get_devices(self, names):
+        """Filas de varios dispositivos en una operación; los que no existen se omiten"""
+        return [device for device in map(self.get_device, names) if device]
+
+    def list_devices(self):
+        """Todos los dispositivos, más recientes primero"""
+        raise NotImplementedError
+
+    def insert_device(self, device):
+        raise NotImplementedError
+
+    def update_device(self, name, values):
+        """Retorna la fila actualizada o None si no existe"""
+        raise NotImplementedError
+
+    def delete_device(self, name):
+        """True si existía"""
+        raise NotImplementedError
+
+    def device_version(self):
+        """Contador que cambia con cada alta, cambio o borrado; None si no hay"""
+        return None
+
+    def list_devices_since(self, since):
+        """
+        Dispositivos con updated_at >= since y lápidas [{name, deleted_at}]
+        de los borrados desde entonces
+        """
+        raise NotImplementedError
+
+    def touch_devices(self, rows):
+        """Escritura por lotes de [{name, last_used, ip_address}]; IP nula conserva la anterior"""
+        for row in rows:
+            values = {'last_used': row['last_used']}
+            if row.get('ip_address'):
+                values['ip_address'] = row['ip_address']
+            self.update_device(row['name'], values)
+
+    # --- Logs ---
+    def insert_logs(self, rows):
+        raise NotImplementedError
+
+    def list_logs(self, limit=100):
+        """Últimos logs, más recientes primero"""
+        raise NotImplementedError
+
+    def log_rollup(self, granularity, since=None, until=None, group_by=(), filters=None):
+        """
+        Conteos de logs por intervalo (minute, hour o day) con since <= bucket <
+        until, sumados por las dimensiones de group_by y filtrados por
+        {dimensión: valor}. Filas {bucket, log_type, device_name, user_id, count}
+        según log_rollups.py.
+        """
+        raise NotImplementedError
+
+    # --- Paginación ---
+    def list_page(self, table, after=None, limit=100, columns=None):
+        """
+        Página por cursor (keyset) de users, devices o logs en el orden de
+        pagination.PAGE_KEYS. after es la clave (valor, desempate) de la última
+        fila ya entregada.
+        """
+        raise NotImplementedError
+
+    # --- Validación combinada ---
+    def validate_user_device(self, user_id, device_name):
+        """
+        Usuario y dispositivo en una sola operación cuando el backend lo permite.
+        Solo lectura: el dispositivo se actualiza tras verificar el OTP.
+        Retorna: (user, device)
+        """
+        return self.get_user(user_id), self.get_device(device_name)
+
+
+class SupabaseStorage(Storage):
+    """Tablas users, devices y logs en Supabase"""
+
+    name = 'supabase'
+
+    # Valores por consulta in (...)
+    IN_CHUNK = 100
+    # Filas por página al contar logs sin log_rollups (máximo de PostgREST por defecto)
+    SCAN_PAGE = 1000
+
+    def __init__(self, client=None, use_rpc=True, client_factory=None):
+        # Con client_factory el cliente (y el paquete supabase) se carga en el
+        # primer uso: el arranque no paga su importación ni su construcción
+        self._client = client
+        self._client_factory = client_factory
+        self._client_lock = threading.Lock()
+        self.use_rpc = use_rpc
+        self.use_touch_rpc = use_rpc
+        self.use_rollup_rpc = True
+        self.use_rotate_rpc = True
+        self.use_device_sync = True
+
+    @property
+    def client(self):
+        client = self._client
+        if client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._client_factory()
+                client = self._client
+        return client
+
+    def _first(self, response):
+        rows = response.data or []
+        return rows[0] if rows else None
+
+    def get_user(self, user_id):
+        return self._first(
+            self.client.table("users").select("*").eq("user_id", user_id).limit(1).execute()
+        )
+
+    def _in(self, table, column, values):
+        """Filas con column in (...), en tramos para no exceder el largo de la URL"""
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), self.IN_CHUNK):
+            rows.extend(
+                self.client.table(table).select('*')
+                .in_(column, values[start:start + self.IN_CHUNK])
+                .execute().data or []
+            )
+        return rows
+
+    def get_users(self, user_ids):
+        return self._in('users', 'user_id', user_ids)
+
+    def list_users(self, columns=None, active_only=False):
+        query = self.client.table("users").select(', '.join(columns) if columns else "*")
+        if active_only:
+            query = query.neq("status_user", False)
+        return query.execute().data or []
+
+    def insert_user(self, user):
+        return self._first(self.client.table('users').insert(user).execute())
+
+    def insert_users(self, users):
+        return self.client.table('users').insert(users).execute().data or []
+
+    def update_user(self, user_id, values):
+        return self._first(
+            self.client.table('users').update(values).eq('user_id', user_id).execute()
+        )
+
+    def list_stale_users(self, cutoff, after=None, limit=500):
+        query = self.client.table('users')\
+            .select('*')\
+            .neq('status_user', False)\
+            .or_(f'date_totp.is.null,date_totp.lte."{cutoff}"')
+        if after is not None:
+            query = query.gt('user_id', after)
+        return query.order('user_id').limit(limit).execute().data or []
+
+    def rotate_secrets(self, rotations):
+        """
+        Una llamada vía RPC (sql/rotate_secrets.sql). Solo se envían user_id,
+        totp_secret y date_totp: nunca se reescriben otras columnas ni se
+        insertan usuarios borrados durante la rotación.
+        """
+        rows = [
+            {'user_id': r['user_id'], 'totp_secret': r['totp_secret'], 'date_totp': r['date_totp']}
+            for r in rotations
+        ]
+        if self.use_rotate_rpc:
+            try:
+                self.client.rpc('rotate_secrets', {'p_rows': rows}).execute()
+                return
+            except Exception as e:
+                if not _missing(e):
+                    raise
+                log.warning("RPC rotate_secrets no disponible", extra={'error': str(e)})
+                self.use_rotate_rpc = False
+        for row in rows:
+            self.client.table('users')\
+                .update({'totp_secret': row['totp_secret'], 'date_totp': row['date_totp']})\
+                .eq('user_id', row['user_id'])\
+                .execute()
+
+    def get_device(self, name):
+        return self._first(
+            self.client.table("devices").select("*").eq("name", name).limit(1).execute()
+        )
+
+    def get_devices(self, names):
+        return self._in('devices', 'name', names)
+
+    def list_devices(self):
+        return self.client.table('devices')\
+            .select('*')\
+            .order('created_at', desc=True)\
+            .execute().data or []
+
+    def insert_device(self, device):
+        return self._first(self.client.table("devices").insert(device).execute())
+
+    def update_device(self, name, values):
+        return self._first(
+            self.client.table('devices').update(values).eq('name', name).execute()
+        )
+
+    def delete_device(self, name):
+        return bool(self.client.table('devices').delete().eq('name', name).execute().data)
+
+    def device_version(self):
+        """Tabla sync_versions (sql/device_sync.sql)"""
+        if not self.use_device_sync:
+            return None
+        try:
+            row = self._first(
+                self.client.table('sync_versions').select('version').eq('name', 'devices').execute()
+            )
+            return row['version'] if row else None
+        except Exception as e:
+            # Sin la tabla se deja de consultar; ante un error pasajero solo
+            # esta respuesta sale sin ETag
+            log.warning("sync_versions no disponible", extra={'error': str(e)})
+            if _missing(e, MISSING_TABLE):
+                self.use_device_sync = False
+            return None
+
+    def list_devices_since(self, since):
+        devices = self.client.table('devices')\
+            .select('*')\
+            .gte('updated_at', since)\
+            .order('updated_at')\
+            .execute().data or []
+        tombstones = self.client.table('device_tombstones')\
+            .select('name, deleted_at')\
+            .gte('deleted_at', since)\
+            .order('deleted_at')\
+            .execute().data or []
+        return devices, tombstones
+
+    def touch_devices(self, rows):
+        """Una llamada vía RPC (sql/touch_devices.sql)"""
+        if self.use_touch_rpc:
+            try:
+                self.client.rpc('touch_devices', {'p_rows': rows}).execute()
+                return
+            except Exception as e:
+                # Un error pasajero se propaga: el coalescedor repone las filas
+                if not _missing(e):
+                    raise
+                log.warning("RPC touch_devices no disponible", extra={'error': str(e)})
+                self.use_touch_rpc = False
+        super().touch_devices(rows)
+
+    def insert_logs(self, rows):
+        self.client.table("logs").insert(rows).execute()
+
+    def list_logs(self, limit=100):
+        return self.client.table('logs')\
+            .select('*')\
+            .order('timestamp', desc=True)\
+            .limit(limit)\
+            .execute().data or []
+
+    def log_rollup(self, granularity, since=None, until=None, group_by=(), filters=None):
+        """Una llamada vía RPC (sql/log_rollups.sql)"""
+        filters = filters or {}
+        if self.use_rollup_rpc:
+            try:
+                return self.client.rpc('log_rollup_counts', {
+                    'p_granularity': granularity,
+                    'p_since': since,
+                    'p_until': until,
+                    'p_group_by': list(group_by),
+                    'p_log_type': filters.get('log_type'),
+                    'p_device_name': filters.get('device_name'),
+                    'p_user_id': filters.get('user_id')
+                }).execute().data or []
+            except Exception as e:
+                # Sin las tablas de resumen: contar sobre los logs del rango.
+                # Otros errores (timeouts, red) se propagan: recorrer los logs
+                # crudos es justo lo que log_rollups evita.
+                if not _missing(e):
+                    raise
+                log.warning("RPC log_rollup_counts no disponible", extra={'error': str(e)})
+                self.use_rollup_rpc = False
+        return self._scan_log_rollup(granularity, since, until, group_by, filters)
+
+    def _scan_log_rollup(self, granularity, since, until, group_by, filters):
+        entries = []
+        offset = 0
+        while True:
+            query = self.client.table('logs').select('timestamp, log_type, device_name, user_id')
+            if since is not None:
+                query = query.gte('timestamp', since)
+            if until is not None:
+                query = query.lt('timestamp', until)
+            for dim, value in filters.items():
+                query = query.eq(dim, value)
+            rows = query.order('timestamp').range(offset, offset + self.SCAN_PAGE - 1).execute().data or []
+            entries.extend(
+                (bucket_of(row['timestamp'], granularity), rollup_key(row), 1) for row in rows
+            )
+            if len(rows) < self.SCAN_PAGE:
+                break
+            offset += len(rows)
+        return aggregate(entries, group_by)
+
+    def list_page(self, table, after=None, limit=100, columns=None):
+        sort_col, tie_col = PAGE_KEYS[table]
+        query = self.client.table(table).select(', '.join(columns) if columns else '*')
+        if after is not None:
+            value, tie = after
+            if value is None:
+                query = query.is_(sort_col, 'null').lt(tie_col, tie)
+            else:
+                value, tie = _quoted(value), _quoted(tie)
+                query = query.or_(
+                    f'{sort_col}.lt.{value},{sort_col}.is.null,'
+                    f'and({sort_col}.eq.{value},{tie_col}.lt.{tie})'
+                )
+        return query\
+            .order(sort_col, desc=True, nullsfirst=False)\
+            .order(tie_col, desc=True)\
+            .limit(limit)\
+            .execute().data or []
+
+    def validate_user_device(self, user_id, device_name):
+        """Una sola llamada vía RPC (sql/validate_user_device.sql)"""
+        if self.use_rpc:
+            try:
+                response = self.client.rpc('validate_user_device', {
+                    'p_user_id': user_id,
+                    'p_device_name': device_name
+                }).execute()
+                result = response.data or {}
+                return result.get('user'), result.get('device')
+            except Exception as e:
+                # La función no existe en esta base: volver a las lecturas separadas.
+                # Un error pasajero se propaga y la próxima validación reintenta la RPC.
+                if not _missing(e):
+                    raise
+                log.warning("RPC validate_user_device no disponible", extra={'error': str(e)})
+                self.use_rpc = False
+        return super().validate_user_device(user_id, device_name)
+
+
+class SQLiteStorage(Storage):
+    """Base local SQLite (bd_nr.py)"""
+
+    name = 'sqlite'
+
+    def __init__(self, db_file=None):
+        import bd_nr
+        if db_file and db_file != bd_nr.DB_FILE:
+            bd_nr.configure(db_file)
+        self.db = bd_nr
+
+    def get_user(self, user_id):
+        return self.db.get_user_db(user_id)
+
+    def get_users(self, user_ids):
+        return self.db.get_users_db(user_ids)
+
+    def list_users(self, columns=None, active_only=False):
+        return [_project(user, columns) for user in self.db.list_users_db(active_only)]
+
+    def insert_user(self, user):
+        return self.db.insert_user_db(user)
+
+    def insert_users(self, users):
+        return self.db.insert_users_db(users)
+
+    def update_user(self, user_id, values):
+        return self.db.update_user_db(user_id, values)
+
+    def list_stale_users(self, cutoff, after=None, limit=500):
+        return self.db.list_stale_users_db(cutoff, after, limit)
+
+    def rotate_secrets(self, rotations):
+        self.db.rotate_secrets_db(rotations)
+
+    def get_device(self, name):
+        return self.db.get_device_by_name_db(name)
+
+    def get_devices(self, names):
+        return self.db.get_devices_by_name_db(names)
+
+    def list_devices(self):
+        return self.db.list_device_rows_db()
+
+    def insert_device(self, device):
+        return self.db.insert_device_row_db(device)
+
+    def update_device(self, name, values):
+        return self.db.update_device_by_name_db(name, values)
+
+    def delete_device(self, name):
+        return self.db.delete_device_by_name_db(name)
+
+    def device_version(self):
+        return self.db.device_version_db()
+
+    def list_devices_since(self, since):
+        return self.db.list_devices_since_db(since)
+
+    def touch_devices(self, rows):
+        self.db.touch_devices_db(rows)
+
+    def insert_logs(self, rows):
+        self.db.add_logs_db(rows)
+
+    def log_rollup(self, granularity, since=None, until=None, group_by=(), filters=None):
+        return self.db.log_rollup_db(granularity, since, until, group_by, filters)
+
+    def list_logs(self, limit=100):
+        return self.db.list_logs_db(limit)
+
+    def list_page(self, table, after=None, limit=100, columns=None):
+        rows = self.db.list_page_db(table, after, limit)
+        return [_project(row, columns) for row in rows]
+
+    def validate_user_device(self, user_id, device_name):
+        return self.db.validate_user_device_db(user_id, device_name)
+
+
+class MemoryStorage(Storage):
+    """Diccionarios en proceso; para sitios sin red y benchmarks"""
+
+    name = 'memory'
+
+    def __init__(self, log_retention=None):
+        if log_retention is None:
+            log_retention = int(os.environ.get('OTP_LOG_RETENTION', 50))
+        self._lock = threading.Lock()
+        self.users = {}
+        self.devices = {}
+        # Buffer circular: descartar el log más antiguo es O(1)
+        self.logs = deque(maxlen=log_retention or None)
+        # Los conteos sobreviven a la retención del buffer
+        self.rollup = LogRollup()
+        self.tombstones = {}
+        self.devices_version = 0
+        self._next_id = 1
+
+    def _take_id(self):
+        value = self._next_id
+        self._next_id += 1
+        return value
+
+    def get_user(self, user_id):
+        with self._lock:
+            return copy.deepcopy(self.users.get(user_id))
+
+    def get_users(self, user_ids):
+        with self._lock:
+            return copy.deepcopy([self.users[u] for u in user_ids if u in self.users])
+
+    def list_users(self, columns=None, active_only=False):
+        with self._lock:
+            users = [u for u in self.users.values() if not active_only or u.get('status_user')]
+            return [_project(copy.deepcopy(u), columns) for u in users]
+
+    def insert_user(self, user):
+        with self._lock:
+            if user['user_id'] in self.users:
+                raise ValueError(f"El usuario {user['user_id']} ya existe")
+            self.users[user['user_id']] = dict(user)
+            return copy.deepcopy(self.users[user['user_id']])
+
+    def insert_users(self, users):
+        with self._lock:
+            ids = [user['user_id'] for user in users]
+            existing = [user_id for user_id in ids if user_id in self.users]
+            if existing or len(set(ids)) != len(ids):
+                raise ValueError(f"Usuarios duplicados: {', '.join(existing) or 'en el lote'}")
+            for user in users:
+                self.users[user['user_id']] = dict(user)
+            return [copy.deepcopy(self.users[user_id]) for user_id in ids]
+
+    def update_user(self, user_id, values):
+        with self._lock:
+            user = self.users.get(user_id)
+            if user is None:
+                return None
+            user.update(values)
+            return copy.deepcopy(user)
+
+    def list_stale_users(self, cutoff, after=None, limit=500):
+        with self._lock:
+            users = [
+                u for u in self.users.values()
+                if u.get('status_user') and (not u.get('date_totp') or u['date_totp'] <= cutoff)
+                and (after is None or u['user_id'] > after)
+            ]
+            users.sort(key=lambda u: u['user_id'])
+            return copy.deepcopy(users[:limit])
+
+    def rotate_secrets(self, rotations):
+        with self._lock:
+            for rotation in rotations:
+                user = self.users.get(rotation['user_id'])
+                if user is not None:
+                    user['totp_secret'] = rotation['totp_secret']
+                    user['date_totp'] = rotation['date_totp']
+
+    def get_device(self, name):
+        with self._lock:
+            return copy.deepcopy(self.devices.get(name))
+
+    def get_devices(self, names):
+        with self._lock:
+            return copy.deepcopy([self.devices[n] for n in names if n in self.devices])
+
+    def list_devices(self):
+        with self._lock:
+            devices = copy.deepcopy(list(self.devices.values()))
+        devices.sort(key=lambda d: d.get('created_at') or '', reverse=True)
+        return devices
+
+    def insert_device(self, device):
+        with self._lock:
+            if device['name'] in self.devices:
+                raise ValueError(f"El dispositivo {device['name']} ya existe")
+            row = {'id': self._take_id(), 'last_used': None, 'ip_address': None}
+            row.update(device)
+            row.setdefault('created_at', datetime.now().isoformat())
+            self._device_changed(row)
+            self.tombstones.pop(device['name'], None)
+            self.devices[device['name']] = row
+            return copy.deepcopy(row)
+
+    def _device_changed(self, device):
+        device['updated_at'] = datetime.now().isoformat()
+        self.devices_version += 1
+
+    def update_device(self, name, values):
+        with self._lock:
+            device = self.devices.get(name)
+            if device is None:
+                return None
+            device.update(values)
+            self._device_changed(device)
+            return copy.deepcopy(device)
+
+    def delete_device(self, name):
+        with self._lock:
+            if self.devices.pop(name, None) is None:
+                return False
+            self.tombstones[name] = datetime.now().isoformat()
+            self.devices_version += 1
+            return True
+
+    def device_version(self):
+        with self._lock:
+            return self.devices_version
+
+    def list_devices_since(self, since):
+        with self._lock:
+            devices = [d for d in self.devices.values() if (d.get('updated_at') or '') >= since]
+            tombstones = [{'name': name, 'deleted_at': deleted_at}
+                          for name, deleted_at in self.tombstones.items() if deleted_at >= since]
+        devices = copy.deepcopy(devices)
+        devices.sort(key=lambda d: d['updated_at'])
+        tombstones.sort(key=lambda t: t['deleted_at'])
+        return devices, tombstones
+
+    def insert_logs(self, rows):
+        with self._lock:
+            for row in rows:
+                log = dict(row)
+                log['id'] = self._take_id()
+                self.logs.append(log)
+        self.rollup.add(rows)
+
+    def list_logs(self, limit=100):
+        with self._lock:
+            logs = copy.deepcopy(list(self.logs))
+        logs.sort(key=lambda l: (l.get('timestamp') or '', l['id']), reverse=True)
+        return logs[:limit]
+
+    def log_rollup(self, granularity, since=None, until=None, group_by=(), filters=None):
+        return self.rollup.query(granularity, since, until, group_by, filters)
+
+    def list_page(self, table, after=None, limit=100, columns=None):
+        with self._lock:
+            source = {'users': self.users.values(), 'devices': self.devices.values(),
+                      'logs': self.logs}[table]
+            rows = list(source)
+        if after is not None:
+            bound = _page_key(table, dict(zip(PAGE_KEYS[table], after)))
+            rows = [row for row in rows if _page_key(table, row) < bound]
+        rows.sort(key=lambda row: _page_key(table, row), reverse=True)
+        return [_project(copy.deepcopy(row), columns) for row in rows[:limit]]
+
+    def validate_user_device(self, user_id, device_name):
+        with self._lock:
+            return copy.deepcopy(self.users.get(user_id)), copy.deepcopy(self.devices.get(device_name))
+
+
+def create_storage(backend=None):
+    """Crea el backend indicado (o el de OTP_STORAGE)"""
+    backend = (backend or os.environ.get('OTP_STORAGE', 'supabase')).lower()
+
+    if backend == 'supabase':
+        url = os.environ.get('SUPABASE_URL')
+        key = os.environ.get('SUPABASE_KEY')
+        if not url or not key:
+            raise ValueError("SUPABASE_URL y SUPABASE_KEY deben estar configuradas")
+
+        def connect():
+            from supabase import create_client
+            return create_client(url, key)
+
+        return SupabaseStorage(
+            use_rpc=os.environ.get('OTP_VALIDATION_RPC', '1') == '1',
+            client_factory=connect
+        )
+
+    if backend == 'sqlite':
+        return SQLiteStorage(os.environ.get('OTP_SQLITE_FILE'))
+
+    if backend == 'memory':
+        return MemoryStorage()
+
+    raise ValueError(f"OTP_STORAGE desconocido: {backend}")
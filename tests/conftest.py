@@ -0,0 +1,26 @@
+import os
+import sys
+
+# Los módulos viven en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# api_server se importa con almacenamiento en memoria y sin estado compartido
+os.environ.setdefault('OTP_STORAGE', 'memory')
+os.environ.setdefault('OTP_SHARED_STATE', '0')
+os.environ.setdefault('OTP_LOG_LEVEL', 'ERROR')
+
+
+class Clock:
+    """Reloj manual para los límites y los códigos usados"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
@@ -0,0 +1,89 @@
+import itertools
+
+import pyotp
+import pytest
+
+import api_server
+from rate_limiter import RateLimiter
+
+_ids = itertools.count()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Orden de las llamadas a límites, almacenamiento y códigos usados"""
+    calls = []
+
+    def spy(owner, name):
+        original = getattr(owner, name)
+
+        def wrapper(arg, *rest):
+            calls.append((name, list(arg)))
+            return original(arg, *rest)
+        monkeypatch.setattr(owner, name, wrapper)
+
+    limiter = RateLimiter(limits={'user': (2, 5), 'device': (100, 100), 'ip': (100, 100)})
+    monkeypatch.setattr(api_server, 'rate_limiter', limiter)
+    for owner, name in ((limiter, 'check_many'), (limiter, 'record_many'),
+                        (api_server.storage, 'get_users'), (api_server.storage, 'get_devices'),
+                        (api_server.replay_guard, 'claim_many')):
+        spy(owner, name)
+    return calls
+
+
+@pytest.fixture
+def account():
+    """Usuario y dispositivo nuevos (las cachés son del módulo)"""
+    n = next(_ids)
+    secret = pyotp.random_base32()
+    user_id, device_name = f'lote{n}', f'lote-disp{n}'
+    api_server.storage.insert_user({'user_id': user_id, 'full_name': 'Lote', 'email': f'{user_id}@x',
+                                    'cedula': str(n), 'totp_secret': secret, 'status_user': True})
+    api_server.storage.insert_device({'name': device_name, 'enabled': True})
+    return user_id, device_name, pyotp.TOTP(secret)
+
+
+def _post(items, ip='10.0.0.1'):
+    client = api_server.app.test_client()
+    response = client.post('/api/validate_totp/batch', json={'items': items},
+                           environ_base={'REMOTE_ADDR': ip})
+    assert response.status_code == 200
+    return response.json['results']
+
+
+def _names(calls):
+    return [name for name, _ in calls]
+
+
+def test_limiter_runs_before_storage_and_replay(calls, account):
+    user_id, device_name, totp = account
+    results = _post([{'user_id': user_id, 'device_name': device_name, 'otp': totp.now()}])
+    assert results[0]['status'] == 200
+    assert _names(calls) == ['check_many', 'get_users', 'get_devices', 'claim_many', 'record_many']
+
+
+def test_limited_items_skip_storage_and_keep_their_code(calls, account):
+    user_id, device_name, totp = account
+    item = {'user_id': user_id, 'device_name': device_name, 'otp': '000000'}
+    valid = {'user_id': user_id, 'device_name': device_name, 'otp': totp.now()}
+    assert [r['status'] for r in _post([item, item, valid])] == [401, 401, 429]
+
+    # Solo los dos admitidos llegan al almacenamiento; el código válido no se reclama
+    assert dict(calls)['get_users'] == [user_id]
+    assert 'claim_many' not in _names(calls)
+    assert len(dict(calls)['record_many']) == 2
+
+    calls.clear()
+    assert [r['status'] for r in _post([valid])] == [429]
+    assert _names(calls) == ['check_many']
+
+
+def test_item_ip_does_not_choose_the_rate_limit_key(calls, monkeypatch, account):
+    user_id, device_name, _ = account
+    limiter = api_server.rate_limiter
+    monkeypatch.setattr(limiter, 'limits', dict(limiter.limits, user=(100, 100), ip=(2, 100)))
+    items = [{'user_id': user_id, 'device_name': device_name, 'otp': '000000',
+              'ip_address': f'192.0.2.{i}'} for i in range(3)]
+    assert [r['status'] for r in _post(items, ip='10.0.0.9')] == [401, 401, 429]
+    key_sets = dict(calls)['check_many']
+    assert {key for keys in key_sets for key in keys if key[0] == 'ip'} == {('ip', '10.0.0.9')}
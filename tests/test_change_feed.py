@@ -0,0 +1,151 @@
+import base64
+
+import pytest
+
+from change_feed import ChangeFeed
+from pagination import InvalidCursor, decode_cursor, encode_cursor, split_page
+
+
+def _seq(cursor):
+    return int(cursor.rpartition('-')[2])
+
+
+def test_read_without_cursor_starts_now():
+    feed = ChangeFeed()
+    feed.publish('device', [{'name': 'd1'}])
+    events, cursor, reset = feed.read(None)
+    assert (events, reset) == ([], False)
+    assert cursor == f'{feed.epoch}-1'
+
+
+def test_read_returns_only_newer_events():
+    feed = ChangeFeed()
+    _, cursor, _ = feed.read(None)
+    feed.publish('device', [{'name': 'd1'}, {'name': 'd2'}])
+    feed.publish('log', [{'id': 1}])
+    events, cursor, reset = feed.read(cursor)
+    assert not reset
+    assert [(e['seq'], e['type']) for e in events] == [(1, 'device'), (2, 'device'), (3, 'log')]
+    assert feed.read(cursor) == ([], cursor, False)
+
+
+def test_read_filters_kinds_and_limits():
+    feed = ChangeFeed()
+    start = feed.cursor()
+    feed.publish('device', [{'name': 'd1'}])
+    feed.publish('log', [{'id': i} for i in range(3)])
+    events, cursor, _ = feed.read(start, kinds={'log'}, limit=2)
+    assert [e['data'] for e in events] == [{'id': 0}, {'id': 1}]
+    # El cursor avanza hasta el último evento entregado
+    assert _seq(cursor) == 3
+    events, _, _ = feed.read(cursor, kinds={'log'})
+    assert [e['data'] for e in events] == [{'id': 2}]
+
+
+@pytest.mark.parametrize('cursor', ['otraepoca-0', 'basura', '-', 'x-1a'])
+def test_foreign_or_invalid_cursor_resets(cursor):
+    feed = ChangeFeed()
+    feed.publish('device', [{'name': 'd1'}])
+    events, new_cursor, reset = feed.read(cursor)
+    assert (events, reset) == ([], True)
+    assert new_cursor == feed.cursor()
+
+
+def test_cursor_older_than_buffer_resets():
+    feed = ChangeFeed(maxlen=3)
+    feed.publish('log', [{'id': i} for i in range(1, 6)])
+    # Quedan 3, 4 y 5: desde 2 el buffer está completo, desde 1 no
+    events, _, reset = feed.read(feed.cursor(2))
+    assert not reset
+    assert [e['seq'] for e in events] == [3, 4, 5]
+    assert feed.read(feed.cursor(1)) == ([], feed.cursor(), True)
+
+
+def test_future_cursor_resets_in_local_mode():
+    feed = ChangeFeed()
+    feed.publish('log', [{'id': 1}])
+    assert feed.read(feed.cursor(5)) == ([], feed.cursor(), True)
+
+
+def test_reset_after_fork_changes_epoch():
+    feed = ChangeFeed()
+    feed.publish('log', [{'id': 1}])
+    cursor = feed.cursor()
+    feed._reset()
+    assert feed.read(cursor)[2] is True
+    assert feed.stats()['seq'] == 0
+
+
+def test_shared_mode_follows_global_sequence():
+    published = []
+    feed = ChangeFeed()
+    feed.on_publish = lambda kind, rows: published.append((kind, rows))
+    feed.follow('compartida', 10)
+
+    # Lo propio sale a shared_events y entra al volver con su número global
+    feed.publish('device', [{'name': 'd1'}])
+    assert published == [('device', [{'name': 'd1'}])]
+    assert feed.stats()['seq'] == 10
+
+    feed.append(11, 'device', {'name': 'd1'})
+    feed.append(11, 'device', {'name': 'repetido'})
+    feed.append(12, 'log', {'id': 1})
+    events, cursor, reset = feed.read('compartida-10')
+    assert not reset
+    assert [(e['seq'], e['data']) for e in events] == [(11, {'name': 'd1'}), (12, {'id': 1})]
+    assert cursor == 'compartida-12'
+
+
+def test_shared_mode_accepts_cursor_from_another_worker():
+    feed = ChangeFeed()
+    feed.follow('compartida', 10)
+    feed.append(11, 'log', {'id': 1})
+    # Otro worker ya entregó hasta 15: este aún no los tiene, sin reset
+    assert feed.read('compartida-15') == ([], 'compartida-15', False)
+    # Un cursor anterior a follow() no se puede completar
+    assert feed.read('compartida-9')[2] is True
+
+
+def test_wait_returns_when_event_arrives():
+    feed = ChangeFeed()
+    cursor = feed.cursor()
+    feed.wait(cursor, timeout=0.01)
+    feed.publish('log', [{'id': 1}])
+    feed.wait(cursor, timeout=5)
+    assert len(feed.read(cursor)[0]) == 1
+
+
+def test_page_cursor_round_trip():
+    row = {'created_at': '2024-05-01T10:00:00+00:00', 'user_id': "o'brien,)"}
+    cursor = encode_cursor('users', row)
+    assert '=' not in cursor
+    assert decode_cursor('users', cursor) == ('2024-05-01T10:00:00+00:00', "o'brien,)")
+    assert decode_cursor('logs', encode_cursor('logs', {'timestamp': None, 'id': 7})) == (None, 7)
+    assert decode_cursor('users', None) is None
+
+
+def _raw(value):
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('table, cursor', [
+    ('users', '%%%'),
+    ('users', _raw('{"a": 1}')),
+    ('users', _raw('["2024-05-01"]')),
+    ('users', _raw('["no es fecha", "u1"]')),
+    ('users', _raw('["2024-05-01", 5]')),
+    ('devices', _raw('["2024-05-01", null]')),
+    ('logs', _raw('["2024-05-01", "1) or (1=1"]')),
+    ('logs', _raw('["2024-05-01", true]')),
+])
+def test_invalid_page_cursor(table, cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(table, cursor)
+
+
+def test_split_page():
+    rows = [{'created_at': f'2024-05-0{i}', 'name': f'd{i}'} for i in (3, 2, 1)]
+    page, cursor = split_page('devices', rows, 2)
+    assert page == rows[:2]
+    assert decode_cursor('devices', cursor) == ('2024-05-02', 'd2')
+    assert split_page('devices', rows, 3) == (rows, None)
@@ -0,0 +1,145 @@
+import pytest
+
+from rate_limiter import RateLimiter, SQLiteRateLimiter
+from conftest import Clock
+
+WINDOW = 60
+LOCKOUT = 60
+
+USER = [('user', 'u1')]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_limiter(request, tmp_path):
+    def make(requests=3, failures=3, lockout_max=3600):
+        limits = {'user': (requests, failures), 'device': (100, 100), 'ip': (100, 100)}
+        options = dict(limits=limits, window=WINDOW, lockout=LOCKOUT, lockout_max=lockout_max)
+        if request.param == 'sqlite':
+            limiter = SQLiteRateLimiter(str(tmp_path / 'rate.db'), **options)
+        else:
+            limiter = RateLimiter(**options)
+        clock = Clock()
+        limiter._now = clock
+        limiter._last_sweep = clock.now
+        return limiter, clock
+    return make
+
+
+def test_window_limit(make_limiter):
+    limiter, clock = make_limiter(requests=3)
+    assert [limiter.check(USER) for _ in range(3)] == [0, 0, 0]
+    clock.advance(10)
+    # La ventana actual termina en 50 segundos
+    assert limiter.check(USER) == 50
+
+
+def test_rejected_requests_do_not_count(make_limiter):
+    limiter, clock = make_limiter(requests=3)
+    for _ in range(3):
+        limiter.check(USER)
+    for _ in range(5):
+        assert limiter.check(USER)
+    assert limiter.rejected == 5
+    # Media ventana después la anterior pesa 3 * 0.5: cabe una más
+    clock.advance(WINDOW + WINDOW / 2)
+    assert limiter.check(USER) == 0
+    assert limiter.check(USER) == WINDOW / 2
+
+
+def test_sliding_window_weights_previous(make_limiter):
+    limiter, clock = make_limiter(requests=3)
+    for _ in range(3):
+        limiter.check(USER)
+    # Justo al empezar la ventana siguiente la anterior pesa completa
+    clock.advance(WINDOW)
+    assert limiter.check(USER) == WINDOW
+    # Dos ventanas sin peticiones: la anterior queda vacía
+    clock.advance(2 * WINDOW)
+    assert [limiter.check(USER) for _ in range(3)] == [0, 0, 0]
+
+
+def test_lockout_after_failures(make_limiter):
+    limiter, clock = make_limiter(requests=100, failures=3)
+    assert [limiter.failure(USER) for _ in range(3)] == [False, False, True]
+    assert limiter.check(USER) == LOCKOUT
+    clock.advance(LOCKOUT - 1)
+    assert limiter.check(USER) == 1
+    clock.advance(1)
+    assert limiter.check(USER) == 0
+    assert limiter.lockouts == 1
+
+
+def test_repeated_lockout_doubles_up_to_max(make_limiter):
+    limiter, clock = make_limiter(requests=100, failures=2, lockout_max=300)
+    durations = []
+    for _ in range(4):
+        limiter.failure(USER)
+        assert limiter.failure(USER)
+        durations.append(limiter.check(USER))
+        clock.advance(durations[-1])
+    assert durations == [60, 120, 240, 300]
+
+
+def test_failures_expire_after_window(make_limiter):
+    limiter, clock = make_limiter(requests=100, failures=3)
+    limiter.failure(USER)
+    limiter.failure(USER)
+    clock.advance(WINDOW)
+    assert not limiter.failure(USER)
+    assert not limiter.failure(USER)
+    assert limiter.failure(USER)
+
+
+def test_success_resets_failures_and_strikes(make_limiter):
+    limiter, clock = make_limiter(requests=100, failures=2)
+    limiter.failure(USER)
+    limiter.failure(USER)
+    clock.advance(LOCKOUT)
+    limiter.success(USER)
+    assert not limiter.failure(USER)
+    assert limiter.failure(USER)
+    # Sin strikes acumulados el bloqueo vuelve a la duración base
+    assert limiter.check(USER) == LOCKOUT
+
+
+def test_lockout_applies_to_any_request_with_the_key(make_limiter):
+    limiter, _ = make_limiter(requests=100, failures=2)
+    limiter.failure([('user', 'u1'), ('device', 'd1')])
+    limiter.failure([('user', 'u1'), ('device', 'd2')])
+    assert limiter.check([('user', 'u1'), ('device', 'd3')]) == LOCKOUT
+    assert limiter.check([('user', 'u2'), ('device', 'd1')]) == 0
+
+
+def test_check_many_counts_in_order(make_limiter):
+    limiter, _ = make_limiter(requests=2)
+    other = [('user', 'u2')]
+    assert limiter.check_many([USER, other, USER, USER]) == [0, 0, 0, WINDOW]
+    assert limiter.check(other) == 0
+
+
+def test_record_many_locks_for_next_requests(make_limiter):
+    limiter, _ = make_limiter(requests=100, failures=2)
+    assert limiter.record_many([USER, USER, USER], [False, None, False]) == [False, False, True]
+    assert limiter.check_many([USER]) == [LOCKOUT]
+
+
+def test_sqlite_counters_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'rate.db')
+    limits = {'user': (2, 5), 'device': (100, 100), 'ip': (100, 100)}
+    clock = Clock()
+    first, second = SQLiteRateLimiter(path, limits=limits), SQLiteRateLimiter(path, limits=limits)
+    first._now = second._now = clock
+    assert first.check(USER) == 0
+    assert second.check(USER) == 0
+    assert first.check(USER) == WINDOW
+    assert second.stats()['keys'] == 1
+
+
+def test_strikes_forgotten_after_lockout_max(make_limiter):
+    limiter, clock = make_limiter(requests=100, failures=2, lockout_max=200)
+    limiter.failure(USER)
+    limiter.failure(USER)
+    clock.advance(200)
+    limiter.failure(USER)
+    limiter.failure(USER)
+    assert limiter.check(USER) == LOCKOUT
@@ -0,0 +1,83 @@
+import pyotp
+import pytest
+
+import replay_guard
+from replay_guard import MemoryUsedCodeIndex, ReplayGuard, SQLiteUsedCodeIndex
+from totp_verifier import TOTPVerifier
+from conftest import Clock
+
+INTERVAL = 30
+SECRET = pyotp.random_base32()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Inicio del paso 1000
+    clock = Clock(1000 * INTERVAL)
+    monkeypatch.setattr(replay_guard, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def guard(request, tmp_path, clock):
+    if request.param == 'sqlite':
+        index = SQLiteUsedCodeIndex(str(tmp_path / 'replay.db'))
+    else:
+        index = MemoryUsedCodeIndex()
+    return ReplayGuard(index, interval=INTERVAL, window=1)
+
+
+def test_code_is_claimed_once(guard):
+    assert guard.claim('u1', 1000)
+    assert not guard.claim('u1', 1000)
+    assert guard.claim('u2', 1000)
+    assert guard.claim('u1', 1001)
+    assert guard.stats()['rejected'] == 1
+
+
+def test_replay_rejected_across_step_rollover(guard, clock):
+    verifier = TOTPVerifier(interval=INTERVAL, window=1)
+    # Código del paso 1000 usado en su último segundo
+    otp = pyotp.TOTP(SECRET).at(clock.now)
+    clock.advance(INTERVAL - 1)
+    step = verifier.verify(SECRET, otp, for_time=clock.now)
+    assert step == 1000
+    assert guard.claim('u1', step)
+
+    # En el paso siguiente el mismo código sigue siendo válido (ventana 1)
+    # pero ya está usado; el del paso nuevo es otro código
+    clock.advance(1)
+    assert verifier.verify(SECRET, otp, for_time=clock.now) == 1000
+    assert not guard.claim('u1', 1000)
+    assert guard.claim('u1', verifier.verify(SECRET, pyotp.TOTP(SECRET).at(clock.now), for_time=clock.now))
+
+
+def test_claim_expires_with_the_window(guard, clock):
+    assert guard.claim('u1', 1000)
+    # Válido hasta el final del paso 1001
+    clock.now = 1002 * INTERVAL - 1
+    assert not guard.claim('u1', 1000)
+    clock.now = 1002 * INTERVAL
+    assert guard.claim('u1', 1000)
+
+
+def test_claim_many_in_order(guard):
+    assert guard.claim('u1', 1000)
+    assert guard.claim_many([('u1', 1000), ('u2', 1000), ('u2', 1000), ('u1', 1001)]) == [
+        False, True, False, True
+    ]
+    assert guard.stats()['rejected'] == 2
+
+
+def test_sqlite_index_shared_between_instances(tmp_path, clock):
+    path = str(tmp_path / 'replay.db')
+    first = ReplayGuard(SQLiteUsedCodeIndex(path), interval=INTERVAL)
+    second = ReplayGuard(SQLiteUsedCodeIndex(path), interval=INTERVAL)
+    assert first.claim('u1', 1000)
+    assert not second.claim('u1', 1000)
+
+
+def test_off_accepts_everything():
+    guard = ReplayGuard(None)
+    assert guard.claim('u1', 1000) and guard.claim('u1', 1000)
+    assert guard.claim_many([('u1', 1000)] * 2) == [True, True]
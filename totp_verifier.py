@@ -0,0 +1,105 @@
+"""
+Verificación TOTP con claves decodificadas y códigos de ventana en caché
+
+Compatible con pyotp.TOTP(secret).verify(otp, valid_window=window) para
+TOTP estándar (SHA1, 6 dígitos, 30 segundos).
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+class TOTPVerifier:
+    """
+    Por cada secreto guarda la clave ya decodificada y los códigos de los
+    pasos actual ± window. Mientras el paso de tiempo no cambie, verificar es
+    solo comparar contra esos códigos; al avanzar un paso se calcula un único
+    HMAC nuevo y se reutilizan los demás.
+    """
+
+    def __init__(self, digits=6, interval=30, window=1, maxsize=100000):
+        self.digits = digits
+        self.interval = interval
+        self.window = window
+        self.maxsize = maxsize
+        self._modulo = 10 ** digits
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hmacs = 0
+
+    def _decode(self, secret):
+        missing = len(secret) % 8
+        if missing:
+            secret += '=' * (8 - missing)
+        return base64.b32decode(secret, casefold=True)
+
+    def _hotp(self, key, counter):
+        digest = hmac.new(key, struct.pack('>Q', counter), hashlib.sha1).digest()
+        offset = digest[-1] & 0x0F
+        value = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7FFFFFFF
+        return str(value % self._modulo).zfill(self.digits)
+
+    def timecode(self, for_time=None):
+        return int((time.time() if for_time is None else for_time) // self.interval)
+
+    def window_codes(self, secret, step):
+        """Códigos {paso: código} de step - window .. step + window"""
+        with self._lock:
+            entry = self._entries.get(secret)
+            if entry is not None:
+                self._entries.move_to_end(secret)
+        if entry is None:
+            entry = {'key': self._decode(secret), 'step': None, 'codes': {}}
+
+        if entry['step'] != step:
+            wanted = range(step - self.window, step + self.window + 1)
+            previous = entry['codes']
+            codes = {}
+            for s in wanted:
+                code = previous.get(s)
+                if code is None:
+                    code = self._hotp(entry['key'], s)
+                    self.hmacs += 1
+                codes[s] = code
+            entry = {'key': entry['key'], 'step': step, 'codes': codes}
+
+        with self._lock:
+            self._entries[secret] = entry
+            self._entries.move_to_end(secret)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry['codes']
+
+    def verify(self, secret, otp, for_time=None):
+        """
+        Retorna el paso de tiempo que coincide con otp, o None si no es válido.
+        El paso sirve como clave para detectar reutilización del código.
+        """
+        otp = str(otp)
+        if len(otp) != self.digits:
+            return None
+        matched = None
+        for step, code in self.window_codes(secret, self.timecode(for_time)).items():
+            if hmac.compare_digest(code, otp):
+                matched = step
+        return matched
+
+    def forget(self, secret):
+        with self._lock:
+            self._entries.pop(secret, None)
+
+    def stats(self):
+        with self._lock:
+            return {'secrets': len(self._entries), 'maxsize': self.maxsize, 'hmacs': self.hmacs}
+
+
+verifier = TOTPVerifier(
+    window=int(os.environ.get('OTP_TOTP_WINDOW', 1)),
+    maxsize=int(os.environ.get('OTP_TOTP_CACHE_SIZE', 100000))
+)